@@ -1,5 +1,16 @@
-from typing import Optional, Dict
+from typing import Optional, Dict, Callable
 import os
+import io
+import pathlib
+import queue
+import atexit
+import hashlib
+import threading
+import traceback
+import dill
+import hydra
+import torch
+from omegaconf import OmegaConf
 
 class TopKCheckpointManager:
     def __init__(self,
@@ -7,8 +18,14 @@ class TopKCheckpointManager:
             monitor_key: str,
             mode='min',
             k=1,
-            format_str='epoch={epoch:03d}-train_loss={train_loss:.3f}.ckpt'
+            format_str='epoch={epoch:03d}-train_loss={train_loss:.3f}.ckpt',
+            delete_fn: Optional[Callable[[str], None]]=None
         ):
+        """
+        delete_fn: removes a checkpoint that fell out of the top k,
+            e.g. through the workspace's CheckpointWriter so it is
+            ordered with pending saves. Default os.remove
+        """
         assert mode in ['max', 'min']
         assert k >= 0
 
@@ -17,6 +34,7 @@ class TopKCheckpointManager:
         self.mode = mode
         self.k = k
         self.format_str = format_str
+        self.delete_fn = delete_fn
         self.path_value_map = dict()
     
     def get_ckpt_path(self, data: Dict[str, float]) -> Optional[str]:
@@ -54,6 +72,222 @@ class TopKCheckpointManager:
             if not os.path.exists(self.save_dir):
                 os.mkdir(self.save_dir)
 
-            if os.path.exists(delete_path):
+            if self.delete_fn is not None:
+                self.delete_fn(delete_path)
+            elif os.path.exists(delete_path):
                 os.remove(delete_path)
             return ckpt_path
+
+
+def save_payload(payload, path: str, pickle_module=dill):
+    """
+    torch.save to a temporary file, renamed into place.
+    """
+    buffer = io.BytesIO()
+    torch.save(payload, buffer, pickle_module=pickle_module)
+    _write_atomic(buffer.getbuffer(), path)
+
+
+def _write_atomic(data, path: str):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class CheckpointWriter:
+    """
+    Persistent background writer for workspace checkpoints.
+    Saves and removals run in order on one thread behind a bounded
+    queue, the trainer only blocks when max_queue_size saves are pending.
+    Files are regular torch.save checkpoints, written to a temporary
+    file and atomically renamed. A payload with the same content as a
+    file written before (latest.ckpt and the top-k checkpoint of an
+    epoch) is hard-linked to it instead of written again.
+    """
+    def __init__(self, max_queue_size: int=2):
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        # sha256 of serialized payload -> (path, st_dev, st_ino)
+        self.written = dict()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        # flush before the interpreter kills the daemon thread
+        atexit.register(self.close)
+
+    def save(self, payload, path: str, ready_event=None, pickle_module=dill):
+        """
+        ready_event: torch.cuda.Event recorded after the device to host
+            copies of the payload, waited on by the writer thread
+        """
+        self._raise_error()
+        self.queue.put(('save', str(path), (payload, pickle_module), ready_event))
+
+    def remove(self, path: str):
+        self._raise_error()
+        self.queue.put(('remove', str(path), None, None))
+
+    def wait(self):
+        """
+        Block until all queued saves are on disk.
+        """
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise RuntimeError(f"Checkpoint writer failed:\n{error}")
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                op, path, payload, ready_event = item
+                if op == 'save':
+                    if ready_event is not None:
+                        ready_event.synchronize()
+                    self._save(*payload, path=path)
+                elif os.path.exists(path):
+                    os.remove(path)
+            except Exception:
+                self.error = traceback.format_exc()
+                print(self.error)
+            finally:
+                self.queue.task_done()
+
+    def _save(self, payload, pickle_module, path: str):
+        buffer = io.BytesIO()
+        torch.save(payload, buffer, pickle_module=pickle_module)
+        data = buffer.getbuffer()
+        digest = hashlib.sha256(data).hexdigest()
+
+        linked = False
+        src_path = self._get_written_path(digest)
+        if (src_path is not None) and os.path.exists(path) \
+                and os.path.samefile(src_path, path):
+            # already a link to it, renaming a link onto the same
+            # file is a no-op that would leave the temporary file
+            linked = True
+        elif (src_path is not None) and (src_path != path):
+            tmp_path = path + '.tmp'
+            try:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                os.link(src_path, tmp_path)
+                os.replace(tmp_path, path)
+                linked = True
+            except OSError:
+                # no hard links on this file system
+                pass
+        if not linked:
+            _write_atomic(data, path)
+
+        # forget files replaced or deleted since
+        self.written = {key: value for key, value
+            in self.written.items() if _is_same_file(value)}
+        stat = os.stat(path)
+        self.written[digest] = (path, stat.st_dev, stat.st_ino)
+
+    def _get_written_path(self, digest: str) -> Optional[str]:
+        value = self.written.get(digest)
+        if (value is None) or (not _is_same_file(value)):
+            return None
+        return value[0]
+
+
+def _is_same_file(value) -> bool:
+    path, st_dev, st_ino = value
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return (stat.st_dev, stat.st_ino) == (st_dev, st_ino)
+
+
+POLICY_ARTIFACT_SUFFIX = '.policy.pt'
+
+
+def get_policy_artifact_path(checkpoint_path) -> pathlib.Path:
+    """
+    latest.ckpt -> latest.policy.pt
+    """
+    path = pathlib.Path(checkpoint_path)
+    if path.name.endswith(POLICY_ARTIFACT_SUFFIX):
+        return path
+    return path.with_suffix(POLICY_ARTIFACT_SUFFIX)
+
+
+def create_policy_artifact(cfg, state_dict: Dict[str, torch.Tensor]) -> Dict:
+    """
+    Everything needed to run a trained policy: its config, weights
+    (including the normalizer) and the env runner config.
+    Plain containers and tensors, loadable with weights_only=True.
+    """
+    artifact = {
+        'policy_cfg': OmegaConf.to_container(cfg.policy, resolve=True),
+        'env_runner_cfg': None,
+        'state_dict': state_dict
+    }
+    if ('task' in cfg) and ('env_runner' in cfg.task):
+        artifact['env_runner_cfg'] = OmegaConf.to_container(
+            cfg.task.env_runner, resolve=True)
+    return artifact
+
+
+def load_policy_artifact(checkpoint, map_location='cpu') -> Dict:
+    """
+    checkpoint: workspace .ckpt or its .policy.pt artifact. Checkpoints
+        without an artifact are loaded in full.
+    """
+    artifact_path = get_policy_artifact_path(checkpoint)
+    if artifact_path.exists():
+        return torch.load(artifact_path, map_location=map_location,
+            weights_only=True)
+
+    payload = torch.load(open(checkpoint, 'rb'), pickle_module=dill,
+        map_location=map_location)
+    cfg = payload['cfg']
+    key = 'ema_model' if cfg.training.use_ema else 'model'
+    return create_policy_artifact(cfg, payload['state_dicts'][key])
+
+
+def policy_from_artifact(artifact: Dict, device='cpu',
+        sampler: Optional[str]=None, num_inference_steps: Optional[int]=None):
+    policy = hydra.utils.instantiate(artifact['policy_cfg'])
+    policy.load_state_dict(artifact['state_dict'])
+    if (sampler is not None) or (num_inference_steps is not None):
+        if not hasattr(policy, 'set_sampler'):
+            raise ValueError(f"{type(policy).__name__} does not support "
+                "choosing the sampler or number of inference steps")
+        policy.set_sampler(
+            sampler=policy.sampler if sampler is None else sampler,
+            num_inference_steps=num_inference_steps)
+    policy.to(device)
+    policy.eval()
+    return policy
+
+
+def load_policy(checkpoint, device='cpu',
+        sampler: Optional[str]=None, num_inference_steps: Optional[int]=None):
+    """
+    Policy in eval mode with the EMA weights if trained with EMA,
+    without the optimizer state and training workspace.
+    sampler, num_inference_steps: override the trained inference
+        sampler (ddpm, ddim, dpmsolver++) and step count, transformer
+        policies only
+    """
+    return policy_from_artifact(
+        load_policy_artifact(checkpoint, map_location=device),
+        device=device,
+        sampler=sampler,
+        num_inference_steps=num_inference_steps)
@@ -0,0 +1,84 @@
+from typing import Optional, Tuple
+import os
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+
+
+def init_distributed(backend: Optional[str]=None) -> Tuple[int, int, int]:
+    """
+    Join the process group described by the torchrun environment
+    (RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR, MASTER_PORT).
+    Without torchrun this is a no-op returning rank 0 of 1.
+    backend: default nccl if cuda is available, gloo otherwise
+    return: rank, world_size, local_rank
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 1, 0
+    rank = int(os.environ['RANK'])
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if not dist.is_initialized():
+        if backend is None:
+            backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+        dist.init_process_group(backend=backend)
+    return rank, world_size, local_rank
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    if not is_distributed():
+        return 0
+    return dist.get_rank()
+
+
+def get_world_size() -> int:
+    if not is_distributed():
+        return 1
+    return dist.get_world_size()
+
+
+def barrier():
+    """
+    Wait for all ranks, no-op without a process group.
+    """
+    if not is_distributed():
+        return
+    if dist.get_backend() == 'nccl':
+        # the GPU of this rank, torch.cuda.set_device may not have run yet
+        dist.barrier(device_ids=[int(os.environ.get('LOCAL_RANK', 0))])
+    else:
+        dist.barrier()
+
+
+def all_reduce_mean(value: float, device: torch.device) -> float:
+    """
+    Mean of a python scalar over all ranks.
+    device: has to be a cuda device for nccl
+    """
+    if not is_distributed():
+        return value
+    x = torch.tensor(value, dtype=torch.float64, device=device)
+    dist.all_reduce(x, op=dist.ReduceOp.SUM)
+    return x.item() / dist.get_world_size()
+
+
+class PolicyLossModule(nn.Module):
+    """
+    DistributedDataParallel only synchronizes gradients of what runs
+    through forward, policies compute their training loss in compute_loss.
+    """
+    def __init__(self, policy: nn.Module):
+        super().__init__()
+        self.policy = policy
+
+    def forward(self, batch):
+        return self.policy.compute_loss(batch)
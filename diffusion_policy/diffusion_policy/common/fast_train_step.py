@@ -0,0 +1,71 @@
+from typing import Dict, Optional
+import torch
+import torch.nn as nn
+from diffusion_policy.common.pytorch_util import autocast, create_grad_scaler
+
+
+class FastTrainStep:
+    """
+    Opt-in replacement for the body of the lowdim training loop:
+    compute_loss compiled once for a static batch shape (CUDA graphs
+    with compile_mode='reduce-overhead') and fused AdamW on CUDA.
+    Nothing in a step reads values back to the host, the returned
+    loss is a device tensor.
+    """
+    def __init__(self,
+            model: nn.Module,
+            optimizer: torch.optim.Optimizer,
+            lr_scheduler,
+            ema=None,
+            gradient_accumulate_every: int=1,
+            compile_mode: Optional[str]='reduce-overhead',
+            loss_module: Optional[nn.Module]=None,
+            precision: str='fp32'):
+        """
+        loss_module: called with the batch to compute the loss,
+            e.g. the DistributedDataParallel wrapped policy.
+            Default model.compute_loss
+        precision: fp32, bf16 or fp16 autocast of the loss computation
+        """
+        self.model = model
+        self.optimizer = optimizer
+        self.lr_scheduler = lr_scheduler
+        self.ema = ema
+        self.gradient_accumulate_every = gradient_accumulate_every
+        self.precision = precision
+        self.device = next(iter(model.parameters())).device
+        self.grad_scaler = create_grad_scaler(self.device, precision)
+
+        self.compute_loss = model.compute_loss
+        if loss_module is not None:
+            self.compute_loss = loss_module
+        if compile_mode is not None:
+            self.compute_loss = torch.compile(self.compute_loss,
+                mode=compile_mode, dynamic=False)
+
+        # fused is a per-group optimizer flag, like lr
+        params = [p for group in optimizer.param_groups for p in group['params']]
+        if isinstance(optimizer, (torch.optim.Adam, torch.optim.AdamW)) \
+                and all(p.is_cuda and p.is_floating_point() for p in params):
+            for group in optimizer.param_groups:
+                group['fused'] = True
+                group['foreach'] = False
+
+    def __call__(self, batch: Dict[str, torch.Tensor], global_step: int) -> torch.Tensor:
+        if hasattr(torch.compiler, 'cudagraph_mark_step_begin'):
+            torch.compiler.cudagraph_mark_step_begin()
+        with autocast(self.device, self.precision):
+            raw_loss = self.compute_loss(batch)
+        loss = raw_loss / self.gradient_accumulate_every
+        self.grad_scaler.scale(loss).backward()
+
+        if global_step % self.gradient_accumulate_every == 0:
+            self.grad_scaler.step(self.optimizer)
+            self.grad_scaler.update()
+            self.optimizer.zero_grad(set_to_none=True)
+            self.lr_scheduler.step()
+
+        if self.ema is not None:
+            self.ema.step(self.model)
+        # graph outputs are overwritten by the next replay
+        return raw_loss.detach().clone()
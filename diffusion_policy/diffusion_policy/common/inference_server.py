@@ -0,0 +1,237 @@
+from typing import Dict, List, Optional
+import time
+import queue
+import threading
+import traceback
+import collections
+import numpy as np
+import torch
+import torch.nn as nn
+from multiprocessing.connection import Listener, Client
+from diffusion_policy.common.inference_session import InferenceSession
+
+
+class InferenceServer:
+    """
+    Serves predict_action of one policy to several clients (robots,
+    simulator processes) over a Unix domain socket. Requests arriving
+    within max_wait_ms of the oldest waiting one are stacked into a
+    single batch, up to max_batch_size observations.
+    Each reply carries the time the request waited for its batch and
+    the time of the batched inference.
+    """
+    def __init__(self,
+            policy: nn.Module,
+            address: str,
+            max_batch_size: int=32,
+            max_wait_ms: float=2.0,
+            authkey: Optional[bytes]=None,
+            n_latency_records: int=100000):
+        """
+        address: path of the Unix domain socket
+        max_wait_ms: longest a request waits for others to batch with
+        n_latency_records: per request latencies kept for get_stats
+        """
+        self.policy = policy
+        self.address = address
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.authkey = authkey
+
+        self.listener = Listener(address, family='AF_UNIX', authkey=authkey)
+        self.requests = queue.Queue()
+        self.sessions = dict()
+        self.connections = list()
+        self.closed = threading.Event()
+        self._carry = None
+
+        self.stats_lock = threading.Lock()
+        self.records = collections.deque(maxlen=n_latency_records)
+        self.n_batches = 0
+
+        self.accept_thread = threading.Thread(target=self._accept_loop, daemon=True)
+        self.accept_thread.start()
+
+    def _accept_loop(self):
+        while not self.closed.is_set():
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                break
+            if self.closed.is_set():
+                conn.close()
+                break
+            self.connections.append(conn)
+            threading.Thread(target=self._read_loop, args=(conn,), daemon=True).start()
+
+    def _read_loop(self, conn):
+        while not self.closed.is_set():
+            try:
+                command, obs = conn.recv()
+            except (EOFError, OSError):
+                break
+            if command == 'stats':
+                conn.send(self.get_stats())
+                continue
+            To = self.policy.n_obs_steps
+            Do = self.policy.obs_dim
+            if (obs.ndim != 3) or (obs.shape[1] < To) or (obs.shape[2] != Do):
+                # rejected before it can fail a whole batch
+                self._send(conn, {'error': f"Expected obs of shape (B,{To},{Do}), got {obs.shape}"})
+                continue
+            self.requests.put((conn, obs[:,:To], time.perf_counter()))
+
+    def _next_request(self, timeout: float):
+        if self._carry is not None:
+            request, self._carry = self._carry, None
+            return request
+        if timeout <= 0:
+            return self.requests.get_nowait()
+        return self.requests.get(timeout=timeout)
+
+    def _collect_batch(self) -> List:
+        """
+        Oldest request, everything queued behind it and the requests
+        arriving until max_wait after it was received.
+        """
+        try:
+            first = self._next_request(timeout=0.1)
+        except queue.Empty:
+            return list()
+        batch = [first]
+        n_obs = len(first[1])
+        deadline = first[2] + self.max_wait
+        while n_obs < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                request = self._next_request(timeout=timeout)
+            except queue.Empty:
+                break
+            if n_obs + len(request[1]) > self.max_batch_size:
+                # first of the next batch
+                self._carry = request
+                break
+            batch.append(request)
+            n_obs += len(request[1])
+        return batch
+
+    def _get_session(self, batch_size: int) -> InferenceSession:
+        session = self.sessions.get(batch_size)
+        if session is None:
+            session = InferenceSession(self.policy, batch_size=batch_size)
+            self.sessions[batch_size] = session
+        return session
+
+    def _run_batch(self, batch: List):
+        start_time = time.perf_counter()
+        sizes = [len(obs) for _, obs, _ in batch]
+        try:
+            obs = torch.from_numpy(np.concatenate([obs for _, obs, _ in batch]))
+            result = self._get_session(len(obs)).predict_action({'obs': obs})
+            result = {key: value.cpu().numpy() for key, value in result.items()}
+        except Exception:
+            error = traceback.format_exc()
+            for conn, _, _ in batch:
+                self._send(conn, {'error': error})
+            return
+        end_time = time.perf_counter()
+        inference_ms = (end_time - start_time) * 1000
+
+        records = list()
+        start = 0
+        for (conn, _, received_time), size in zip(batch, sizes):
+            end = start + size
+            latency = {
+                'queue_ms': (start_time - received_time) * 1000,
+                'inference_ms': inference_ms,
+                'batch_size': len(obs)
+            }
+            reply = {key: value[start:end] for key, value in result.items()}
+            reply['latency'] = latency
+            self._send(conn, reply)
+            records.append(latency)
+            start = end
+        with self.stats_lock:
+            self.records.extend(records)
+            self.n_batches += 1
+
+    def _send(self, conn, reply):
+        try:
+            conn.send(reply)
+        except OSError:
+            # client disconnected while waiting
+            pass
+
+    def serve_forever(self):
+        while not self.closed.is_set():
+            batch = self._collect_batch()
+            if len(batch) > 0:
+                self._run_batch(batch)
+
+    def get_stats(self) -> Dict:
+        """
+        Request counts and latency percentiles over the kept records.
+        """
+        with self.stats_lock:
+            records = list(self.records)
+            n_batches = self.n_batches
+        stats = {
+            'n_requests': len(records),
+            'n_batches': n_batches
+        }
+        if len(records) > 0:
+            for key in ['queue_ms', 'inference_ms', 'batch_size']:
+                values = np.array([record[key] for record in records])
+                stats[key + '_mean'] = float(values.mean())
+                stats[key + '_p50'] = float(np.percentile(values, 50))
+                stats[key + '_p99'] = float(np.percentile(values, 99))
+        return stats
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        # wake up the blocking accept
+        try:
+            Client(self.address, family='AF_UNIX', authkey=self.authkey).close()
+        except OSError:
+            pass
+        self.listener.close()
+        for conn in self.connections:
+            conn.close()
+
+
+class InferenceClient:
+    """
+    Drop-in for policy.predict_action backed by an InferenceServer.
+    """
+    def __init__(self, address: str, authkey: Optional[bytes]=None):
+        self.conn = Client(address, family='AF_UNIX', authkey=authkey)
+        self.last_latency = None
+
+    def predict_action(self, obs_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        """
+        obs_dict: "obs" (B,To,Do), tensor or ndarray
+        result: as policy.predict_action, on the device of obs
+        """
+        obs = obs_dict['obs']
+        device = torch.device('cpu')
+        if isinstance(obs, torch.Tensor):
+            device = obs.device
+            obs = obs.detach().cpu().numpy()
+        start_time = time.perf_counter()
+        self.conn.send(('predict_action', np.ascontiguousarray(obs, dtype=np.float32)))
+        reply = self.conn.recv()
+        if 'error' in reply:
+            raise RuntimeError(f"Inference server failed:\n{reply['error']}")
+        latency = reply.pop('latency')
+        latency['round_trip_ms'] = (time.perf_counter() - start_time) * 1000
+        self.last_latency = latency
+        return {key: torch.from_numpy(value).to(device) for key, value in reply.items()}
+
+    def get_stats(self) -> Dict:
+        self.conn.send(('stats', None))
+        return self.conn.recv()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,163 @@
+from typing import Dict, Optional, Union
+import numpy as np
+import torch
+import torch.nn as nn
+from diffusers.schedulers.scheduling_ddpm import DDPMScheduler
+from diffusion_policy.model.diffusion.inference_scheduler import get_ddpm_step_coefficients
+
+
+class InferenceSession:
+    """
+    predict_action of a diffusion transformer lowdim policy for a fixed
+    batch size, without per call allocations outside the model itself:
+    observation, trajectory, noise and output buffers are allocated
+    once, the timestep schedule and DDPM step coefficients are cached
+    and the conditioning is written as a slice instead of a mask.
+    Same samples as policy.predict_action for the same random state.
+    The returned tensors are overwritten by the next call.
+    """
+    def __init__(self,
+            policy: nn.Module,
+            batch_size: int=1,
+            generator: Optional[torch.Generator]=None):
+        """
+        policy: DiffusionTransformerLowdimPolicy, in eval mode from here on.
+            Call again after changing its sampler or step count.
+        generator: for the initial and DDPM step noise, default global RNG
+        """
+        assert isinstance(policy.model, nn.Module)
+        policy.eval()
+        self.policy = policy
+        self.batch_size = batch_size
+        self.generator = generator
+
+        device = policy.device
+        dtype = policy.dtype
+        B = batch_size
+        To = policy.n_obs_steps
+        T = policy.horizon
+        Da = policy.action_dim
+        Do = policy.obs_dim
+
+        self.obs_params = policy.normalizer['obs'].params_dict
+        self.action_params = policy.normalizer['action'].params_dict
+        self.nobs = torch.empty((B, To, Do), device=device, dtype=dtype)
+        if policy.obs_as_cond:
+            shape = (B, T, Da)
+            if policy.pred_action_steps_only:
+                shape = (B, policy.n_action_steps, Da)
+        else:
+            shape = (B, T, Da+Do)
+        self.trajectory = torch.empty(shape, device=device, dtype=dtype)
+        self.noise = torch.empty(shape, device=device, dtype=dtype)
+        self.pred_original_sample = torch.empty(shape, device=device, dtype=dtype)
+        self.action_pred = torch.empty((B, shape[1], Da), device=device, dtype=dtype)
+        self.obs_pred = None
+        if not policy.obs_as_cond:
+            self.obs_pred = torch.empty((B, T, Do), device=device, dtype=dtype)
+
+        # timestep schedule, model timesteps already broadcast to the batch
+        scheduler = policy.inference_scheduler
+        scheduler.set_timesteps(policy.num_inference_steps)
+        self.timesteps = scheduler.timesteps.clone()
+        self.model_timesteps = [t.to(device).expand(B).contiguous()
+            for t in self.timesteps]
+        self.step_coefficients = None
+        if isinstance(scheduler, DDPMScheduler):
+            self.step_coefficients = get_ddpm_step_coefficients(scheduler)
+        if self.step_coefficients is not None:
+            self.step_coefficients = list(self.step_coefficients.to(device))
+            self.clip_sample_range = None
+            if scheduler.config.clip_sample:
+                self.clip_sample_range = scheduler.config.clip_sample_range
+
+        start = To - 1
+        end = start + policy.n_action_steps
+        if policy.pred_action_steps_only:
+            start, end = 0, policy.n_action_steps
+        self.action_slice = slice(start, end)
+
+    def _apply_conditioning(self):
+        # mask of predict_action, only the observations when inpainting
+        if not self.policy.obs_as_cond:
+            Da = self.policy.action_dim
+            To = self.policy.n_obs_steps
+            self.trajectory[:,:To,Da:] = self.nobs
+
+    def _step(self, i: int, model_output: torch.Tensor):
+        """
+        x_t -> x_t-1 in place, ddpm_step without temporaries
+        """
+        coefficients = self.step_coefficients[i]
+        x_0 = self.pred_original_sample
+        # model_output is not used after the step
+        model_output.mul_(coefficients[0])
+        torch.sub(self.trajectory, model_output, out=x_0)
+        x_0.div_(coefficients[1])
+        if self.clip_sample_range is not None:
+            x_0.clamp_(-self.clip_sample_range, self.clip_sample_range)
+        x_0.mul_(coefficients[2])
+        self.trajectory.mul_(coefficients[3])
+        self.trajectory.add_(x_0)
+        if self.timesteps[i] > 0:
+            torch.randn(self.noise.shape, generator=self.generator, out=self.noise)
+            self.noise.mul_(coefficients[4])
+            self.trajectory.add_(self.noise)
+
+    @torch.no_grad()
+    def predict_action(self, obs_dict: Dict[str, Union[torch.Tensor, np.ndarray]]
+            ) -> Dict[str, torch.Tensor]:
+        """
+        obs_dict: "obs" (batch_size,>=n_obs_steps,obs_dim)
+        result: "action" and "action_pred" as in policy.predict_action
+        """
+        policy = self.policy
+        model = policy.model
+        obs = obs_dict['obs']
+        if isinstance(obs, np.ndarray):
+            obs = torch.from_numpy(obs)
+        assert obs.shape[0] == self.batch_size
+
+        # normalize, as LinearNormalizer
+        self.nobs.copy_(obs[:,:policy.n_obs_steps])
+        self.nobs.mul_(self.obs_params['scale'])
+        self.nobs.add_(self.obs_params['offset'])
+
+        cond = None
+        model_kwargs = dict()
+        if policy.obs_as_cond:
+            cond = self.nobs
+            if hasattr(model, 'embed_obs'):
+                model_kwargs['obs_emb'] = model.embed_obs(cond)
+
+        torch.randn(self.trajectory.shape, generator=self.generator, out=self.trajectory)
+        scheduler = policy.inference_scheduler
+        if self.step_coefficients is None:
+            # multistep solvers keep state between steps
+            scheduler.set_timesteps(policy.num_inference_steps)
+        for i, t in enumerate(self.timesteps):
+            self._apply_conditioning()
+            model_output = model(self.trajectory, self.model_timesteps[i], cond, **model_kwargs)
+            if self.step_coefficients is None:
+                self.trajectory.copy_(scheduler.step(
+                    model_output, t, self.trajectory,
+                    generator=self.generator,
+                    **policy.kwargs).prev_sample)
+            else:
+                self._step(i, model_output)
+        self._apply_conditioning()
+
+        # unnormalize, as LinearNormalizer
+        Da = policy.action_dim
+        torch.sub(self.trajectory[...,:Da], self.action_params['offset'], out=self.action_pred)
+        self.action_pred.div_(self.action_params['scale'])
+        result = {
+            'action': self.action_pred[:,self.action_slice],
+            'action_pred': self.action_pred
+        }
+        if self.obs_pred is not None:
+            torch.sub(self.trajectory[...,Da:], self.obs_params['offset'], out=self.obs_pred)
+            self.obs_pred.div_(self.obs_params['scale'])
+            result['action_obs_pred'] = self.obs_pred[:,self.action_slice]
+            result['obs_pred'] = self.obs_pred
+        return result
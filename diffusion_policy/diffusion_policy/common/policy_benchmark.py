@@ -0,0 +1,123 @@
+from typing import Dict, Optional
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+def count_model_calls(policy: nn.Module, obs: torch.Tensor) -> int:
+    """
+    Network evaluations of one policy.predict_action.
+    """
+    n_calls = [0]
+    def hook(module, args):
+        n_calls[0] += 1
+    handle = policy.model.register_forward_pre_hook(hook)
+    try:
+        with torch.no_grad():
+            policy.predict_action({'obs': obs})
+    finally:
+        handle.remove()
+    return n_calls[0]
+
+
+def measure_latency(policy: nn.Module, obs: torch.Tensor,
+        n_warmup: int=10) -> np.ndarray:
+    """
+    Batch 1 predict_action latency in seconds for each observation.
+    obs: (N,To,Do)
+    """
+    device = policy.device
+    latencies = list()
+    for i in range(n_warmup + obs.shape[0]):
+        obs_dict = {'obs': obs[i % obs.shape[0]][None].to(device)}
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start_time = time.perf_counter()
+        with torch.no_grad():
+            policy.predict_action(obs_dict)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        if i >= n_warmup:
+            latencies.append(time.perf_counter() - start_time)
+    return np.array(latencies)
+
+
+def sample_actions(policy: nn.Module, obs: torch.Tensor,
+        batch_size: int=256, seed: int=0) -> torch.Tensor:
+    """
+    action_pred (N,T,Da) on cpu, the same noise for every policy
+    with the same trajectory shape.
+    """
+    torch.manual_seed(seed)
+    actions = list()
+    for start in range(0, obs.shape[0], batch_size):
+        obs_dict = {'obs': obs[start:start + batch_size].to(policy.device)}
+        with torch.no_grad():
+            actions.append(policy.predict_action(obs_dict)['action_pred'].cpu())
+    return torch.cat(actions)
+
+
+def _rmse(x: torch.Tensor, y: torch.Tensor) -> float:
+    return torch.sqrt(torch.mean(torch.square(x - y))).item()
+
+
+def compare_policies(policies: Dict[str, nn.Module],
+        obs: torch.Tensor,
+        action: Optional[torch.Tensor]=None,
+        reference: Optional[str]=None,
+        n_latency: int=200,
+        seed: int=0) -> Dict[str, Dict[str, float]]:
+    """
+    Latency and action quality of policies on the same observations.
+    obs: (N,To,Do) unnormalized
+    action: (N,T,Da) recorded actions, optional
+    reference: name of the policy the others are compared against,
+        default the first. Its row compares two of its samples with
+        different noise, the error floor of any other policy.
+    return: per policy model_calls, latency_ms_p50/p99,
+        action_rmse (to action) and reference_rmse
+    """
+    if reference is None:
+        reference = next(iter(policies))
+    reference_action = sample_actions(policies[reference], obs, seed=seed)
+
+    report = dict()
+    for name, policy in policies.items():
+        latencies = measure_latency(policy, obs[:n_latency]) * 1000
+        if name == reference:
+            # independent noise
+            action_pred = sample_actions(policy, obs, seed=seed + 1)
+        else:
+            action_pred = sample_actions(policy, obs, seed=seed)
+        result = {
+            'model_calls': count_model_calls(policy, obs[:1].to(policy.device)),
+            'latency_ms_p50': float(np.percentile(latencies, 50)),
+            'latency_ms_p99': float(np.percentile(latencies, 99)),
+            'reference_rmse': _rmse(action_pred, reference_action)
+        }
+        if action is not None:
+            start = 0
+            if action_pred.shape[1] != action.shape[1]:
+                # pred_action_steps_only
+                start = policy.n_obs_steps - 1
+            end = start + action_pred.shape[1]
+            result['action_rmse'] = _rmse(action_pred, action[:,start:end])
+        report[name] = result
+    return report
+
+
+def format_comparison(report: Dict[str, Dict[str, float]]) -> str:
+    """
+    Table of compare_policies, speedup relative to the first policy.
+    """
+    lines = [f"{'policy':>24} {'calls':>5} {'p50 ms':>8} {'p99 ms':>8} "
+        f"{'speedup':>8} {'action rmse':>12} {'ref rmse':>9}"]
+    reference_p50 = next(iter(report.values()))['latency_ms_p50']
+    for name, result in report.items():
+        lines.append(f"{name:>24} {result['model_calls']:>5} "
+            f"{result['latency_ms_p50']:>8.2f} {result['latency_ms_p99']:>8.2f} "
+            f"{reference_p50 / result['latency_ms_p50']:>7.2f}x "
+            f"{result.get('action_rmse', float('nan')):>12.5f} "
+            f"{result['reference_rmse']:>9.5f}")
+    return '\n'.join(lines)
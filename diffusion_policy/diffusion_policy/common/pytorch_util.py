@@ -1,4 +1,4 @@
-from typing import Dict, Callable, List
+from typing import Dict, Callable, List, Optional
 import collections
 import torch
 import torch.nn as nn
@@ -80,3 +80,32 @@ def optimizer_to(optimizer, device):
             if isinstance(v, torch.Tensor):
                 state[k] = v.to(device=device)
     return optimizer
+
+def get_autocast_dtype(precision: str) -> Optional[torch.dtype]:
+    """
+    precision: fp32, bf16 or fp16
+    return: autocast dtype, None for fp32
+    """
+    if precision == 'fp32':
+        return None
+    elif precision == 'bf16':
+        return torch.bfloat16
+    elif precision == 'fp16':
+        return torch.float16
+    raise ValueError(f"Unsupported precision {precision}")
+
+def autocast(device, precision: str):
+    """
+    Mixed precision context for the forward pass, disabled for fp32.
+    """
+    dtype = get_autocast_dtype(precision)
+    return torch.autocast(device_type=torch.device(device).type,
+        dtype=dtype, enabled=dtype is not None)
+
+def create_grad_scaler(device, precision: str):
+    """
+    Loss scaling is only needed for fp16, the scaler
+    is a pass-through otherwise.
+    """
+    return torch.amp.GradScaler(torch.device(device).type,
+        enabled=(precision == 'fp16'))
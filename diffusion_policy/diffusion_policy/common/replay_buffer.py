@@ -1,10 +1,15 @@
 from typing import Union, Dict, Optional
 import os
+import json
 import math
 import numbers
+import hashlib
+import time
+import concurrent.futures
 import zarr
 import numcodecs
 import numpy as np
+import tqdm
 try:
     from functools import cached_property
 except:
@@ -84,12 +89,108 @@ def get_optimal_chunks(shape, dtype,
     # print(np.prod(chunks) * itemsize / target_chunk_bytes)
     return chunks
 
+def _walk_zarr_files(zarr_path, paths):
+    """
+    Sorted (relative path, absolute path) of the files under paths.
+    """
+    for path in paths:
+        for dirpath, _, filenames in sorted(os.walk(
+                os.path.join(zarr_path, path))):
+            for filename in sorted(filenames):
+                file_path = os.path.join(dirpath, filename)
+                yield os.path.relpath(file_path, zarr_path), file_path
+
+def get_zarr_hash(zarr_path, keys=None, block_size=2**20) -> str:
+    """
+    Content hash of an on-disk (directory store) zarr.
+    Hashes the raw chunk files of meta and the given data keys,
+    which avoids decompressing anything.
+    """
+    zarr_path = os.path.expanduser(zarr_path)
+    if keys is None:
+        paths = ['meta', 'data']
+    else:
+        paths = ['meta'] + ['data/' + key for key in keys]
+    
+    return _hash_zarr_files(zarr_path, paths, block_size=block_size)
+
+def _hash_zarr_files(zarr_path, paths, block_size=2**20) -> str:
+    hasher = hashlib.sha1()
+    for rel_path, file_path in _walk_zarr_files(zarr_path, paths):
+        hasher.update(rel_path.encode())
+        with open(file_path, 'rb') as f:
+            while True:
+                block = f.read(block_size)
+                if len(block) == 0:
+                    break
+                hasher.update(block)
+    return hasher.hexdigest()
+
+def get_zarr_fingerprint(zarr_path, path) -> str:
+    """
+    Cheap change detection for one group or array (e.g. 'meta',
+    'data/obs') of an on-disk zarr: contents of the .zarray/.zattrs/.zgroup
+    files plus name, size and mtime of every chunk file, nothing is read.
+    """
+    zarr_path = os.path.expanduser(zarr_path)
+    hasher = hashlib.sha1()
+    for rel_path, file_path in _walk_zarr_files(zarr_path, [path]):
+        hasher.update(rel_path.encode())
+        if os.path.basename(rel_path) in ('.zarray', '.zattrs', '.zgroup'):
+            with open(file_path, 'rb') as f:
+                hasher.update(f.read())
+        else:
+            stat = os.stat(file_path)
+            hasher.update(f'{stat.st_size} {stat.st_mtime_ns}'.encode())
+    return hasher.hexdigest()
+
+def load_array_parallel(arr: zarr.Array, num_threads: int=1, desc=None) -> np.ndarray:
+    """
+    Decompress a zarr array into a preallocated numpy array, one chunk
+    (along the first dimension) per task on a thread pool.
+    Blosc releases the GIL, so decoding scales with num_threads.
+    Progress is reported in bytes/s.
+    """
+    result = np.empty(arr.shape, dtype=arr.dtype)
+    if arr.shape[0] == 0:
+        return result
+    chunk_length = arr.chunks[0]
+    step_nbytes = result.nbytes // arr.shape[0]
+    slices = [slice(start, min(start + chunk_length, arr.shape[0])) 
+        for start in range(0, arr.shape[0], chunk_length)]
+
+    def load_chunk(this_slice):
+        result[this_slice] = arr[this_slice]
+        return (this_slice.stop - this_slice.start) * step_nbytes
+
+    start_time = time.perf_counter()
+    with tqdm.tqdm(total=result.nbytes, desc=desc, unit='B', 
+            unit_scale=True, leave=False) as pbar:
+        if num_threads <= 1:
+            for this_slice in slices:
+                pbar.update(load_chunk(this_slice))
+        else:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=num_threads) as executor:
+                futures = [executor.submit(load_chunk, this_slice) 
+                    for this_slice in slices]
+                for future in concurrent.futures.as_completed(futures):
+                    pbar.update(future.result())
+    elapsed = time.perf_counter() - start_time
+    mb = result.nbytes / 1e6
+    print(f"loaded {desc}: {mb:.1f} MB in {elapsed:.2f} s "
+        f"({mb / max(elapsed, 1e-6):.1f} MB/s, {num_threads} threads)")
+    return result
+
 
 class ReplayBuffer:
     """
     Zarr-based temporal datastructure.
     Assumes first dimension to be time. Only chunk in time dimension.
     """
+    _mmap_args = None
+    _stream = None
+
     def __init__(self, 
             root: Union[zarr.Group, 
             Dict[str,dict]]):
@@ -100,8 +201,8 @@ class ReplayBuffer:
         assert('meta' in root)
         assert('episode_ends' in root['meta'])
         for key, value in root['data'].items():
-            value = value[:root['meta']['episode_ends'][-1]]
-            assert(value.shape[0] == root['meta']['episode_ends'][-1])
+            # shape only, slicing a zarr array would read all of it
+            assert(value.shape[0] >= root['meta']['episode_ends'][-1])
         self.root = root
     
     # ============= create constructors ===============
@@ -153,9 +254,11 @@ class ReplayBuffer:
             chunks: Dict[str,tuple]=dict(), 
             compressors: Union[dict, str, numcodecs.abc.Codec]=dict(), 
             if_exists='replace',
+            num_threads: int=1,
             **kwargs):
         """
         Load to memory.
+        num_threads: chunks decompressed concurrently (numpy backend)
         """
         src_root = zarr.group(src_store)
         root = None
@@ -171,12 +274,10 @@ class ReplayBuffer:
             if keys is None:
                 keys = src_root['data'].keys()
             data = dict()
-            print("start loading data")
             for key in keys:
-                print("loading", key)
                 arr = src_root['data'][key]
-                data[key] = arr[:]
-                print("loaded", key)
+                data[key] = load_array_parallel(
+                    arr, num_threads=num_threads, desc=key)
 
             root = {
                 'meta': meta,
@@ -218,18 +319,240 @@ class ReplayBuffer:
             chunks: Dict[str,tuple]=dict(), 
             compressors: Union[dict, str, numcodecs.abc.Codec]=dict(), 
             if_exists='replace',
+            num_threads: int=1,
             **kwargs):
         """
         Copy a on-disk zarr to in-memory compressed.
         Recommended
+
+        backend='mmap': convert the zarr once into an uncompressed
+            memory-mapped copy next to it (see get_mmap_path) and open that
+            instead, nothing is loaded into process memory. Keys whose
+            content changed since the conversion are converted again, checked
+            with get_zarr_fingerprint and only hashed when that differs.
         """
         if backend == 'numpy':
             print('backend argument is deprecated!')
             store = None
+        elif backend == 'mmap':
+            mmap_path = cls.get_mmap_path(zarr_path)
+            group = zarr.open(os.path.expanduser(zarr_path), 'r')
+            if keys is None:
+                keys = list(group['data'].keys())
+            record_path = os.path.join(mmap_path, 'source_hash.json')
+            record = dict()
+            if os.path.isfile(record_path):
+                with open(record_path, 'r') as f:
+                    record = json.load(f)
+            # fingerprint and content hash of meta and each key at
+            # conversion, content is only hashed when the fingerprint
+            # changed, e.g. a source rewritten with the same episodes
+            changed = set()
+            is_updated = False
+            for name in ['meta'] + keys:
+                path = name if name == 'meta' else 'data/' + name
+                converted = record.get(name)
+                if not isinstance(converted, dict):
+                    converted = dict()
+                fingerprint = get_zarr_fingerprint(zarr_path, path)
+                if converted.get('fingerprint') == fingerprint:
+                    continue
+                source_hash = _hash_zarr_files(
+                    os.path.expanduser(zarr_path), [path])
+                if converted.get('hash') != source_hash:
+                    changed.add(name)
+                record[name] = {'fingerprint': fingerprint, 'hash': source_hash}
+                is_updated = True
+            if 'meta' in changed:
+                # keys converted with the old meta, not checked here
+                record = {name: value for name, value in record.items()
+                    if (name == 'meta') or (name in keys)}
+            missing_keys = [key for key in keys
+                if ('meta' in changed) or (key in changed)
+                or not os.path.isfile(os.path.join(mmap_path, 'data', key + '.npy'))]
+            if len(missing_keys) > 0:
+                cls._save_root_to_mmap(group, mmap_path, keys=missing_keys)
+            if is_updated:
+                tmp_path = record_path + f'.{os.getpid()}.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(record, f)
+                os.replace(tmp_path, record_path)
+            return cls.create_from_mmap_path(mmap_path, keys=keys)
         group = zarr.open(os.path.expanduser(zarr_path), 'r')
         return cls.copy_from_store(src_store=group.store, store=store, 
             keys=keys, chunks=chunks, compressors=compressors, 
-            if_exists=if_exists, **kwargs)
+            if_exists=if_exists, num_threads=num_threads, **kwargs)
+
+    # ============= merge ===============
+    @classmethod
+    def merge(cls, paths, out_path, keys=None,
+            chunks: Dict[str,tuple]=dict(),
+            compressors: Union[dict, str, numcodecs.abc.Codec]=dict(),
+            skill_ids: Optional[list]=None,
+            target_block_bytes=2**26):
+        """
+        Concatenate the episodes of several on-disk zarrs into a new one
+        at out_path, in bounded memory: destination arrays are preallocated
+        and filled block by block (about target_block_bytes per copy, aligned
+        to the destination chunks). Chunks and compressors default to those
+        of the first source.
+        skill_ids: one int per path, stored per episode in meta/skill_ids.
+        True uses the index of the path.
+        """
+        src_roots = [zarr.open(os.path.expanduser(path), 'r') for path in paths]
+        if keys is None:
+            keys = list(src_roots[0]['data'].keys())
+        if skill_ids is True:
+            skill_ids = list(range(len(paths)))
+        if skill_ids is not None:
+            assert(len(skill_ids) == len(paths))
+
+        # older datasets stored episode_ends as float64
+        src_ends = [src_root['meta']['episode_ends'][:].astype(np.int64) 
+            for src_root in src_roots]
+        offsets = np.cumsum([0] + [ends[-1] if len(ends) > 0 else 0 
+            for ends in src_ends]).astype(np.int64)
+        n_steps = int(offsets[-1])
+
+        root = zarr.open(os.path.expanduser(out_path), 'w')
+        data_group = root.create_group('data')
+        for key in keys:
+            src_arrs = [src_root['data'][key] for src_root in src_roots]
+            for src_arr in src_arrs:
+                assert(src_arr.shape[1:] == src_arrs[0].shape[1:])
+            first_arr = src_arrs[0]
+            cks = cls._resolve_array_chunks(
+                chunks=chunks, key=key, array=first_arr)
+            cpr = cls._resolve_array_compressor(
+                compressors=compressors, key=key, array=first_arr)
+            arr = data_group.zeros(name=key,
+                shape=(n_steps,) + first_arr.shape[1:],
+                chunks=cks,
+                dtype=np.result_type(*[x.dtype for x in src_arrs]),
+                compressor=cpr)
+
+            step_bytes = arr.dtype.itemsize * int(np.prod(arr.shape[1:]))
+            block_length = cks[0] * max(1, 
+                int(target_block_bytes // (step_bytes * cks[0])))
+            for path, src_arr, offset, ends in zip(
+                    paths, src_arrs, offsets, src_ends):
+                print(f"Merging {key} from {path}")
+                stop = int(offset + (ends[-1] if len(ends) > 0 else 0))
+                start = int(offset)
+                while start < stop:
+                    # split at destination block boundaries
+                    end = min((start // block_length + 1) * block_length, stop)
+                    arr[start:end] = src_arr[start-offset:end-offset]
+                    start = end
+
+        # meta last, a partial merge has no episodes
+        meta_group = root.create_group('meta')
+        episode_ends = np.concatenate([ends + offset
+            for ends, offset in zip(src_ends, offsets)])
+        meta_group.array('episode_ends', episode_ends, 
+            chunks=episode_ends.shape, compressor=None)
+        if skill_ids is not None:
+            episode_skill_ids = np.concatenate([
+                np.full(len(ends), skill_id, dtype=np.int64)
+                for ends, skill_id in zip(src_ends, skill_ids)])
+            meta_group.array('skill_ids', episode_skill_ids, 
+                chunks=episode_skill_ids.shape, compressor=None)
+        root.attrs['merged_from'] = [os.path.basename(
+            os.path.expanduser(path).rstrip('/')) for path in paths]
+        return cls.create_from_group(root)
+
+    # ============= mmap backend ===============
+    @staticmethod
+    def get_mmap_path(zarr_path):
+        zarr_path = os.path.expanduser(zarr_path).rstrip('/')
+        return os.path.splitext(zarr_path)[0] + '.mmap'
+
+    @classmethod
+    def create_from_mmap_path(cls, mmap_path, keys=None, mode='r'):
+        """
+        Open a directory written by save_to_mmap_path.
+        Uses the numpy backend with np.memmap arrays, so processes and
+        DataLoader workers opening the same files share the page cache.
+        """
+        mmap_path = os.path.expanduser(mmap_path)
+        root = {
+            'meta': cls._load_mmap_dir(
+                os.path.join(mmap_path, 'meta'), mode=mode),
+            'data': cls._load_mmap_dir(
+                os.path.join(mmap_path, 'data'), keys=keys, mode=mode)
+        }
+        buffer = cls(root=root)
+        buffer._mmap_args = (mmap_path, keys, mode)
+        return buffer
+
+    def save_to_mmap_path(self, mmap_path, keys=None):
+        """
+        Write one uncompressed .npy file per key (plus meta),
+        to be opened with create_from_mmap_path.
+        """
+        self._save_root_to_mmap(self.root, mmap_path, keys=keys)
+        return mmap_path
+
+    @staticmethod
+    def _load_mmap_dir(path, keys=None, mode='r'):
+        if keys is None:
+            keys = sorted(os.path.splitext(name)[0] for name in os.listdir(path) 
+                if name.endswith('.npy'))
+        result = dict()
+        for key in keys:
+            result[key] = np.load(os.path.join(path, key + '.npy'), mmap_mode=mode)
+        return result
+
+    @staticmethod
+    def _save_root_to_mmap(root, mmap_path, keys=None, 
+            chunk_length=2**16):
+        mmap_path = os.path.expanduser(mmap_path)
+        meta_dir = os.path.join(mmap_path, 'meta')
+        data_dir = os.path.join(mmap_path, 'data')
+        os.makedirs(meta_dir, exist_ok=True)
+        os.makedirs(data_dir, exist_ok=True)
+
+        for key, value in root['meta'].items():
+            this_path = os.path.join(meta_dir, key + '.npy')
+            tmp_path = this_path + f'.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.array(value[:] if len(value.shape) > 0 else value))
+            os.replace(tmp_path, this_path)
+
+        if keys is None:
+            keys = root['data'].keys()
+        for key in keys:
+            value = root['data'][key]
+            this_chunk_length = chunk_length
+            if isinstance(value, zarr.Array):
+                # decompress one zarr chunk at a time, bounded memory
+                this_chunk_length = value.chunks[0]
+            this_path = os.path.join(data_dir, key + '.npy')
+            tmp_path = this_path + f'.{os.getpid()}.tmp'
+            # the .npy header is padded so the data is 64 byte aligned
+            arr = np.lib.format.open_memmap(tmp_path, mode='w+', 
+                dtype=value.dtype, shape=value.shape)
+            for start in range(0, value.shape[0], this_chunk_length):
+                end = min(start + this_chunk_length, value.shape[0])
+                arr[start:end] = value[start:end]
+            arr.flush()
+            del arr
+            # atomic, concurrent readers never see a partial file and
+            # concurrent conversions each write their own temporary file
+            os.replace(tmp_path, this_path)
+
+    def __getstate__(self):
+        if self._mmap_args is not None:
+            # re-map the files instead of pickling their content
+            return {'_mmap_args': self._mmap_args}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if 'root' not in state:
+            mmap_path, keys, mode = state['_mmap_args']
+            state = self.create_from_mmap_path(
+                mmap_path, keys=keys, mode=mode).__dict__
+        self.__dict__.update(state)
 
     # ============= save methods ===============
     def save_to_store(self, store, 
@@ -464,6 +787,9 @@ class ReplayBuffer:
             chunks: Optional[Dict[str,tuple]]=dict(),
             compressors: Union[str, numcodecs.abc.Codec, dict]=dict()):
         assert(len(data) > 0)
+        if self._stream is not None:
+            self._stream_episode(data)
+            return
         is_zarr = (self.backend == 'zarr')
 
         curr_len = self.n_steps
@@ -519,6 +845,114 @@ class ReplayBuffer:
                 rechunk_recompress_array(self.meta, 'episode_ends', 
                     chunk_length=int(episode_ends.shape[0] * 1.5))
     
+    # =========== streaming =============
+    def start_streaming(self, 
+            flush_every: Optional[int]=None,
+            chunks: Optional[Dict[str,tuple]]=dict(),
+            compressors: Union[str, numcodecs.abc.Codec, dict]=dict()):
+        """
+        Turn add_episode into a bounded-memory sink for an on-disk zarr.
+        Episodes are kept in memory and appended to the arrays once
+        flush_every steps are pending (default: one chunk of the first key),
+        so writes are mostly whole chunks. Episodes become visible, and 
+        survive a crash, only after a flush.
+        """
+        assert self.backend == 'zarr'
+        self._stream = {
+            'flush_every': flush_every,
+            'chunks': chunks,
+            'compressors': compressors,
+            'data': dict(),
+            'episode_lengths': list(),
+            'n_steps': 0
+        }
+
+    def stop_streaming(self):
+        self.flush()
+        self._stream = None
+
+    def _stream_episode(self, data: Dict[str, np.ndarray]):
+        stream = self._stream
+        episode_length = None
+        for key, value in data.items():
+            assert(len(value.shape) >= 1)
+            if episode_length is None:
+                episode_length = len(value)
+            else:
+                assert(episode_length == len(value))
+        if len(stream['episode_lengths']) > 0:
+            assert(data.keys() == stream['data'].keys())
+
+        for key, value in data.items():
+            # copy, callers usually reuse their episode buffers
+            stream['data'].setdefault(key, list()).append(np.array(value))
+        stream['episode_lengths'].append(episode_length)
+        stream['n_steps'] += episode_length
+
+        if stream['flush_every'] is None:
+            key, value = next(iter(data.items()))
+            stream['flush_every'] = self._resolve_stream_chunks(key, value)[0]
+        if stream['n_steps'] >= stream['flush_every']:
+            self.flush()
+
+    def _resolve_stream_chunks(self, key, value):
+        chunks = self._stream['chunks']
+        if key in self.data:
+            return self.data[key].chunks
+        if isinstance(chunks, tuple):
+            return chunks
+        if key in chunks:
+            return chunks[key]
+        # size for the whole stream, not for the first episode
+        return get_optimal_chunks(
+            shape=(np.iinfo(np.int64).max,) + value.shape[1:], 
+            dtype=value.dtype)
+
+    def flush(self):
+        """
+        Append all pending streamed episodes to the zarr arrays.
+        Data is written before episode_ends, so an interrupted
+        flush never exposes partial episodes.
+        """
+        stream = self._stream
+        if (stream is None) or (len(stream['episode_lengths']) == 0):
+            return
+        curr_len = self.n_steps
+        new_len = curr_len + stream['n_steps']
+
+        for key, values in stream['data'].items():
+            value = np.concatenate(values, axis=0)
+            new_shape = (new_len,) + value.shape[1:]
+            if key not in self.data:
+                cks = self._resolve_stream_chunks(key, value)
+                check_chunks_compatible(cks, new_shape)
+                cpr = self._resolve_array_compressor(
+                    compressors=stream['compressors'], key=key, array=value)
+                arr = self.data.zeros(name=key, 
+                    shape=(curr_len,) + value.shape[1:], 
+                    chunks=cks,
+                    dtype=value.dtype,
+                    compressor=cpr)
+            else:
+                arr = self.data[key]
+                assert(value.shape[1:] == arr.shape[1:])
+            assert(arr.shape[0] >= curr_len)
+            arr.resize(new_shape)
+            arr[curr_len:new_len] = value
+
+        episode_ends = self.episode_ends
+        n_episodes = episode_ends.shape[0]
+        new_ends = curr_len + np.cumsum(stream['episode_lengths'])
+        episode_ends.resize(n_episodes + len(new_ends))
+        episode_ends[n_episodes:] = new_ends
+        if episode_ends.chunks[0] < episode_ends.shape[0]:
+            rechunk_recompress_array(self.meta, 'episode_ends', 
+                chunk_length=int(episode_ends.shape[0] * 1.5))
+
+        stream['data'] = dict()
+        stream['episode_lengths'] = list()
+        stream['n_steps'] = 0
+
     def drop_episode(self):
         is_zarr = (self.backend == 'zarr')
         episode_ends = self.episode_ends[:].copy()
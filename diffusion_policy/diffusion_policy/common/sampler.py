@@ -1,52 +1,110 @@
-from typing import Optional
+from typing import Optional, Dict
+import os
+import copy
+import hashlib
 import numpy as np
-import numba
+import torch
 from diffusion_policy.common.replay_buffer import ReplayBuffer
 
 
-@numba.jit(nopython=True)
 def create_indices(
     episode_ends:np.ndarray, sequence_length:int, 
     episode_mask: np.ndarray,
     pad_before: int=0, pad_after: int=0,
     debug:bool=True) -> np.ndarray:
-    episode_mask.shape == episode_ends.shape        
+    """
+    (buffer_start_idx, buffer_end_idx, sample_start_idx, sample_end_idx)
+    for every window start idx in [-pad_before, episode_length - sequence_length + pad_after]
+    of every episode in episode_mask, in episode order.
+    int32 unless the buffer is too long for it.
+    """
+    assert episode_mask.shape == episode_ends.shape
     pad_before = min(max(pad_before, 0), sequence_length-1)
     pad_after = min(max(pad_after, 0), sequence_length-1)
 
-    indices = list()
-    for i in range(len(episode_ends)):
-        if not episode_mask[i]:
-            # skip episode
-            continue
-        start_idx = 0
-        if i > 0:
-            start_idx = episode_ends[i-1]
-        end_idx = episode_ends[i]
-        episode_length = end_idx - start_idx
-        
-        min_start = -pad_before
-        max_start = episode_length - sequence_length + pad_after
-        
-        # range stops one idx before end
-        for idx in range(min_start, max_start+1):
-            buffer_start_idx = max(idx, 0) + start_idx
-            buffer_end_idx = min(idx+sequence_length, episode_length) + start_idx
-            start_offset = buffer_start_idx - (idx+start_idx)
-            end_offset = (idx+sequence_length+start_idx) - buffer_end_idx
-            sample_start_idx = 0 + start_offset
-            sample_end_idx = sequence_length - end_offset
-            if debug:
-                assert(start_offset >= 0)
-                assert(end_offset >= 0)
-                assert (sample_end_idx - sample_start_idx) == (buffer_end_idx - buffer_start_idx)
-            indices.append([
-                buffer_start_idx, buffer_end_idx, 
-                sample_start_idx, sample_end_idx])
-    indices = np.array(indices)
+    episode_ends = np.asarray(episode_ends, dtype=np.int64)
+    episode_starts = np.concatenate([[0], episode_ends[:-1]])[episode_mask]
+    episode_lengths = episode_ends[episode_mask] - episode_starts
+    
+    min_start = -pad_before
+    max_start = episode_lengths - sequence_length + pad_after
+    n_windows = np.maximum(max_start - min_start + 1, 0)
+
+    # one row per window
+    episode_idxs = np.repeat(np.arange(len(n_windows)), n_windows)
+    first_row = np.cumsum(n_windows) - n_windows
+    idx = np.arange(n_windows.sum()) - first_row[episode_idxs] + min_start
+    start_idx = episode_starts[episode_idxs]
+    episode_length = episode_lengths[episode_idxs]
+
+    buffer_start_idx = np.maximum(idx, 0) + start_idx
+    buffer_end_idx = np.minimum(idx+sequence_length, episode_length) + start_idx
+    start_offset = buffer_start_idx - (idx+start_idx)
+    end_offset = (idx+sequence_length+start_idx) - buffer_end_idx
+    sample_start_idx = 0 + start_offset
+    sample_end_idx = sequence_length - end_offset
+    if debug:
+        assert np.all(start_offset >= 0)
+        assert np.all(end_offset >= 0)
+        assert np.all((sample_end_idx - sample_start_idx) == (buffer_end_idx - buffer_start_idx))
+    indices = np.stack([
+        buffer_start_idx, buffer_end_idx, 
+        sample_start_idx, sample_end_idx], axis=-1)
+    dtype = np.int32
+    if len(episode_ends) > 0 and episode_ends[-1] > np.iinfo(np.int32).max:
+        dtype = np.int64
+    return indices.astype(dtype)
+
+
+def get_cached_indices(cache_dir: str,
+    episode_ends:np.ndarray, sequence_length:int, 
+    episode_mask: np.ndarray,
+    pad_before: int=0, pad_after: int=0) -> np.ndarray:
+    """
+    create_indices, stored in cache_dir under a hash of all its inputs.
+    """
+    episode_ends = np.ascontiguousarray(episode_ends, dtype=np.int64)
+    episode_mask = np.ascontiguousarray(episode_mask, dtype=bool)
+    key = hashlib.sha1()
+    key.update(episode_ends.tobytes())
+    key.update(episode_mask.tobytes())
+    key.update(np.array([sequence_length, pad_before, pad_after], 
+        dtype=np.int64).tobytes())
+    cache_path = os.path.join(os.path.expanduser(cache_dir), key.hexdigest() + '.npy')
+    if os.path.isfile(cache_path):
+        return np.load(cache_path)
+
+    indices = create_indices(episode_ends, 
+        sequence_length=sequence_length, 
+        pad_before=pad_before, 
+        pad_after=pad_after,
+        episode_mask=episode_mask)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = cache_path + f'.{os.getpid()}.tmp.npy'
+        np.save(tmp_path, indices)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        # e.g. read-only dataset directory, caching is only an optimization
+        print(f"Could not cache sampler indices in {cache_dir}: {e}")
     return indices
 
 
+def create_window_idxs(indices: np.ndarray, sequence_length: int) -> np.ndarray:
+    """
+    Expand (buffer_start_idx, buffer_end_idx, sample_start_idx, sample_end_idx)
+    rows into per-step buffer indices. Steps before sample_start_idx repeat the
+    first valid step and steps after sample_end_idx repeat the last one.
+    """
+    indices = np.asarray(indices, dtype=np.int64).reshape(-1, 4)
+    buffer_start_idx, buffer_end_idx, sample_start_idx, _ = indices.T
+    offsets = np.arange(sequence_length, dtype=np.int64)[None,:] \
+        - sample_start_idx[:,None]
+    offsets = np.clip(offsets, 0, (buffer_end_idx - buffer_start_idx - 1)[:,None])
+    window_idxs = buffer_start_idx[:,None] + offsets
+    return window_idxs
+
+
 def get_val_mask(n_episodes, val_ratio, seed=0):
     val_mask = np.zeros(n_episodes, dtype=bool)
     if val_ratio <= 0:
@@ -83,10 +141,13 @@ class SequenceSampler:
         keys=None,
         key_first_k=dict(),
         episode_mask: Optional[np.ndarray]=None,
+        index_cache_dir: Optional[str]=None,
         ):
         """
         key_first_k: dict str: int
-            Only take first k data from these keys (to improve perf)
+            Only load and return the first k steps of the window for 
+            these keys, result[key] is (k, ...) (to improve perf)
+        index_cache_dir: reuse the index table across runs, see get_cached_indices
         """
 
         super().__init__()
@@ -98,15 +159,22 @@ class SequenceSampler:
         if episode_mask is None:
             episode_mask = np.ones(episode_ends.shape, dtype=bool)
 
-        if np.any(episode_mask):
-            indices = create_indices(episode_ends, 
+        if not np.any(episode_mask):
+            indices = np.zeros((0,4), dtype=np.int32)
+        elif index_cache_dir is not None:
+            indices = get_cached_indices(index_cache_dir, episode_ends, 
                 sequence_length=sequence_length, 
                 pad_before=pad_before, 
                 pad_after=pad_after,
                 episode_mask=episode_mask
                 )
         else:
-            indices = np.zeros((0,4), dtype=np.int64)
+            indices = create_indices(episode_ends, 
+                sequence_length=sequence_length, 
+                pad_before=pad_before, 
+                pad_after=pad_after,
+                episode_mask=episode_mask
+                )
 
         # (buffer_start_idx, buffer_end_idx, sample_start_idx, sample_end_idx)
         self.indices = indices 
@@ -114,9 +182,47 @@ class SequenceSampler:
         self.sequence_length = sequence_length
         self.replay_buffer = replay_buffer
         self.key_first_k = key_first_k
-    
+        self._window_idxs = None
+
     def __len__(self):
         return len(self.indices)
+
+    @property
+    def window_idxs(self):
+        """
+        (len(self), sequence_length) table of replay buffer indices.
+        Padding is expressed by clamping into the episode, so
+        window_idxs[i] gathers exactly the window of sample_sequence(i).
+        Computed lazily, only the batched path needs it.
+        """
+        if self._window_idxs is None:
+            self._window_idxs = create_window_idxs(
+                self.indices, self.sequence_length)
+        return self._window_idxs
+
+    def sample_batch(self, idxs):
+        """
+        Batched equivalent of sample_sequence.
+        idxs: (B,) indices into self.indices
+        result: dict str: (B, sequence_length, ...), (B, k, ...) for key_first_k
+        """
+        idxs = np.asarray(idxs, dtype=np.int64)
+        window_idxs = self.window_idxs[idxs]
+        result = dict()
+        for key in self.keys:
+            input_arr = self.replay_buffer[key]
+            this_idxs = window_idxs
+            if key in self.key_first_k:
+                this_idxs = window_idxs[:,:self.key_first_k[key]]
+            if isinstance(input_arr, np.ndarray):
+                data = input_arr[this_idxs]
+            else:
+                # zarr array, orthogonal selection on the flattened table
+                data = input_arr.get_orthogonal_selection(
+                    this_idxs.reshape(-1))
+                data = data.reshape(this_idxs.shape + input_arr.shape[1:])
+            result[key] = data
+        return result
         
     def sample_sequence(self, idx):
         buffer_start_idx, buffer_end_idx, sample_start_idx, sample_end_idx \
@@ -124,21 +230,18 @@ class SequenceSampler:
         result = dict()
         for key in self.keys:
             input_arr = self.replay_buffer[key]
-            # performance optimization, avoid small allocation if possible
-            if key not in self.key_first_k:
-                sample = input_arr[buffer_start_idx:buffer_end_idx]
-            else:
+            if key in self.key_first_k:
                 # performance optimization, only load used obs steps
-                n_data = buffer_end_idx - buffer_start_idx
-                k_data = min(self.key_first_k[key], n_data)
-                # fill value with Nan to catch bugs
-                # the non-loaded region should never be used
-                sample = np.full((n_data,) + input_arr.shape[1:], 
-                    fill_value=np.nan, dtype=input_arr.dtype)
-                try:
-                    sample[:k_data] = input_arr[buffer_start_idx:buffer_start_idx+k_data]
-                except Exception as e:
-                    import pdb; pdb.set_trace()
+                k = min(self.key_first_k[key], self.sequence_length)
+                offsets = np.clip(np.arange(k) - sample_start_idx, 
+                    0, buffer_end_idx - buffer_start_idx - 1)
+                sample = input_arr[buffer_start_idx:buffer_start_idx+offsets[-1]+1]
+                if (sample_start_idx > 0) or (len(sample) < k):
+                    sample = sample[offsets]
+                result[key] = sample
+                continue
+            # performance optimization, avoid small allocation if possible
+            sample = input_arr[buffer_start_idx:buffer_end_idx]
             data = sample
             if (sample_start_idx > 0) or (sample_end_idx < self.sequence_length):
                 data = np.zeros(
@@ -151,3 +254,160 @@ class SequenceSampler:
                 data[sample_start_idx:sample_end_idx] = sample
             result[key] = data
         return result
+
+
+class DeviceSequenceSampler:
+    def __init__(self,
+        sampler: SequenceSampler,
+        device: torch.device,
+        data: Optional[Dict[str, torch.Tensor]]=None,
+        ):
+        """
+        Device-resident counterpart of SequenceSampler.
+        Uploads the replay buffer arrays and the index table once,
+        windows are then gathered on device.
+        data: dict str: torch.Tensor
+            Already uploaded replay buffer arrays to share between
+            samplers (e.g. train and validation) over the same buffer.
+        """
+        device = torch.device(device)
+        if data is None:
+            data = dict()
+        for key in sampler.keys:
+            if key not in data:
+                data[key] = torch.from_numpy(
+                    np.asarray(sampler.replay_buffer[key][:])).to(device)
+
+        self.indices = torch.from_numpy(
+            sampler.indices.astype(np.int64)).reshape(-1,4).to(device)
+        self.steps = torch.arange(sampler.sequence_length, device=device)
+        self.data = data
+        self.keys = list(sampler.keys)
+        self.sequence_length = sampler.sequence_length
+        self.key_first_k = sampler.key_first_k
+        self.device = device
+
+    def __len__(self):
+        return len(self.indices)
+
+    def sample_batch(self, idxs: torch.Tensor) -> Dict[str, torch.Tensor]:
+        """
+        Same windows as SequenceSampler.sample_batch, computed on device.
+        idxs: (B,) indices into self.indices
+        """
+        rows = self.indices[idxs]
+        buffer_start_idx = rows[:,0:1]
+        buffer_end_idx = rows[:,1:2]
+        sample_start_idx = rows[:,2:3]
+        offsets = (self.steps[None,:] - sample_start_idx).clamp_(min=0)
+        offsets = torch.minimum(offsets, buffer_end_idx - buffer_start_idx - 1)
+        window_idxs = buffer_start_idx + offsets
+        result = dict()
+        for key in self.keys:
+            if key in self.key_first_k:
+                data = self.data[key][window_idxs[:,:self.key_first_k[key]]]
+            else:
+                data = self.data[key][window_idxs]
+            result[key] = data
+        return result
+
+
+def create_alias_table(weights: np.ndarray):
+    """
+    Vose's alias method. Drawing i uniformly and keeping it with 
+    probability prob[i] (else taking alias[i]) samples i with 
+    probability weights[i] / sum(weights), in O(1) per draw.
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    assert(np.all(weights >= 0) and (weights.sum() > 0))
+    n = len(weights)
+    prob = weights * n / weights.sum()
+    alias = np.arange(n, dtype=np.int64)
+    small = [i for i in range(n) if prob[i] < 1.0]
+    large = [i for i in range(n) if prob[i] >= 1.0]
+    while (len(small) > 0) and (len(large) > 0):
+        s = small.pop()
+        l = large.pop()
+        alias[s] = l
+        prob[l] = prob[l] + prob[s] - 1.0
+        if prob[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+    # leftovers are 1 up to rounding
+    for i in small + large:
+        prob[i] = 1.0
+    return prob, alias
+
+
+class WeightedWindowSampler(torch.utils.data.Sampler):
+    def __init__(self,
+        indices: np.ndarray,
+        episode_ends: np.ndarray,
+        episode_weights: np.ndarray,
+        num_samples: Optional[int]=None,
+        seed: Optional[int]=None,
+        ):
+        """
+        Draws window indices (rows of SequenceSampler.indices) so that
+        episode i is picked with probability proportional to 
+        episode_weights[i], then a window uniformly within it.
+        An epoch is num_samples draws (with replacement), 
+        default one per window.
+        """
+        # windows of an episode are contiguous rows of indices
+        episode_idxs = np.searchsorted(episode_ends, indices[:,0], side='right')
+        window_counts = np.bincount(episode_idxs, minlength=len(episode_ends))
+        window_starts = np.cumsum(window_counts) - window_counts
+        weights = np.where(window_counts > 0, episode_weights, 0)
+        self.prob, self.alias = create_alias_table(weights)
+        self.window_counts = window_counts
+        self.window_starts = window_starts
+        if num_samples is None:
+            num_samples = len(indices)
+        self.num_samples = int(num_samples)
+        self.seed = seed
+        self.rng = np.random.default_rng(seed=seed)
+        self._device_tables = dict()
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        return iter(self.sample(self.num_samples).tolist())
+
+    def shard(self, rank: int, world_size: int) -> 'WeightedWindowSampler':
+        """
+        Sampler for one of world_size distributed ranks: same tables,
+        num_samples / world_size draws per epoch from an independent stream.
+        """
+        sampler = copy.copy(self)
+        sampler.num_samples = (self.num_samples + world_size - 1) // world_size
+        seed = None if self.seed is None else [self.seed, rank]
+        sampler.rng = np.random.default_rng(seed=seed)
+        sampler._device_tables = dict()
+        return sampler
+
+    def sample(self, n: int) -> np.ndarray:
+        episode_idxs = self.rng.integers(0, len(self.prob), size=n)
+        keep = self.rng.random(size=n) < self.prob[episode_idxs]
+        episode_idxs = np.where(keep, episode_idxs, self.alias[episode_idxs])
+        return self.window_starts[episode_idxs] \
+            + self.rng.integers(0, self.window_counts[episode_idxs])
+
+    def sample_torch(self, n: int, device: torch.device) -> torch.Tensor:
+        """
+        sample on device, with the global torch RNG
+        """
+        device = torch.device(device)
+        if device not in self._device_tables:
+            self._device_tables[device] = tuple(
+                torch.from_numpy(x).to(device) for x in 
+                (self.prob, self.alias, self.window_starts, self.window_counts))
+        prob, alias, window_starts, window_counts = self._device_tables[device]
+        episode_idxs = torch.randint(len(prob), (n,), device=device)
+        keep = torch.rand(n, dtype=torch.float64, device=device) < prob[episode_idxs]
+        episode_idxs = torch.where(keep, episode_idxs, alias[episode_idxs])
+        offsets = torch.rand(n, dtype=torch.float64, device=device) \
+            * window_counts[episode_idxs]
+        return window_starts[episode_idxs] + offsets.long()
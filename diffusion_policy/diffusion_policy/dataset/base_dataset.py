@@ -1,7 +1,10 @@
-from typing import Dict
+from typing import Dict, Optional
 
 import torch
 import torch.nn
+import torch.distributed as dist
+from torch.utils.data import (DataLoader, BatchSampler, 
+    RandomSampler, SequentialSampler, DistributedSampler)
 from diffusion_policy.model.common.normalizer import LinearNormalizer
 
 class BaseLowdimDataset(torch.utils.data.Dataset):
@@ -14,6 +17,10 @@ class BaseLowdimDataset(torch.utils.data.Dataset):
 
     def get_all_actions(self) -> torch.Tensor:
         raise NotImplementedError()
+
+    def get_sampler(self) -> Optional[torch.utils.data.Sampler]:
+        # None: shuffle uniformly over __len__
+        return None
     
     def __len__(self) -> int:
         return 0
@@ -37,6 +44,10 @@ class BaseImageDataset(torch.utils.data.Dataset):
 
     def get_all_actions(self) -> torch.Tensor:
         raise NotImplementedError()
+
+    def get_sampler(self) -> Optional[torch.utils.data.Sampler]:
+        # None: shuffle uniformly over __len__
+        return None
     
     def __len__(self) -> int:
         return 0
@@ -49,3 +60,139 @@ class BaseImageDataset(torch.utils.data.Dataset):
             action: T, Da
         """
         raise NotImplementedError()
+
+
+def create_dataloader(dataset: torch.utils.data.Dataset,
+        batch_size: int=1,
+        shuffle: bool=False,
+        drop_last: bool=False,
+        batch_sampler: bool=False,
+        distributed: bool=False,
+        **kwargs) -> DataLoader:
+    """
+    batch_sampler: index the dataset with a whole batch of indices at once
+        (dataset[list_of_idx]) instead of collating batch_size single items.
+        The dataset has to support batched __getitem__.
+    kwargs: passed to DataLoader
+    
+    Device-resident datasets bypass DataLoader entirely, see DeviceDataLoader.
+    When shuffling, dataset.get_sampler() (e.g. a WeightedWindowSampler)
+    replaces uniform shuffling and defines the epoch length.
+    distributed: each rank of the initialized process group iterates 
+        its own shard, the same number of batches on every rank.
+        Call set_dataloader_epoch every epoch.
+    """
+    sampler = None
+    if shuffle and hasattr(dataset, 'get_sampler'):
+        sampler = dataset.get_sampler()
+
+    rank, world_size = 0, 1
+    if distributed:
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+        if sampler is not None:
+            sampler = sampler.shard(rank, world_size)
+
+    if getattr(dataset, 'device_resident', False):
+        return DeviceDataLoader(dataset, batch_size=batch_size,
+            shuffle=shuffle, drop_last=drop_last, sampler=sampler,
+            rank=rank, world_size=world_size)
+
+    if distributed and (sampler is None):
+        sampler = DistributedSampler(dataset, 
+            num_replicas=world_size, rank=rank, shuffle=shuffle)
+
+    if not batch_sampler:
+        if sampler is not None:
+            return DataLoader(dataset, batch_size=batch_size, 
+                sampler=sampler, drop_last=drop_last, **kwargs)
+        return DataLoader(dataset, batch_size=batch_size, 
+            shuffle=shuffle, drop_last=drop_last, **kwargs)
+    
+    if sampler is None:
+        if shuffle:
+            sampler = RandomSampler(dataset)
+        else:
+            sampler = SequentialSampler(dataset)
+    sampler = BatchSampler(sampler, batch_size=batch_size, drop_last=drop_last)
+    # batch_size=None disables automatic batching,
+    # each list of indices from the sampler is passed to __getitem__
+    return DataLoader(dataset, sampler=sampler, batch_size=None, **kwargs)
+
+
+def set_dataloader_epoch(dataloader, epoch: int):
+    """
+    Reshuffle distributed shards, no-op for other dataloaders.
+    """
+    if hasattr(dataloader, 'set_epoch'):
+        dataloader.set_epoch(epoch)
+        return
+    sampler = getattr(dataloader, 'sampler', None)
+    if isinstance(sampler, BatchSampler):
+        sampler = sampler.sampler
+    if isinstance(sampler, DistributedSampler):
+        sampler.set_epoch(epoch)
+
+
+class DeviceDataLoader:
+    """
+    DataLoader replacement for datasets whose arrays already live on the 
+    training device. Indices are drawn on dataset.device and each batch
+    is gathered with dataset[idxs], without worker processes, 
+    pinned memory or host-to-device copies.
+    sampler: needs sample_torch(n, device), see WeightedWindowSampler
+    rank, world_size: iterate one distributed shard, padded like 
+        DistributedSampler so all ranks see the same number of batches.
+    """
+    def __init__(self, dataset: torch.utils.data.Dataset, 
+            batch_size: int=1, 
+            shuffle: bool=False, 
+            drop_last: bool=False,
+            sampler=None,
+            rank: int=0,
+            world_size: int=1,
+            seed: int=0):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.sampler = sampler
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+    
+    def __len__(self) -> int:
+        n = len(self.dataset)
+        if self.sampler is not None:
+            n = len(self.sampler)
+        elif self.world_size > 1:
+            n = (n + self.world_size - 1) // self.world_size
+        if self.drop_last:
+            return n // self.batch_size
+        return (n + self.batch_size - 1) // self.batch_size
+    
+    def __iter__(self):
+        n = len(self.dataset)
+        device = self.dataset.device
+        if self.sampler is not None:
+            order = self.sampler.sample_torch(len(self.sampler), device=device)
+        elif self.world_size > 1:
+            # same permutation on every rank, each takes its own slice
+            if self.shuffle:
+                generator = torch.Generator().manual_seed(self.seed + self.epoch)
+                order = torch.randperm(n, generator=generator)
+            else:
+                order = torch.arange(n)
+            total = ((n + self.world_size - 1) // self.world_size) * self.world_size
+            order = order.repeat((total + n - 1) // max(n, 1))[:total]
+            order = order[self.rank::self.world_size].to(device)
+        elif self.shuffle:
+            order = torch.randperm(n, device=device)
+        else:
+            order = torch.arange(n, device=device)
+        for i in range(len(self)):
+            idxs = order[i*self.batch_size:(i+1)*self.batch_size]
+            yield self.dataset[idxs]
@@ -1,11 +1,17 @@
 from typing import Dict
+import os
+import shutil
+import fcntl
+import contextlib
+import zarr
 import torch
 import numpy as np
 import copy
 from diffusion_policy.common.pytorch_util import dict_apply
-from diffusion_policy.common.replay_buffer import ReplayBuffer
+from diffusion_policy.common.replay_buffer import ReplayBuffer, get_zarr_hash
 from diffusion_policy.common.sampler import (
-    SequenceSampler, get_val_mask, downsample_mask)
+    SequenceSampler, DeviceSequenceSampler, WeightedWindowSampler,
+    get_val_mask, downsample_mask)
 from diffusion_policy.model.common.normalizer import LinearNormalizer
 from diffusion_policy.dataset.base_dataset import BaseLowdimDataset
 
@@ -20,12 +26,69 @@ class CyberDogDataset(BaseLowdimDataset):
             action_key='action',
             seed=42,
             val_ratio=0.0,
-            max_train_episodes=None
+            max_train_episodes=None,
+            device_resident=False,
+            device='cuda:0',
+            pre_normalize=False,
+            cache_dtype='float32',
+            buffer_backend=None,
+            num_load_threads=1,
+            sample_weighting=None,
+            skill_weights=None,
+            num_samples_per_epoch=None,
+            cache_indices=False,
+            n_obs_steps=None
             ):
+        """
+        device_resident: upload the replay buffer to device once and
+            gather batches there, see DeviceDataLoader.
+        pre_normalize: train on normalized copies of obs and action cached
+            next to zarr_path, together with the fitted normalizer.
+            Samples then carry 'nobs' and 'naction' instead of 'obs' and 'action'.
+            The cache is rebuilt whenever the content hash of zarr_path changes,
+            by one process at a time (lock file next to it) and swapped in
+            once complete.
+        cache_dtype: storage dtype of the normalized cache, float32 or float16
+        buffer_backend: passed to ReplayBuffer.copy_from_path, 'mmap' maps an
+            uncompressed copy of the dataset instead of loading it into memory.
+        num_load_threads: threads decompressing zarr chunks while loading
+        sample_weighting: None samples windows uniformly. 'episode' gives
+            every training episode the same weight, 'skill' splits 
+            skill_weights (default uniform) over the episodes of each skill,
+            read from meta/skill_ids (see ReplayBuffer.merge).
+        num_samples_per_epoch: windows drawn per epoch with sample_weighting,
+            default len(self)
+        cache_indices: keep the sampler index tables next to zarr_path
+            (see get_index_cache_dir) and reuse them across runs
+        n_obs_steps: only load and return the first n_obs_steps of obs,
+            for policies that only condition on those (obs_as_cond).
+            None returns obs over the whole horizon, as needed by
+            policies inpainting obs.
+        """
         super().__init__()
+        self.obs_key = obs_key
+        self.state_key = state_key
+        self.action_key = action_key
+        self.pre_normalize = pre_normalize
+        self.buffer_backend = buffer_backend
+        self.num_load_threads = num_load_threads
+        self.index_cache_dir = None
+        if cache_indices:
+            self.index_cache_dir = self.get_index_cache_dir(zarr_path)
+
+        self.normalizer = None
+        if pre_normalize:
+            self.replay_buffer, self.normalizer = self._load_normalized_cache(
+                zarr_path, dtype=cache_dtype)
+        else:
+            self.replay_buffer = ReplayBuffer.copy_from_path(
+                zarr_path, keys=[state_key, action_key],
+                backend=buffer_backend, num_threads=num_load_threads)
 
-        self.replay_buffer = ReplayBuffer.copy_from_path(
-            zarr_path, keys=[state_key, action_key])
+        self.key_first_k = dict()
+        if n_obs_steps is not None:
+            obs_source_key = 'nobs' if pre_normalize else state_key
+            self.key_first_k = {obs_source_key: n_obs_steps}
 
         val_mask = get_val_mask(
             n_episodes=self.replay_buffer.n_episodes, 
@@ -42,15 +105,29 @@ class CyberDogDataset(BaseLowdimDataset):
             sequence_length=horizon,
             pad_before=pad_before, 
             pad_after=pad_after,
-            episode_mask=train_mask
+            key_first_k=self.key_first_k,
+            episode_mask=train_mask,
+            index_cache_dir=self.index_cache_dir
             )
-        self.obs_key = obs_key
-        self.state_key = state_key
-        self.action_key = action_key
         self.train_mask = train_mask
         self.horizon = horizon
         self.pad_before = pad_before
         self.pad_after = pad_after
+        self.device_resident = device_resident
+        self.device = torch.device(device)
+        self.device_sampler = None
+        if device_resident:
+            self.device_sampler = DeviceSequenceSampler(
+                self.sampler, device=self.device)
+        self.window_sampler = None
+        if sample_weighting is not None:
+            self.window_sampler = WeightedWindowSampler(
+                indices=self.sampler.indices,
+                episode_ends=self.replay_buffer.episode_ends[:],
+                episode_weights=self._get_episode_weights(
+                    zarr_path, sample_weighting, skill_weights),
+                num_samples=num_samples_per_epoch,
+                seed=seed)
 
     def get_validation_dataset(self):
         val_set = copy.copy(self)
@@ -59,26 +136,148 @@ class CyberDogDataset(BaseLowdimDataset):
             sequence_length=self.horizon,
             pad_before=self.pad_before, 
             pad_after=self.pad_after,
-            episode_mask=~self.train_mask
+            key_first_k=self.key_first_k,
+            episode_mask=~self.train_mask,
+            index_cache_dir=self.index_cache_dir
             )
         val_set.train_mask = ~self.train_mask
+        val_set.window_sampler = None
+        if self.device_resident:
+            # share the uploaded replay buffer
+            val_set.device_sampler = DeviceSequenceSampler(
+                val_set.sampler, device=self.device, 
+                data=self.device_sampler.data)
         return val_set
 
     def get_normalizer(self, mode='limits', **kwargs):
+        if self.pre_normalize:
+            # fitted once when the cache was built
+            assert mode == 'limits' and len(kwargs) == 0
+            return self.normalizer
         data = self._sample_to_data(self.replay_buffer)
         normalizer = LinearNormalizer()
         normalizer.fit(data=data, last_n_dims=1, mode=mode, **kwargs)
         return normalizer
 
     def get_all_actions(self) -> torch.Tensor:
+        if self.pre_normalize:
+            return self.normalizer['action'].unnormalize(
+                self.replay_buffer['naction'])
         return torch.from_numpy(self.replay_buffer[self.action_key])
 
+    def get_sampler(self):
+        return self.window_sampler
+
     def __len__(self) -> int:
         return len(self.sampler)
 
+    def _get_episode_weights(self, zarr_path, sample_weighting, skill_weights=None):
+        n_episodes = self.replay_buffer.n_episodes
+        if sample_weighting == 'episode':
+            return np.ones(n_episodes)
+        elif sample_weighting == 'skill':
+            # meta of the source, the normalized cache only keeps episode_ends
+            skill_ids = zarr.open(os.path.expanduser(zarr_path), 'r')['meta']['skill_ids'][:]
+            assert len(skill_ids) == n_episodes
+            n_skills = skill_ids.max() + 1
+            if skill_weights is None:
+                skill_weights = np.ones(n_skills)
+            skill_weights = np.array(list(skill_weights), dtype=np.float64)
+            assert len(skill_weights) == n_skills
+            n_train_episodes = np.bincount(skill_ids[self.train_mask], minlength=n_skills)
+            return skill_weights[skill_ids] / np.maximum(n_train_episodes[skill_ids], 1)
+        raise ValueError(f"Unsupported sample_weighting {sample_weighting}")
+
+    @staticmethod
+    def get_normalized_cache_path(zarr_path):
+        zarr_path = os.path.expanduser(zarr_path).rstrip('/')
+        return os.path.splitext(zarr_path)[0] + '.normalized.zarr'
+
+    @staticmethod
+    def get_index_cache_dir(zarr_path):
+        zarr_path = os.path.expanduser(zarr_path).rstrip('/')
+        return os.path.splitext(zarr_path)[0] + '.indices'
+
+    def _load_normalized_cache(self, zarr_path, dtype='float32'):
+        dtype = np.dtype(dtype)
+        assert dtype in (np.float16, np.float32)
+        cache_path = self.get_normalized_cache_path(zarr_path)
+        source_hash = get_zarr_hash(zarr_path, 
+            keys=[self.state_key, self.action_key])
+
+        # one process builds or reads the cache at a time, concurrent
+        # jobs on the same dataset wait for the build instead of reading
+        # a partial cache
+        with _file_lock(cache_path + '.lock'):
+            is_valid = False
+            if os.path.exists(cache_path):
+                attrs = zarr.open(cache_path, 'r').attrs
+                is_valid = (attrs.get('source_hash') == source_hash) \
+                    and (attrs.get('dtype') == dtype.name)
+            
+            if not is_valid:
+                print("building normalized cache", cache_path)
+                # built next to the cache and swapped in once complete
+                tmp_path = cache_path + f'.{os.getpid()}.tmp'
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                src_buffer = ReplayBuffer.copy_from_path(
+                    zarr_path, keys=[self.state_key, self.action_key],
+                    num_threads=self.num_load_threads)
+                data = self._buffer_to_data(src_buffer)
+                normalizer = LinearNormalizer()
+                normalizer.fit(data=data, last_n_dims=1, mode='limits')
+                ndata = normalizer.normalize(data)
+                cache_buffer = ReplayBuffer(root={
+                    'meta': {
+                        'episode_ends': src_buffer.episode_ends[:]
+                    },
+                    'data': {
+                        'nobs': ndata['obs'].numpy().astype(dtype),
+                        'naction': ndata['action'].numpy().astype(dtype)
+                    }
+                })
+                cache_buffer.save_to_path(tmp_path)
+                root = zarr.open(tmp_path, 'r+')
+                normalizer_group = root.create_group('normalizer', overwrite=True)
+                for key, value in normalizer.state_dict().items():
+                    normalizer_group.array(name=key, data=value.numpy())
+                # an interrupted build is never considered valid
+                root.attrs.update({
+                    'source_hash': source_hash,
+                    'dtype': dtype.name
+                })
+                # a directory can't replace a non-empty one, move the
+                # old cache aside first. Its mmap copy is converted
+                # again by copy_from_path as the content changed.
+                old_path = cache_path + f'.{os.getpid()}.old'
+                if os.path.exists(cache_path):
+                    os.replace(cache_path, old_path)
+                os.replace(tmp_path, cache_path)
+                shutil.rmtree(old_path, ignore_errors=True)
+            
+            replay_buffer = ReplayBuffer.copy_from_path(
+                cache_path, keys=['nobs', 'naction'],
+                backend=self.buffer_backend, num_threads=self.num_load_threads)
+            normalizer = LinearNormalizer()
+            normalizer_group = zarr.open(cache_path, 'r')['normalizer']
+            normalizer.load_state_dict({
+                key: torch.from_numpy(value[:]) 
+                for key, value in normalizer_group.arrays()
+            })
+        return replay_buffer, normalizer
+
     def _sample_to_data(self, sample):
+        if self.pre_normalize:
+            # cached arrays are already normalized
+            return {
+                'nobs': sample['nobs'],
+                'naction': sample['naction']
+            }
+        return self._buffer_to_data(sample)
+
+    def _buffer_to_data(self, sample):
         state = sample[self.state_key]
-        agent_pos = state[:,:253]               # TODO: This might cause a bug need to check dimension
+        agent_pos = state[...,:253]             # TODO: This might cause a bug need to check dimension
         # obs = np.concatenate([
         #    latents[:100000],
         #    agent_pos[:100000]], axis=-1)
@@ -90,9 +289,36 @@ class CyberDogDataset(BaseLowdimDataset):
         }
         return data
 
-    def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
-        sample = self.sampler.sample_sequence(idx)
+    def __getitem__(self, idx) -> Dict[str, torch.Tensor]:
+        if self.device_resident and isinstance(idx, torch.Tensor):
+            # batch of indices on device, no host round trip
+            sample = self.device_sampler.sample_batch(idx)
+            return self._sample_to_data(sample)
+        if isinstance(idx, (list, tuple, np.ndarray, torch.Tensor)):
+            # whole batch of indices from a batch sampler
+            sample = self.sampler.sample_batch(idx)
+        else:
+            sample = self.sampler.sample_sequence(idx)
         data = self._sample_to_data(sample)
 
         torch_data = dict_apply(data, torch.from_numpy)
         return torch_data
+
+
+@contextlib.contextmanager
+def _file_lock(path):
+    """
+    Exclusive advisory lock on path, released when the block exits.
+    Unlocked where the file can't be created, e.g. read-only datasets.
+    """
+    try:
+        f = open(path, 'a')
+    except OSError:
+        yield
+        return
+    with f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,168 @@
+from typing import Dict, List, Optional
+import os
+import time
+import queue
+import shutil
+import traceback
+import hydra
+import torch
+import torch.multiprocessing as mp
+from omegaconf import OmegaConf
+
+
+def _rollout_worker(runner_cfg, policy_cfg, output_dir, device,
+        request_queue, result_queue):
+    """
+    Evaluator process, owns the simulator and its own copy of the policy.
+    """
+    try:
+        env_runner = hydra.utils.instantiate(runner_cfg, output_dir=output_dir)
+        policy = hydra.utils.instantiate(policy_cfg)
+        policy.to(device)
+        policy.eval()
+    except Exception:
+        result_queue.put((None, None, traceback.format_exc()))
+        return
+
+    while True:
+        request = request_queue.get()
+        if request is None:
+            break
+        global_step, epoch, state_dict = request
+        try:
+            policy.load_state_dict(state_dict)
+            del state_dict
+            start_time = time.perf_counter()
+            with torch.no_grad():
+                result = env_runner.run(policy)
+            log = dict()
+            if isinstance(result, dict):
+                log.update(result)
+            elif isinstance(result, str) and os.path.exists(result):
+                # recorded rollout, only the run itself is the evaluation
+                shutil.rmtree(result)
+            log['rollout_duration_sec'] = time.perf_counter() - start_time
+        except Exception:
+            result_queue.put((global_step, epoch, traceback.format_exc()))
+            continue
+        result_queue.put((global_step, epoch, log))
+
+
+class AsyncRunner:
+    """
+    Runs env_runner.run in a separate process on a snapshot of the
+    policy weights, so training continues during the rollout.
+    At most one snapshot waits behind the running evaluation,
+    submitting a newer one replaces it, the trainer never blocks.
+    """
+    def __init__(self,
+            runner_cfg,
+            policy_cfg,
+            output_dir: str,
+            device='cpu',
+            start_method: str='spawn'):
+        """
+        runner_cfg: task.env_runner config, instantiated in the evaluator
+        policy_cfg: policy config, instantiated in the evaluator
+        device: evaluator policy device
+        """
+        if OmegaConf.is_config(runner_cfg):
+            runner_cfg = OmegaConf.to_container(runner_cfg, resolve=True)
+        if OmegaConf.is_config(policy_cfg):
+            policy_cfg = OmegaConf.to_container(policy_cfg, resolve=True)
+
+        ctx = mp.get_context(start_method)
+        self.request_queue = ctx.Queue(maxsize=1)
+        self.result_queue = ctx.Queue()
+        self.process = ctx.Process(
+            target=_rollout_worker,
+            args=(runner_cfg, policy_cfg, output_dir, str(device),
+                self.request_queue, self.result_queue),
+            daemon=True)
+        self.process.start()
+        self.n_pending = 0
+
+    def submit(self, policy: torch.nn.Module, global_step: int, epoch: int) -> bool:
+        """
+        Snapshot the policy weights and queue them for evaluation.
+        return: False if an older queued snapshot was replaced
+        """
+        self._check_alive()
+        state_dict = {key: value.detach().to('cpu', copy=True)
+            for key, value in policy.state_dict().items()}
+        request = (global_step, epoch, state_dict)
+        replaced = False
+        try:
+            self.request_queue.put_nowait(request)
+        except queue.Full:
+            try:
+                self.request_queue.get_nowait()
+                replaced = True
+                self.n_pending -= 1
+            except queue.Empty:
+                # picked up by the evaluator in the meantime
+                pass
+            self.request_queue.put(request)
+        self.n_pending += 1
+        return not replaced
+
+    def poll(self, block: bool=False, timeout: Optional[float]=None) -> List[Dict]:
+        """
+        Finished evaluations, without waiting by default.
+        block, timeout: wait for the first result, as in queue.Queue.get
+        return: logs with the global_step and epoch they belong to
+        """
+        logs = list()
+        while self.n_pending > 0:
+            try:
+                global_step, epoch, log = self.result_queue.get(
+                    block=block, timeout=timeout)
+            except queue.Empty:
+                if block:
+                    self._check_alive()
+                break
+            block = False
+            if isinstance(log, str):
+                raise RuntimeError(f"Rollout at global_step {global_step} failed:\n{log}")
+            self.n_pending -= 1
+            log['global_step'] = global_step
+            log['epoch'] = epoch
+            logs.append(log)
+        return logs
+
+    def close(self, timeout: Optional[float]=None) -> List[Dict]:
+        """
+        Wait for queued evaluations and stop the evaluator.
+        timeout: seconds to wait in total, None for no limit
+        return: logs of the evaluations finished meanwhile
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        logs = list()
+        while (self.n_pending > 0) and self.process.is_alive():
+            if (deadline is not None) and (time.monotonic() > deadline):
+                break
+            logs.extend(self.poll(block=True, timeout=1.0))
+        if self.process.is_alive():
+            try:
+                self.request_queue.put_nowait(None)
+            except queue.Full:
+                # timed out with a snapshot still queued
+                pass
+            self.process.join(timeout=5.0)
+        if self.process.is_alive():
+            self.process.terminate()
+        return logs
+
+    def _check_alive(self):
+        if self.process.is_alive():
+            return
+        # startup errors are reported through the result queue
+        try:
+            _, _, log = self.result_queue.get_nowait()
+            if isinstance(log, str):
+                raise RuntimeError(f"Rollout evaluator failed:\n{log}")
+        except queue.Empty:
+            pass
+        raise RuntimeError(f"Rollout evaluator exited with code {self.process.exitcode}")
@@ -4,6 +4,7 @@ import tqdm
 
 from diffusion_policy.policy.base_policy import BaseLowdimPolicy
 from diffusion_policy.env_runner.base_runner import BaseLowdimRunner
+from diffusion_policy.common.replay_buffer import ReplayBuffer
 
 import zarr, time
 
@@ -35,7 +36,15 @@ class LeggedRunner(BaseLowdimRunner):
             tqdm_interval_sec=5.0,
             n_envs=None,
             device=None,
+            warm_start_step=None,
+            evaluate=False,
         ):
+        """
+        warm_start_step: start each prediction from the previous plan,
+            re-noised to this inference step, None to sample from noise
+        evaluate: run until every env finished one episode and return
+            survival, heading tracking error and prediction latency
+        """
         super().__init__(output_dir)
 
         self.task = task
@@ -61,6 +70,8 @@ class LeggedRunner(BaseLowdimRunner):
         self.past_action = past_action
         self.max_steps = max_steps
         self.tqdm_interval_sec = tqdm_interval_sec
+        self.warm_start_step = warm_start_step
+        self.evaluate = evaluate
     
     def run(self, policy: BaseLowdimPolicy, online=False, generate_data=False):
         device = policy.device
@@ -97,40 +108,37 @@ class LeggedRunner(BaseLowdimRunner):
         
         if save_zarr:
             if generate_data:
-                zroot = zarr.open_group("recorded_data_{}_{}.zarr".format(self.task, time.strftime("%H-%M-%S", time.localtime())), "w")
+                file_name = "recorded_data_{}_{}.zarr".format(self.task, time.strftime("%H-%M-%S", time.localtime()))
             else:
                 file_name = "recorded_data{}_eval.zarr".format(time.strftime("%H-%M-%S", time.localtime()))
-                zroot = zarr.open_group(file_name, "w")
             
-            zroot.create_group("data")
-            zdata = zroot["data"]
-            
-            zroot.create_group("meta")
-            zmeta = zroot["meta"]
-            
-            zmeta.create_group("episode_ends")
-            
-            zdata.create_group("action")
-            zdata.create_group("state")
-            
-            recorded_obs = []
-            recorded_acs = []
+            # episodes are appended as they finish and flushed to disk
+            # every chunk, memory stays constant over the whole run
+            replay_buffer = ReplayBuffer.create_from_path(file_name, mode="w")
+            replay_buffer.start_streaming()
             
             recorded_obs_episode = np.zeros((env.num_envs, env.max_episode_length+2, 45))
             recorded_acs_episode = np.zeros((env.num_envs, env.max_episode_length+3, env.num_actions))
             
             
-        episode_ends = []
         action_error = []
         idx = 0    
         saved_idx = 0    
         
         
-        evaluate = False
+        evaluate = self.evaluate
 
         if evaluate:
-            record_done = torch.zeros(100)
-            record_episode_length = torch.zeros(100)
+            record_done = torch.zeros(env.num_envs)
+            record_episode_length = torch.zeros(env.num_envs)
+            # heading error of the first episode, see _reward_evaluate_metrics
+            tracking_error_sum = torch.zeros(env.num_envs, device=env.device)
+            tracking_steps = torch.zeros(env.num_envs, device=env.device)
+            predict_times = []
+
+        # previous plan and the envs it is still valid for
+        prev_action_pred = None
+        warm_start_mask = torch.zeros(env.num_envs, dtype=torch.bool, device=device)
 
         action = torch.zeros((env.num_envs, 1, env.num_actions), dtype=torch.float32, device=device)
         while True:
@@ -148,11 +156,25 @@ class LeggedRunner(BaseLowdimRunner):
                     # USE DELAYED INPUTS s_t-h-1:s_t-1
                     obs_dict = {"obs": state_history[:, -policy.n_obs_steps-1:-1, :]}
                     t1 = time.perf_counter()
-                    action_dict = policy.predict_action(obs_dict)
+                    if (self.warm_start_step is not None) and (prev_action_pred is not None):
+                        # the observations moved by the actions executed since
+                        warm_start = policy.shift_action_pred(prev_action_pred, action.shape[1])
+                        action_dict = policy.predict_action(obs_dict,
+                            warm_start=warm_start,
+                            warm_start_step=self.warm_start_step,
+                            warm_start_mask=warm_start_mask)
+                    else:
+                        action_dict = policy.predict_action(obs_dict)
+                    if evaluate and (device.type == 'cuda'):
+                        torch.cuda.synchronize(device)
                     t2 = time.perf_counter()
                     print("time spent diffusion step: ", t2-t1)
                     
                     pred_action = action_dict["action_pred"]
+                    prev_action_pred = pred_action
+                    warm_start_mask[:] = True
+                    if evaluate:
+                        predict_times.append(t2 - t1)
 
                     # USE THE NEXT PREDICTED ACTION
                     # RHC Framework -- only use the first action
@@ -173,6 +195,10 @@ class LeggedRunner(BaseLowdimRunner):
                 action_step = action[:, i, :]
                 temp_length_buf[:] = env.episode_length_buf.clone()
                 obs, _, rews, done, infos = env.step(action_step)
+                if evaluate and hasattr(env, 'metrics'):
+                    first_episode = (record_done < 1).to(env.device)
+                    tracking_error_sum += env.metrics["tracking_ang_vel"] * first_episode
+                    tracking_steps += (env.metrics["time"] > 0) * first_episode
             
                 state_history = torch.roll(state_history, shifts=-1, dims=1)
                 action_history = torch.roll(action_history, shifts=-1, dims=1)
@@ -187,6 +213,7 @@ class LeggedRunner(BaseLowdimRunner):
             if len(env_ids) > 0:
                 state_history[env_ids,:,:] = single_obs_dict["obs"][env_ids].to(state_history.device)[:,None,:]
                 action_history[env_ids,:,:] = 0.0
+                warm_start_mask[env_ids.long().to(device)] = False
 
                 idx = 0
                 
@@ -197,10 +224,11 @@ class LeggedRunner(BaseLowdimRunner):
                         if epi_len == 0:
                             epi_len = recorded_acs_episode.shape[1]
                         if epi_len > 400:
-                            recorded_obs.append(np.copy(recorded_obs_episode[env_ids[i], :epi_len]))
-                            recorded_acs.append(np.copy(recorded_acs_episode[env_ids[i], :epi_len]))
+                            replay_buffer.add_episode({
+                                "state": recorded_obs_episode[env_ids[i], :epi_len],
+                                "action": recorded_acs_episode[env_ids[i], :epi_len]
+                            })
                             saved_idx += epi_len
-                            episode_ends.append(saved_idx)
                             
                             print("saved_idx: ", saved_idx)
                         recorded_obs_episode[env_ids[i]] = 0
@@ -228,18 +256,25 @@ class LeggedRunner(BaseLowdimRunner):
                 pbar.update(env.num_envs)
             
             if save_zarr and saved_idx >= len_to_save:
-                recorded_obs = np.concatenate(recorded_obs)
-                recorded_acs = np.concatenate(recorded_acs)
-                episode_ends = np.array(episode_ends)
-                
-                zdata["state"] = recorded_obs
-                zdata["action"] = recorded_acs
-                zmeta["episode_ends"] = episode_ends
-                print(zroot.tree())
+                replay_buffer.stop_streaming()
+                print(replay_buffer.root.tree())
                 if generate_data:
                     raise StopIteration
                 break
 
         # clear out video buffer
         _ = env.reset()
+
+        if evaluate:
+            log_data = {
+                'mean_episode_length': torch.mean(record_episode_length).item(),
+                'survival_rate': torch.mean((record_episode_length >= 1000).float()).item()
+            }
+            if len(predict_times) > 0:
+                predict_ms = np.array(predict_times) * 1000
+                log_data['predict_ms_p50'] = float(np.percentile(predict_ms, 50))
+                log_data['predict_ms_p99'] = float(np.percentile(predict_ms, 99))
+            if tracking_steps.sum() > 0:
+                log_data['tracking_error'] = (tracking_error_sum.sum() / tracking_steps.sum()).item()
+            return log_data
         
@@ -3,7 +3,8 @@ import torch.nn as nn
 class ModuleAttrMixin(nn.Module):
     def __init__(self):
         super().__init__()
-        self._dummy_variable = nn.Parameter()
+        # never receives a gradient, DistributedDataParallel would wait on it
+        self._dummy_variable = nn.Parameter(requires_grad=False)
 
     @property
     def device(self):
@@ -0,0 +1,220 @@
+from typing import List, Optional, Tuple
+import torch
+import torch.nn.functional as F
+from einops import reduce
+from diffusers.schedulers.scheduling_ddim import DDIMScheduler
+
+
+DISTILLATION_METHODS = ('progressive', 'consistency')
+
+
+def get_ddim_transitions(scheduler: DDIMScheduler,
+        num_inference_steps: int) -> List[Tuple[int, int]]:
+    """
+    (t, prev_t) of each step of DDIMScheduler.step sampling with
+    num_inference_steps, prev_t = -1 for the clean sample.
+    """
+    scheduler.set_timesteps(num_inference_steps)
+    step_size = scheduler.config.num_train_timesteps // scheduler.num_inference_steps
+    return [(int(t), max(int(t) - step_size, -1)) for t in scheduler.timesteps]
+
+
+def get_alpha_prod(alphas_cumprod: torch.Tensor, timesteps: torch.Tensor) -> torch.Tensor:
+    """
+    alphas_cumprod at timesteps (B,) as (B,1,1), 1 for the clean sample (t < 0)
+    """
+    alpha_prod = alphas_cumprod.to(timesteps.device)[timesteps.clamp(min=0)]
+    alpha_prod = torch.where(timesteps >= 0, alpha_prod, torch.ones_like(alpha_prod))
+    return alpha_prod[:,None,None]
+
+
+def predict_original_sample(model_output: torch.Tensor, sample: torch.Tensor,
+        alpha_prod: torch.Tensor, prediction_type: str
+        ) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    x_0 and epsilon predicted by the model output at x_t, as
+    DDIMScheduler.step before clipping.
+    """
+    beta_prod = 1 - alpha_prod
+    if prediction_type == 'epsilon':
+        pred_original_sample = (sample - beta_prod ** 0.5 * model_output) / alpha_prod ** 0.5
+        pred_epsilon = model_output
+    elif prediction_type == 'sample':
+        pred_original_sample = model_output
+        pred_epsilon = (sample - alpha_prod ** 0.5 * pred_original_sample) / beta_prod ** 0.5
+    elif prediction_type == 'v_prediction':
+        pred_original_sample = alpha_prod ** 0.5 * sample - beta_prod ** 0.5 * model_output
+        pred_epsilon = alpha_prod ** 0.5 * model_output + beta_prod ** 0.5 * sample
+    else:
+        raise ValueError(f"Unsupported prediction type {prediction_type}")
+    return pred_original_sample, pred_epsilon
+
+
+class PolicyDistillation:
+    """
+    Losses training a student DiffusionTransformerLowdimPolicy to sample
+    in a few DDIM steps from a teacher policy with the same noise schedule.
+    The student predicts x_0 (prediction_type sample), at the last
+    training timestep alphas_cumprod is close to 0 and an epsilon
+    prediction can't be turned into x_0 in one step.
+    Both are sampled with their inference_scheduler, set to DDIM.
+
+    progressive: one DDIM step of the student matches two DDIM steps of
+        the teacher, at least one when the teacher has no timestep in
+        between. The teacher is the student of the previous stage.
+        (Salimans & Ho, Progressive Distillation for Fast Sampling of
+        Diffusion Models)
+    consistency: the student's x_0 at x_t matches its own x_0, without
+        gradient, at the teacher's DDIM step x_t -> x_t-1 and the
+        teacher's x_0 at t = 0. The teacher samples with all training
+        timesteps. (Song et al., Consistency Models)
+    """
+    def __init__(self, student, teacher, method: str='progressive'):
+        if method not in DISTILLATION_METHODS:
+            raise ValueError(f"Unsupported distillation method {method}, "
+                f"expected one of {DISTILLATION_METHODS}")
+        assert student.noise_scheduler.config.num_train_timesteps \
+            == teacher.noise_scheduler.config.num_train_timesteps
+        self.student = student
+        self.teacher = teacher
+        self.method = method
+
+        self.alphas_cumprod = student.noise_scheduler.alphas_cumprod
+        config = student.inference_scheduler.config
+        self.clip_sample_range = None
+        if config.clip_sample:
+            self.clip_sample_range = config.clip_sample_range
+
+        # (t, teacher midpoint, prev_t) of the steps trained
+        teacher_transitions = get_ddim_transitions(
+            teacher.inference_scheduler, teacher.num_inference_steps)
+        if method == 'progressive':
+            teacher_timesteps = [t for t, _ in teacher_transitions]
+            transitions = list()
+            for t, prev_t in get_ddim_transitions(
+                    student.inference_scheduler, student.num_inference_steps):
+                candidates = [s for s in teacher_timesteps if prev_t < s < t]
+                mid_t = prev_t
+                if len(candidates) > 0:
+                    mid_t = min(candidates, key=lambda s: abs(2 * s - t - prev_t))
+                transitions.append((t, mid_t, prev_t))
+        else:
+            transitions = [(t, prev_t, prev_t) for t, prev_t in teacher_transitions]
+        self.transitions = torch.tensor(transitions, dtype=torch.long)
+
+    def _clip(self, x: torch.Tensor) -> torch.Tensor:
+        if self.clip_sample_range is None:
+            return x
+        return x.clamp(-self.clip_sample_range, self.clip_sample_range)
+
+    def _predict_original_sample(self, policy, sample, t, cond) -> Tuple[torch.Tensor, torch.Tensor]:
+        model_output = policy.model(sample, t, cond)
+        return predict_original_sample(model_output, sample,
+            get_alpha_prod(self.alphas_cumprod, t),
+            policy.noise_scheduler.config.prediction_type)
+
+    def _teacher_step(self, sample, t, prev_t, cond) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Deterministic DDIM step x_t -> x_prev_t of the teacher.
+        return: x_prev_t, clipped x_0
+        """
+        pred_original_sample, pred_epsilon = self._predict_original_sample(
+            self.teacher, sample, t, cond)
+        pred_original_sample = self._clip(pred_original_sample)
+        alpha_prod_prev = get_alpha_prod(self.alphas_cumprod, prev_t)
+        prev_sample = alpha_prod_prev ** 0.5 * pred_original_sample \
+            + (1 - alpha_prod_prev) ** 0.5 * pred_epsilon
+        return prev_sample, pred_original_sample
+
+    def _get_trajectory(self, batch) -> Tuple[torch.Tensor, Optional[torch.Tensor], torch.Tensor]:
+        """
+        Normalized trajectory, obs conditioning and inpainting mask,
+        as policy.compute_loss.
+        """
+        policy = self.student
+        if 'nobs' in batch:
+            # pre-normalized by the dataset
+            obs = batch['nobs'].to(dtype=policy.dtype)
+            action = batch['naction'].to(dtype=policy.dtype)
+        else:
+            nbatch = policy.normalizer.normalize(batch)
+            obs = nbatch['obs']
+            action = nbatch['action']
+
+        cond = None
+        trajectory = action
+        if policy.obs_as_cond:
+            cond = obs[:,:policy.n_obs_steps,:]
+            if policy.pred_action_steps_only:
+                start = policy.n_obs_steps - 1
+                end = start + policy.n_action_steps
+                trajectory = action[:,start:end]
+        else:
+            trajectory = torch.cat([action, obs], dim=-1)
+
+        if policy.pred_action_steps_only:
+            condition_mask = torch.zeros_like(trajectory, dtype=torch.bool)
+        else:
+            condition_mask = policy.mask_generator(trajectory.shape)
+        return trajectory, cond, condition_mask
+
+    @torch.no_grad()
+    def _get_target(self, trajectory, noisy_trajectory, t, mid_t, prev_t,
+            cond, condition_mask) -> torch.Tensor:
+        """
+        x_0 target of the student at noisy_trajectory (x_t)
+        """
+        prev_sample, pred_original_sample = self._teacher_step(
+            noisy_trajectory, t, mid_t, cond)
+        if self.method == 'progressive':
+            # second teacher step where the teacher has a midpoint
+            prev_sample = torch.where(condition_mask, trajectory, prev_sample)
+            second_sample, _ = self._teacher_step(
+                prev_sample, mid_t.clamp(min=0), prev_t, cond)
+            prev_sample = torch.where((mid_t > prev_t)[:,None,None],
+                second_sample, prev_sample)
+            # x_0 for which the student's DDIM step lands on prev_sample
+            alpha_prod = get_alpha_prod(self.alphas_cumprod, t)
+            alpha_prod_prev = get_alpha_prod(self.alphas_cumprod, prev_t)
+            ratio = ((1 - alpha_prod_prev) / (1 - alpha_prod)) ** 0.5
+            target = (prev_sample - ratio * noisy_trajectory) \
+                / (alpha_prod_prev ** 0.5 - ratio * alpha_prod ** 0.5)
+            return self._clip(target)
+
+        # consistency with the student's own x_0 one teacher step later,
+        # in eval mode like the teacher
+        prev_sample = torch.where(condition_mask, trajectory, prev_sample)
+        training = self.student.training
+        self.student.eval()
+        student_original_sample, _ = self._predict_original_sample(
+            self.student, prev_sample, prev_t.clamp(min=0), cond)
+        self.student.train(training)
+        return torch.where((prev_t >= 0)[:,None,None],
+            self._clip(student_original_sample), pred_original_sample)
+
+    def compute_loss(self, batch) -> torch.Tensor:
+        """
+        Distillation loss on a dataset batch, at a random training
+        step of the student per sample.
+        """
+        trajectory, cond, condition_mask = self._get_trajectory(batch)
+        B = trajectory.shape[0]
+        device = trajectory.device
+        self.transitions = self.transitions.to(device)
+        index = torch.randint(0, len(self.transitions), (B,), device=device)
+        t, mid_t, prev_t = self.transitions[index].unbind(dim=-1)
+
+        noise = torch.randn(trajectory.shape, device=device)
+        noisy_trajectory = self.student.noise_scheduler.add_noise(
+            trajectory, noise, t)
+        noisy_trajectory = torch.where(condition_mask, trajectory, noisy_trajectory)
+
+        target = self._get_target(trajectory, noisy_trajectory,
+            t, mid_t, prev_t, cond, condition_mask)
+        # gradient also where the clipped x_0 of sampling saturates
+        pred, _ = self._predict_original_sample(self.student, noisy_trajectory, t, cond)
+
+        loss = F.mse_loss(pred.float(), target.float(), reduction='none')
+        loss = loss * (~condition_mask).type(loss.dtype)
+        loss = reduce(loss, 'b ... -> b (...)', 'mean')
+        return loss.mean()
@@ -14,7 +14,8 @@ class EMAModel:
         inv_gamma=1.0,
         power=2 / 3,
         min_value=0.0,
-        max_value=0.9999
+        max_value=0.9999,
+        update_every=1
     ):
         """
         @crowsonkb's notes on EMA Warmup:
@@ -26,6 +27,7 @@ class EMAModel:
             inv_gamma (float): Inverse multiplicative factor of EMA warmup. Default: 1.
             power (float): Exponential factor of EMA warmup. Default: 2/3.
             min_value (float): The minimum EMA decay rate. Default: 0.
+            update_every (int): Update the average every this many optimization steps. Default: 1.
         """
 
         self.averaged_model = model
@@ -37,9 +39,12 @@ class EMAModel:
         self.power = power
         self.min_value = min_value
         self.max_value = max_value
+        self.update_every = update_every
 
         self.decay = 0.0
         self.optimization_step = 0
+        self._pending_decay = 1.0
+        self._param_lists = None
 
     def get_decay(self, optimization_step):
         """
@@ -53,36 +58,62 @@ class EMAModel:
 
         return max(self.min_value, min(value, self.max_value))
 
-    @torch.no_grad()
-    def step(self, new_model):
-        self.decay = self.get_decay(self.optimization_step)
-
-        # old_all_dataptrs = set()
-        # for param in new_model.parameters():
-        #     data_ptr = param.data_ptr()
-        #     if data_ptr != 0:
-        #         old_all_dataptrs.add(data_ptr)
+    def _get_param_lists(self, new_model):
+        """
+        Parameters paired by module, immediate parameters only.
+        Cached per model, Module.to and load_state_dict keep
+        the Parameter objects.
+        """
+        if (self._param_lists is not None) and (self._param_lists[0] is new_model):
+            return self._param_lists[1:]
 
-        all_dataptrs = set()
-        for module, ema_module in zip(new_model.modules(), self.averaged_model.modules()):            
+        ema_params = list()
+        model_params = list()
+        ema_copy_params = list()
+        model_copy_params = list()
+        for module, ema_module in zip(new_model.modules(), self.averaged_model.modules()):
             for param, ema_param in zip(module.parameters(recurse=False), ema_module.parameters(recurse=False)):
                 # iterative over immediate parameters only.
                 if isinstance(param, dict):
                     raise RuntimeError('Dict parameter not supported')
-                
-                # data_ptr = param.data_ptr()
-                # if data_ptr != 0:
-                #     all_dataptrs.add(data_ptr)
 
                 if isinstance(module, _BatchNorm):
                     # skip batchnorms
-                    ema_param.copy_(param.to(dtype=ema_param.dtype).data)
+                    ema_copy_params.append(ema_param)
+                    model_copy_params.append(param)
                 elif not param.requires_grad:
-                    ema_param.copy_(param.to(dtype=ema_param.dtype).data)
+                    ema_copy_params.append(ema_param)
+                    model_copy_params.append(param)
                 else:
-                    ema_param.mul_(self.decay)
-                    ema_param.add_(param.data.to(dtype=ema_param.dtype), alpha=1 - self.decay)
+                    ema_params.append(ema_param)
+                    model_params.append(param)
+        self._param_lists = (new_model, ema_params, model_params,
+            ema_copy_params, model_copy_params)
+        return self._param_lists[1:]
 
-        # verify that iterating over module and then parameters is identical to parameters recursively.
-        # assert old_all_dataptrs == all_dataptrs
+    @torch.no_grad()
+    def step(self, new_model):
+        """
+        To be called after every optimization step. The average is
+        updated every update_every steps with the product of the decays
+        of the steps since the last update.
+        """
+        self._pending_decay *= self.get_decay(self.optimization_step)
         self.optimization_step += 1
+        if (self.optimization_step % self.update_every) != 0:
+            return
+        self.decay = self._pending_decay
+        self._pending_decay = 1.0
+
+        ema_params, model_params, ema_copy_params, model_copy_params \
+            = self._get_param_lists(new_model)
+
+        # one multi-tensor kernel per op instead of a loop over parameters
+        if len(ema_params) > 0:
+            model_params = [param.data if param.dtype == ema_param.dtype
+                else param.data.to(dtype=ema_param.dtype)
+                for param, ema_param in zip(model_params, ema_params)]
+            torch._foreach_mul_(ema_params, self.decay)
+            torch._foreach_add_(ema_params, model_params, alpha=1 - self.decay)
+        for param, ema_param in zip(model_copy_params, ema_copy_params):
+            ema_param.copy_(param.to(dtype=ema_param.dtype).data)
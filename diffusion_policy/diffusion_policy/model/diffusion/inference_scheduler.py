@@ -0,0 +1,102 @@
+from typing import Optional
+import torch
+from diffusers.schedulers.scheduling_ddpm import DDPMScheduler
+from diffusers.schedulers.scheduling_ddim import DDIMScheduler
+from diffusers.schedulers.scheduling_dpmsolver_multistep import DPMSolverMultistepScheduler
+
+
+SAMPLERS = ('ddpm', 'ddim', 'dpmsolver++')
+
+
+def create_inference_scheduler(noise_scheduler: DDPMScheduler, sampler: str='ddpm'):
+    """
+    Scheduler for sampling with a model trained with noise_scheduler,
+    sharing its betas, prediction type and clipping.
+    sampler:
+        ddpm: noise_scheduler itself
+        ddim: deterministic DDIM (eta=0)
+        dpmsolver++: second order multistep DPM-Solver++
+    The few-step samplers use trailing timesteps, so that the first
+    step always starts from the last training timestep (pure noise).
+    """
+    if sampler == 'ddpm':
+        return noise_scheduler
+    elif sampler == 'ddim':
+        return DDIMScheduler.from_config(noise_scheduler.config,
+            timestep_spacing='trailing',
+            set_alpha_to_one=True,
+            steps_offset=0)
+    elif sampler == 'dpmsolver++':
+        config = noise_scheduler.config
+        # DPM-Solver++ has no clip_sample. Dynamic thresholding divides
+        # the predicted sample by a per-sample quantile s clamped to
+        # [1, sample_max_value] after clamping it to [-s, s], which is
+        # clip_sample only for clip_sample_range 1 (the default). With a
+        # larger range it also rescales samples exceeding 1.
+        return DPMSolverMultistepScheduler.from_config(config,
+            algorithm_type='dpmsolver++',
+            solver_order=2,
+            timestep_spacing='trailing',
+            thresholding=config.clip_sample,
+            sample_max_value=config.get('clip_sample_range', 1.0))
+    raise ValueError(f"Unsupported sampler {sampler}, expected one of {SAMPLERS}")
+
+
+def get_ddpm_step_coefficients(scheduler: DDPMScheduler) -> Optional[torch.Tensor]:
+    """
+    Coefficients of DDPMScheduler.step for each of its current timesteps,
+    derived from alphas_cumprod exactly as step does.
+    return: (N,5) sqrt_beta_prod, sqrt_alpha_prod, pred_original_sample_coeff,
+        current_sample_coeff, noise std per step, None if the scheduler
+        config is not covered by ddpm_step
+    """
+    config = scheduler.config
+    if (config.prediction_type != 'epsilon') \
+            or (config.variance_type not in ('fixed_small', 'fixed_large')) \
+            or config.thresholding:
+        return None
+
+    timesteps = scheduler.timesteps
+    coefficients = list()
+    for i, t in enumerate(timesteps):
+        prev_t = timesteps[i + 1] if i + 1 < len(timesteps) else -1
+        alpha_prod_t = scheduler.alphas_cumprod[t]
+        alpha_prod_t_prev = scheduler.alphas_cumprod[prev_t] if prev_t >= 0 else scheduler.one
+        beta_prod_t = 1 - alpha_prod_t
+        beta_prod_t_prev = 1 - alpha_prod_t_prev
+        current_alpha_t = alpha_prod_t / alpha_prod_t_prev
+        current_beta_t = 1 - current_alpha_t
+
+        if config.variance_type == 'fixed_small':
+            variance = (1 - alpha_prod_t_prev) / (1 - alpha_prod_t) * current_beta_t
+            variance = torch.clamp(variance, min=1e-20)
+        else:
+            variance = current_beta_t
+
+        coefficients.append(torch.stack([
+            beta_prod_t ** (0.5),
+            alpha_prod_t ** (0.5),
+            (alpha_prod_t_prev ** (0.5) * current_beta_t) / beta_prod_t,
+            current_alpha_t ** (0.5) * beta_prod_t_prev / beta_prod_t,
+            variance ** 0.5
+        ]))
+    return torch.stack(coefficients)
+
+
+def ddpm_step(sample: torch.Tensor,
+        model_output: torch.Tensor,
+        coefficients: torch.Tensor,
+        noise: Optional[torch.Tensor]=None,
+        clip_sample_range: Optional[float]=None) -> torch.Tensor:
+    """
+    x_t -> x_t-1 of DDPMScheduler.step for epsilon prediction
+    coefficients: (5,) row of get_ddpm_step_coefficients
+    noise: standard normal, None for the last step (t == 0)
+    """
+    pred_original_sample = (sample - coefficients[0] * model_output) / coefficients[1]
+    if clip_sample_range is not None:
+        pred_original_sample = pred_original_sample.clamp(-clip_sample_range, clip_sample_range)
+    prev_sample = coefficients[2] * pred_original_sample + coefficients[3] * sample
+    if noise is not None:
+        prev_sample = prev_sample + coefficients[4] * noise
+    return prev_sample
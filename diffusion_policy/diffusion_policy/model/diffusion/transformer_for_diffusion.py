@@ -313,14 +313,69 @@ class TransformerForDiffusion(ModuleAttrMixin):
         )
         return optimizer
 
+    def _embed_obs(self, cond: torch.Tensor):
+        """
+        cond: (B,T',cond_dim)
+        output: (B,T_cond-1,n_emb) observation tokens of the encoder input
+        """
+        if self.separate_goal_conditioning and not self.is_cassie:
+            cond_obs_emb = self.cond_obs_emb(torch.cat([cond[...,:6], cond[...,9:]], dim=-1))
+            cond_obs_emb_2 = self.cond_obs_emb_2(cond[...,6:9])
+            # (B,To,n_emb)
+            return torch.cat([cond_obs_emb, cond_obs_emb_2], dim=1)
+        elif self.separate_goal_conditioning and self.is_cassie:
+            if self.is_ref:
+                cond_obs_emb = self.cond_obs_emb(cond[...,:29])
+                cond_obs_emb_3 = self.cond_obs_emb_3(cond[...,29:59])
+                cond_obs_emb_2 = self.cond_obs_emb_2(cond[...,59:])
+                # (B,To,n_emb)
+                return torch.cat([cond_obs_emb, cond_obs_emb_2, cond_obs_emb_3], dim=1)
+            else:
+                cond_obs_emb = self.cond_obs_emb(cond[...,:-5])
+                cond_obs_emb_2 = self.cond_obs_emb_2(cond[...,-5:])
+                # (B,To,n_emb)
+                return torch.cat([cond_obs_emb, cond_obs_emb_2], dim=1)
+        # (B,To,n_emb)
+        return self.cond_obs_emb(cond)
+
+    def embed_obs(self, cond: torch.Tensor):
+        """
+        Encoder input of the observation tokens, which is the same for
+        every denoising step. Computed once per sample and passed to
+        forward as obs_emb, the encoder still runs on the time and
+        observation tokens together, so that outputs are unchanged.
+        cond: (B,T',cond_dim)
+        output: (B,T_cond-1,n_emb)
+        """
+        assert self.obs_as_cond
+        x = self._embed_obs(cond)
+        tc = x.shape[1] + 1
+        position_embeddings = self.cond_pos_emb[
+            :, 1:tc, :
+        ]  # each position maps to a (learnable) vector
+        return self.drop(x + position_embeddings)
+
+    def _encode(self, time_emb: torch.Tensor, obs_emb: Optional[torch.Tensor]=None):
+        """
+        time_emb: (B,1,n_emb)
+        obs_emb: (B,T_cond-1,n_emb) from embed_obs
+        output: (B,T_cond,n_emb) decoder memory
+        """
+        x = self.drop(time_emb + self.cond_pos_emb[:, :1, :])
+        if obs_emb is not None:
+            x = torch.cat([x, obs_emb], dim=1)
+        return self.encoder(x)
+
     def forward(self, 
         sample: torch.Tensor, 
         timestep: Union[torch.Tensor, float, int], 
-        cond: Optional[torch.Tensor]=None, **kwargs):
+        cond: Optional[torch.Tensor]=None,
+        obs_emb: Optional[torch.Tensor]=None, **kwargs):
         """
         x: (B,T,input_dim)
         timestep: (B,) or int, diffusion step
         cond: (B,T',cond_dim)
+        obs_emb: embed_obs(cond), replaces cond when given
         output: (B,T,input_dim)
         """
         # 1. time
@@ -356,36 +411,9 @@ class TransformerForDiffusion(ModuleAttrMixin):
             # (B,T,n_emb)
         else:
             # encoder
-            cond_embeddings = time_emb
-            if self.obs_as_cond:
-                if self.separate_goal_conditioning and not self.is_cassie:
-                    cond_obs_emb = self.cond_obs_emb(torch.cat([cond[...,:6], cond[...,9:]], dim=-1))
-                    cond_obs_emb_2 = self.cond_obs_emb_2(cond[...,6:9])
-                    # (B,To,n_emb)
-                    cond_embeddings = torch.cat([cond_embeddings, cond_obs_emb, cond_obs_emb_2], dim=1)
-                elif self.separate_goal_conditioning and self.is_cassie:
-                    if self.is_ref:
-                        cond_obs_emb = self.cond_obs_emb(cond[...,:29])
-                        cond_obs_emb_3 = self.cond_obs_emb_3(cond[...,29:59])
-                        cond_obs_emb_2 = self.cond_obs_emb_2(cond[...,59:])
-                        # (B,To,n_emb)
-                        cond_embeddings = torch.cat([cond_embeddings, cond_obs_emb, cond_obs_emb_2, cond_obs_emb_3], dim=1)
-                    else:
-                        cond_obs_emb = self.cond_obs_emb(cond[...,:-5])
-                        cond_obs_emb_2 = self.cond_obs_emb_2(cond[...,-5:])
-                        # (B,To,n_emb)
-                        cond_embeddings = torch.cat([cond_embeddings, cond_obs_emb, cond_obs_emb_2], dim=1)
-                else:
-                    cond_obs_emb = self.cond_obs_emb(cond)
-                    # (B,To,n_emb)
-                    cond_embeddings = torch.cat([cond_embeddings, cond_obs_emb], dim=1)
-            tc = cond_embeddings.shape[1]
-            position_embeddings = self.cond_pos_emb[
-                :, :tc, :
-            ]  # each position maps to a (learnable) vector
-            x = self.drop(cond_embeddings + position_embeddings)
-            x = self.encoder(x)
-            memory = x
+            if obs_emb is None and self.obs_as_cond:
+                obs_emb = self.embed_obs(cond)
+            memory = self._encode(time_emb, obs_emb)
             # (B,T_cond,n_emb)
             
             # decoder
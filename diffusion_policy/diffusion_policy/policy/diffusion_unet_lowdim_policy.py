@@ -185,9 +185,14 @@ class DiffusionUnetLowdimPolicy(BaseLowdimPolicy):
     def compute_loss(self, batch):
         # normalize input
         assert 'valid_mask' not in batch
-        nbatch = self.normalizer.normalize(batch)
-        obs = nbatch['obs']
-        action = nbatch['action']
+        if 'nobs' in batch:
+            # pre-normalized by the dataset
+            obs = batch['nobs'].to(dtype=self.dtype)
+            action = batch['naction'].to(dtype=self.dtype)
+        else:
+            nbatch = self.normalizer.normalize(batch)
+            obs = nbatch['obs']
+            action = nbatch['action']
 
         # handle different ways of passing observation
         local_cond = None
@@ -208,6 +213,9 @@ class DiffusionUnetLowdimPolicy(BaseLowdimPolicy):
                 end = start + self.n_action_steps
                 trajectory = action[:,start:end]
         else:
+            # inpainting needs obs over the whole horizon,
+            # not only the n_obs_steps window of the dataset
+            assert obs.shape[1] == action.shape[1]
             trajectory = torch.cat([action, obs], dim=-1)
 
         # generate impainting mask
@@ -248,7 +256,8 @@ class DiffusionUnetLowdimPolicy(BaseLowdimPolicy):
         else:
             raise ValueError(f"Unsupported prediction type {pred_type}")
 
-        loss = F.mse_loss(pred, target, reduction='none')
+        # fp32 loss under autocast
+        loss = F.mse_loss(pred.float(), target.float(), reduction='none')
         loss = loss * loss_mask.type(loss.dtype)
         loss = reduce(loss, 'b ... -> b (...)', 'mean')
         loss = loss.mean()
@@ -6,8 +6,11 @@ import copy
 from hydra.core.hydra_config import HydraConfig
 from omegaconf import OmegaConf
 import dill
+import pickle
 import torch
-import threading
+from diffusion_policy.common.checkpoint_util import (
+    CheckpointWriter, save_payload,
+    create_policy_artifact, get_policy_artifact_path)
 
 
 class BaseWorkspace:
@@ -17,7 +20,7 @@ class BaseWorkspace:
     def __init__(self, cfg: OmegaConf, output_dir: Optional[str]=None):
         self.cfg = cfg
         self._output_dir = output_dir
-        self._saving_thread = None
+        self._checkpoint_writer = None
 
     @property
     def output_dir(self):
@@ -32,6 +35,18 @@ class BaseWorkspace:
         """
         pass
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # thread and queue of the writer can't be pickled
+        state['_checkpoint_writer'] = None
+        return state
+
+    @property
+    def checkpoint_writer(self) -> CheckpointWriter:
+        if self._checkpoint_writer is None:
+            self._checkpoint_writer = CheckpointWriter()
+        return self._checkpoint_writer
+
     def save_checkpoint(self, path=None, tag='latest', 
             exclude_keys=None,
             include_keys=None,
@@ -62,14 +77,48 @@ class BaseWorkspace:
                         payload['state_dicts'][key] = value.state_dict()
             elif key in include_keys:
                 payload['pickles'][key] = dill.dumps(value)
+
+        # model-only artifact next to the checkpoint, for load_policy
+        artifact = None
+        policy_key = 'model'
+        if OmegaConf.select(self.cfg, 'training.use_ema', default=False):
+            policy_key = 'ema_model'
+        if ('policy' in self.cfg) and (policy_key in payload['state_dicts']):
+            artifact = create_policy_artifact(self.cfg,
+                payload['state_dicts'][policy_key])
+        artifact_path = get_policy_artifact_path(path)
+
         if use_thread:
-            self._saving_thread = threading.Thread(
-                target=lambda : torch.save(payload, path.open('wb'), pickle_module=dill))
-            self._saving_thread.start()
+            # device to host copies are asynchronous, the writer
+            # waits for them instead of the training loop
+            ready_event = None
+            if torch.cuda.is_available() and torch.cuda.is_initialized():
+                ready_event = torch.cuda.Event()
+                ready_event.record()
+            self.checkpoint_writer.save(payload, path, ready_event=ready_event)
+            if artifact is not None:
+                self.checkpoint_writer.save(artifact, artifact_path,
+                    ready_event=ready_event, pickle_module=pickle)
         else:
-            torch.save(payload, path.open('wb'), pickle_module=dill)
+            save_payload(payload, str(path))
+            if artifact is not None:
+                save_payload(artifact, str(artifact_path), pickle_module=pickle)
         return str(path.absolute())
     
+    def remove_checkpoint(self, path):
+        """
+        Remove a checkpoint and its policy artifact after the pending saves.
+        """
+        for remove_path in [str(path), str(get_policy_artifact_path(path))]:
+            if self._checkpoint_writer is not None:
+                self._checkpoint_writer.remove(remove_path)
+            elif os.path.exists(remove_path):
+                os.remove(remove_path)
+
+    def wait_for_checkpoints(self):
+        if self._checkpoint_writer is not None:
+            self._checkpoint_writer.wait()
+
     def get_checkpoint_path(self, tag='latest'):
         return pathlib.Path(self.output_dir).joinpath('checkpoints', f'{tag}.ckpt')
 
@@ -139,7 +188,12 @@ class BaseWorkspace:
 
 def _copy_to_cpu(x):
     if isinstance(x, torch.Tensor):
-        return x.detach().to('cpu')
+        if x.is_cuda:
+            # pinned for a non-blocking copy
+            result = torch.empty_like(x, device='cpu', pin_memory=True)
+            return result.copy_(x.detach(), non_blocking=True)
+        # training keeps updating cpu tensors in place
+        return x.detach().clone()
     elif isinstance(x, dict):
         result = dict()
         for k, v in x.items():
@@ -0,0 +1,421 @@
+if __name__ == "__main__":
+    import sys
+    import os
+    import pathlib
+
+    ROOT_DIR = str(pathlib.Path(__file__).parent.parent.parent)
+    sys.path.append(ROOT_DIR)
+    os.chdir(ROOT_DIR)
+
+import os
+import hydra
+import torch
+from omegaconf import OmegaConf
+import pathlib
+import copy
+import json
+import random
+import wandb
+import tqdm
+import numpy as np
+import time
+
+from diffusion_policy.common.pytorch_util import (
+    dict_apply, optimizer_to, autocast, create_grad_scaler)
+from diffusion_policy.workspace.base_workspace import BaseWorkspace
+from diffusion_policy.policy.diffusion_transformer_lowdim_policy import DiffusionTransformerLowdimPolicy
+from diffusion_policy.dataset.base_dataset import (
+    BaseLowdimDataset, create_dataloader, set_dataloader_epoch)
+from diffusion_policy.common.checkpoint_util import (
+    load_policy_artifact, policy_from_artifact, load_policy)
+from diffusion_policy.common.json_logger import JsonLogger
+from diffusion_policy.common.policy_benchmark import compare_policies, format_comparison
+from diffusion_policy.model.diffusion.distillation import PolicyDistillation
+from diffusion_policy.model.common.lr_scheduler import get_scheduler
+from diffusers.training_utils import EMAModel
+
+OmegaConf.register_new_resolver("eval", eval, replace=True)
+
+# %%
+class DistillDiffusionTransformerLowdimWorkspace(BaseWorkspace):
+    """
+    Distills a trained DiffusionTransformerLowdimPolicy (the teacher)
+    into a student of the same architecture, initialized with its
+    weights, that samples in distillation.num_inference_steps DDIM steps.
+    progressive: one stage per entry of num_inference_steps, each
+        halving (roughly) the steps of the previous stage's student
+    consistency: one stage for the last entry of num_inference_steps
+    The student of each stage is exported as
+    checkpoints/student_{num_inference_steps}_steps.ckpt, loadable with
+    load_policy, followed by a latency and action error comparison with
+    the teacher on the validation set in distillation_report.json.
+    """
+    include_keys = ['global_step', 'epoch', 'stage', 'stage_epoch', 'stage_step']
+
+    def __init__(self, cfg: OmegaConf, output_dir=None):
+        super().__init__(cfg, output_dir=output_dir)
+
+        # set seed
+        seed = cfg.training.seed
+        torch.manual_seed(seed)
+        np.random.seed(seed)
+        random.seed(seed)
+
+        # frozen teacher
+        artifact = load_policy_artifact(cfg.distillation.teacher_checkpoint)
+        self.teacher: DiffusionTransformerLowdimPolicy
+        self.teacher = policy_from_artifact(artifact)
+        self.teacher.requires_grad_(False)
+
+        # student: teacher architecture and weights, x_0 prediction
+        # and DDIM sampling, exported with the policy artifact
+        policy_cfg = OmegaConf.create(artifact['policy_cfg'])
+        policy_cfg.sampler = 'ddim'
+        policy_cfg.num_inference_steps = self.get_stage_steps()[0]
+        policy_cfg.noise_scheduler.prediction_type = 'sample'
+        self.cfg.policy = policy_cfg
+
+        self.model: DiffusionTransformerLowdimPolicy
+        self.model = hydra.utils.instantiate(self.cfg.policy)
+        self.model.load_state_dict(artifact['state_dict'])
+
+        self.ema_model: DiffusionTransformerLowdimPolicy = None
+        if cfg.training.use_ema:
+            self.ema_model = copy.deepcopy(self.model)
+
+        # configure training state
+        self.optimizer = self.model.get_optimizer(**cfg.optimizer)
+
+        self.global_step = 0
+        self.epoch = 0
+        self.stage = 0
+        self.stage_epoch = 0
+        self.stage_step = 0
+
+    def get_stage_steps(self):
+        """
+        Student inference steps of each stage.
+        """
+        num_inference_steps = list(self.cfg.distillation.num_inference_steps)
+        if self.cfg.distillation.method == 'consistency':
+            return num_inference_steps[-1:]
+        return num_inference_steps
+
+    def _configure_stage(self):
+        """
+        Samplers of the current stage's student and its teacher,
+        the student of the previous stage or the trained policy on
+        all of its training timesteps.
+        """
+        stage_steps = self.get_stage_steps()
+        num_inference_steps = stage_steps[self.stage]
+        for policy in [self.model, self.ema_model]:
+            if policy is not None:
+                policy.set_sampler('ddim', num_inference_steps=num_inference_steps)
+        self.cfg.policy.num_inference_steps = num_inference_steps
+
+        if self.stage == 0:
+            teacher_steps = self.teacher.noise_scheduler.config.num_train_timesteps
+        else:
+            # previous student, x_0 prediction
+            self.teacher.noise_scheduler = copy.deepcopy(self.model.noise_scheduler)
+            teacher_steps = stage_steps[self.stage - 1]
+        self.teacher.set_sampler('ddim', num_inference_steps=teacher_steps)
+
+    def _next_stage(self):
+        """
+        The student of this stage, with EMA weights if used, becomes
+        the teacher and initial student of the next one.
+        """
+        policy = self.model
+        if self.ema_model is not None:
+            policy = self.ema_model
+        state_dict = policy.state_dict()
+        self.teacher.load_state_dict(state_dict)
+        self.model.load_state_dict(state_dict)
+
+        self.stage += 1
+        self.stage_epoch = 0
+        self.stage_step = 0
+        self._configure_stage()
+        self.optimizer = self.model.get_optimizer(**self.cfg.optimizer)
+
+    def run(self):
+        cfg = copy.deepcopy(self.cfg)
+
+        # resume training
+        if cfg.training.resume:
+            lastest_ckpt_path = self.get_checkpoint_path()
+            if lastest_ckpt_path.is_file():
+                print(f"Resuming from checkpoint {lastest_ckpt_path}")
+                self.load_checkpoint(path=lastest_ckpt_path)
+        self._configure_stage()
+
+        # configure dataset, normalized as the teacher was trained
+        dataset: BaseLowdimDataset
+        dataset = hydra.utils.instantiate(cfg.task.dataset)
+        assert isinstance(dataset, BaseLowdimDataset)
+        train_dataloader = create_dataloader(dataset, **cfg.dataloader)
+        val_dataset = dataset.get_validation_dataset()
+        val_dataloader = create_dataloader(val_dataset, **cfg.val_dataloader)
+
+        # configure logging
+        wandb_run = wandb.init(
+            dir=str(self.output_dir),
+            config=OmegaConf.to_container(cfg, resolve=True),
+            **OmegaConf.to_container(cfg.logging)
+        )
+        wandb.config.update(
+            {
+                "output_dir": self.output_dir,
+            }
+        )
+
+        # device transfer
+        device = torch.device(cfg.training.device)
+        self.model.to(device)
+        if self.ema_model is not None:
+            self.ema_model.to(device)
+        self.teacher.to(device)
+        self.teacher.eval()
+
+        precision = cfg.training.precision
+        grad_scaler = create_grad_scaler(device, precision)
+
+        if cfg.training.debug:
+            cfg.distillation.num_epochs = 2
+            cfg.training.max_train_steps = 3
+            cfg.training.max_val_steps = 3
+            cfg.training.checkpoint_every = 1
+            cfg.training.val_every = 1
+            cfg.training.sample_every = 1
+
+        # save batch for sampling
+        train_sampling_batch = None
+
+        stage_steps = self.get_stage_steps()
+        log_path = os.path.join(self.output_dir, 'logs.json.txt')
+        with JsonLogger(log_path) as json_logger:
+            while True:
+                num_inference_steps = stage_steps[self.stage]
+                distillation = PolicyDistillation(
+                    student=self.model,
+                    teacher=self.teacher,
+                    method=cfg.distillation.method)
+                # validation loss of the evaluated policy
+                val_distillation = distillation
+                if cfg.training.use_ema:
+                    val_distillation = PolicyDistillation(
+                        student=self.ema_model,
+                        teacher=self.teacher,
+                        method=cfg.distillation.method)
+                optimizer_to(self.optimizer, device)
+
+                # configure lr scheduler and ema for this stage
+                lr_scheduler = get_scheduler(
+                    cfg.training.lr_scheduler,
+                    optimizer=self.optimizer,
+                    num_warmup_steps=cfg.training.lr_warmup_steps,
+                    num_training_steps=(
+                        len(train_dataloader) * cfg.distillation.num_epochs) \
+                            // cfg.training.gradient_accumulate_every,
+                    last_epoch=self.stage_step-1
+                )
+                ema: EMAModel = None
+                if cfg.training.use_ema:
+                    ema = hydra.utils.instantiate(
+                        cfg.ema,
+                        model=self.ema_model)
+                    # continue the decay warm-up when resuming, one ema
+                    # step per training step of the stage
+                    ema.optimization_step = self.stage_step
+
+                while self.stage_epoch < cfg.distillation.num_epochs:
+                    set_dataloader_epoch(train_dataloader, self.epoch)
+                    step_log = dict()
+                    # ========= train for this epoch ==========
+                    train_losses = list()
+                    train_start_time = time.perf_counter()
+                    with tqdm.tqdm(train_dataloader,
+                            desc=f"Distilling {num_inference_steps} steps, epoch {self.epoch}",
+                            leave=False, mininterval=cfg.training.tqdm_interval_sec) as tepoch:
+                        for batch_idx, batch in enumerate(tepoch):
+                            # device transfer
+                            batch = dict_apply(batch, lambda x: x.to(device, non_blocking=True))
+                            if train_sampling_batch is None:
+                                train_sampling_batch = batch
+
+                            # compute loss
+                            with autocast(device, precision):
+                                raw_loss = distillation.compute_loss(batch)
+                            loss = raw_loss / cfg.training.gradient_accumulate_every
+                            grad_scaler.scale(loss).backward()
+
+                            # step optimizer
+                            if self.stage_step % cfg.training.gradient_accumulate_every == 0:
+                                grad_scaler.step(self.optimizer)
+                                grad_scaler.update()
+                                self.optimizer.zero_grad()
+                                lr_scheduler.step()
+
+                            # update ema
+                            if ema is not None:
+                                ema.step(self.model)
+
+                            # logging
+                            raw_loss_cpu = raw_loss.item()
+                            tepoch.set_postfix(loss=raw_loss_cpu, refresh=False)
+                            train_losses.append(raw_loss_cpu)
+                            step_log = {
+                                'train_loss': np.sqrt(raw_loss_cpu),
+                                'global_step': self.global_step,
+                                'epoch': self.epoch,
+                                'stage': self.stage,
+                                'num_inference_steps': num_inference_steps,
+                                'lr': lr_scheduler.get_last_lr()[0]
+                            }
+
+                            is_last_batch = (batch_idx == (len(train_dataloader)-1))
+                            if not is_last_batch:
+                                # log of last step is combined with validation
+                                wandb_run.log(step_log, step=self.global_step)
+                                json_logger.log(step_log)
+                                self.global_step += 1
+                                self.stage_step += 1
+
+                            if (cfg.training.max_train_steps is not None) \
+                                and batch_idx >= (cfg.training.max_train_steps-1):
+                                break
+
+                    # at the end of each epoch
+                    # replace train_loss with epoch average
+                    step_log['train_loss'] = np.sqrt(np.mean(train_losses))
+                    step_log['train_steps_per_sec'] = len(train_losses) \
+                        / (time.perf_counter() - train_start_time)
+
+                    # ========= eval for this epoch ==========
+                    self.model.eval()
+                    policy = self.model
+                    if cfg.training.use_ema:
+                        policy = self.ema_model
+                    policy.eval()
+
+                    # run validation
+                    if (self.stage_epoch % cfg.training.val_every) == 0:
+                        with torch.no_grad():
+                            val_losses = list()
+                            for batch_idx, batch in enumerate(val_dataloader):
+                                batch = dict_apply(batch, lambda x: x.to(device, non_blocking=True))
+                                with autocast(device, precision):
+                                    loss = val_distillation.compute_loss(batch)
+                                val_losses.append(loss)
+                                if (cfg.training.max_val_steps is not None) \
+                                    and batch_idx >= (cfg.training.max_val_steps-1):
+                                    break
+                            if len(val_losses) > 0:
+                                val_loss = torch.mean(torch.tensor(val_losses)).item()
+                                step_log['val_loss'] = np.sqrt(val_loss)
+
+                    # run few-step sampling on a training batch
+                    if (self.stage_epoch % cfg.training.sample_every) == 0:
+                        with torch.no_grad():
+                            batch = train_sampling_batch
+                            if 'nobs' in batch:
+                                # pre-normalized dataset
+                                batch = policy.normalizer.unnormalize({
+                                    'obs': batch['nobs'], 'action': batch['naction']})
+                            result = policy.predict_action({'obs': batch['obs']})
+                            gt_action = batch['action']
+                            if cfg.pred_action_steps_only:
+                                pred_action = result['action']
+                                start = cfg.n_obs_steps - 1
+                                end = start + cfg.n_action_steps
+                                gt_action = gt_action[:,start:end]
+                            else:
+                                pred_action = result['action_pred']
+                            mse = torch.nn.functional.mse_loss(pred_action, gt_action)
+                            step_log['train_action_mse_error'] = np.sqrt(mse.item())
+
+                    # checkpoint
+                    if (self.stage_epoch % cfg.training.checkpoint_every) == 0:
+                        self.save_checkpoint()
+                    # ========= eval end for this epoch ==========
+                    policy.train()
+                    self.model.train()
+
+                    # end of epoch
+                    # log of last step is combined with validation
+                    wandb_run.log(step_log, step=self.global_step)
+                    json_logger.log(step_log)
+                    self.global_step += 1
+                    self.stage_step += 1
+                    self.epoch += 1
+                    self.stage_epoch += 1
+
+                # export the student of this stage
+                self.save_checkpoint(tag=f'student_{num_inference_steps}_steps')
+                if self.stage == len(stage_steps) - 1:
+                    self.save_checkpoint()
+                    break
+                self._next_stage()
+
+        # checkpoints are written in the background
+        self.wait_for_checkpoints()
+        self.write_report(val_dataset)
+
+    def write_report(self, dataset: BaseLowdimDataset):
+        """
+        Latency and action error of the exported students against the
+        teacher, and the teacher with DDIM at the students' step counts
+        without distillation, on the validation set.
+        """
+        cfg = self.cfg
+        device = torch.device(cfg.training.device)
+        teacher = load_policy(cfg.distillation.teacher_checkpoint, device=device)
+
+        # recorded observations and actions
+        n_samples = cfg.distillation.report.n_samples
+        obs = list()
+        action = list()
+        dataloader = create_dataloader(dataset, **cfg.val_dataloader)
+        for batch in dataloader:
+            if 'nobs' in batch:
+                batch = teacher.normalizer.unnormalize({
+                    'obs': batch['nobs'].to(device), 'action': batch['naction'].to(device)})
+            obs.append(batch['obs'][:,:teacher.n_obs_steps].cpu())
+            action.append(batch['action'].cpu())
+            if sum(len(x) for x in obs) >= n_samples:
+                break
+        obs = torch.cat(obs)[:n_samples]
+        action = torch.cat(action)[:n_samples]
+
+        name = f"teacher_{teacher.sampler}_{teacher.num_inference_steps}"
+        policies = {name: teacher}
+        for num_inference_steps in self.get_stage_steps():
+            path = self.get_checkpoint_path(tag=f'student_{num_inference_steps}_steps')
+            policies[f'student_{num_inference_steps}'] = load_policy(path, device=device)
+        for num_inference_steps in sorted(set(self.get_stage_steps())):
+            ddim_teacher = copy.deepcopy(teacher)
+            ddim_teacher.set_sampler('ddim', num_inference_steps=num_inference_steps)
+            policies[f'teacher_ddim_{num_inference_steps}'] = ddim_teacher
+
+        report = compare_policies(policies, obs, action,
+            n_latency=cfg.distillation.report.n_latency,
+            seed=cfg.training.seed)
+        print(f"{cfg.distillation.method} distillation, {len(obs)} validation samples, "
+            f"batch 1 latency on {device}")
+        print(format_comparison(report))
+        report_path = pathlib.Path(self.output_dir).joinpath('distillation_report.json')
+        report_path.write_text(json.dumps(report, indent=2))
+        return report
+
+@hydra.main(
+    version_base=None,
+    config_path=str(pathlib.Path(__file__).parent.parent.joinpath("config")),
+    config_name=pathlib.Path(__file__).stem)
+def main(cfg):
+    workspace = DistillDiffusionTransformerLowdimWorkspace(cfg)
+    workspace.run()
+
+if __name__ == "__main__":
+    main()
@@ -20,14 +20,21 @@ import wandb
 import tqdm
 import shutil
 import zarr
+import contextlib
 
-from diffusion_policy.common.pytorch_util import dict_apply, optimizer_to
+from diffusion_policy.common.pytorch_util import (
+    dict_apply, optimizer_to, autocast, create_grad_scaler)
 from diffusion_policy.workspace.base_workspace import BaseWorkspace
 from diffusion_policy.policy.diffusion_unet_lowdim_policy import DiffusionUnetLowdimPolicy
-from diffusion_policy.dataset.base_dataset import BaseLowdimDataset
+from diffusion_policy.dataset.base_dataset import (
+    BaseLowdimDataset, create_dataloader, set_dataloader_epoch)
 from diffusion_policy.env_runner.base_runner import BaseLowdimRunner
+from diffusion_policy.env_runner.async_runner import AsyncRunner
 from diffusion_policy.common.checkpoint_util import TopKCheckpointManager
 from diffusion_policy.common.json_logger import JsonLogger
+from diffusion_policy.common.distributed_util import (
+    init_distributed, cleanup_distributed, all_reduce_mean, barrier,
+    PolicyLossModule)
 from diffusion_policy.model.common.lr_scheduler import get_scheduler
 from diffusers.training_utils import EMAModel
 
@@ -64,6 +71,13 @@ class TrainDiffusionUnetLowdimWorkspace(BaseWorkspace):
     def run(self):
         cfg = copy.deepcopy(self.cfg)
 
+        # distributed data parallel when launched with torchrun,
+        # rank 0 alone runs EMA, rollouts, logging and checkpointing
+        rank, world_size, local_rank = init_distributed(
+            OmegaConf.select(cfg, 'training.dist_backend', default=None))
+        is_main_process = (rank == 0)
+        distributed = (world_size > 1)
+
         # resume training
         if cfg.training.resume:
             lastest_ckpt_path = self.get_checkpoint_path()
@@ -74,14 +88,27 @@ class TrainDiffusionUnetLowdimWorkspace(BaseWorkspace):
         # configure dataset
         dataset: BaseLowdimDataset
         #breakpoint()
-        dataset = hydra.utils.instantiate(cfg.task.dataset)
+        dataset_kwargs = dict()
+        if distributed and ('device' in cfg.task.dataset) \
+                and (torch.device(cfg.task.dataset.device).type == 'cuda'):
+            # samples on the GPU of this rank, not on the configured one
+            dataset_kwargs['device'] = f'cuda:{local_rank}'
+        # rank 0 builds the on-disk dataset caches (normalized, mmap)
+        # before the other ranks open them
+        if not is_main_process:
+            barrier()
+        dataset = hydra.utils.instantiate(cfg.task.dataset, **dataset_kwargs)
+        if is_main_process:
+            barrier()
         assert isinstance(dataset, BaseLowdimDataset)
-        train_dataloader = DataLoader(dataset, **cfg.dataloader)
+        train_dataloader = create_dataloader(dataset,
+            distributed=distributed, **cfg.dataloader)
         normalizer = dataset.get_normalizer()
 
         # configure validation dataset
         val_dataset = dataset.get_validation_dataset()
-        val_dataloader = DataLoader(val_dataset, **cfg.val_dataloader)
+        val_dataloader = create_dataloader(val_dataset,
+            distributed=distributed, **cfg.val_dataloader)
 
         self.model.set_normalizer(normalizer)
         if cfg.training.use_ema:
@@ -102,45 +129,80 @@ class TrainDiffusionUnetLowdimWorkspace(BaseWorkspace):
 
         # configure ema
         ema: EMAModel = None
-        if cfg.training.use_ema:
+        if cfg.training.use_ema and is_main_process:
             ema = hydra.utils.instantiate(
                 cfg.ema,
                 model=self.ema_model)
 
         # configure env runner
-        env_runner: BaseLowdimRunner
-        device = cfg.training.device
-        cfg.task.env_runner['device'] = device
-        env_runner = hydra.utils.instantiate(
-            cfg.task.env_runner,
-            output_dir=self.output_dir)
-        assert isinstance(env_runner, BaseLowdimRunner)
+        env_runner: BaseLowdimRunner = None
+        async_runner: AsyncRunner = None
+        if is_main_process:
+            device = cfg.training.device
+            cfg.task.env_runner['device'] = device
+        if is_main_process and OmegaConf.select(cfg, 'training.async_rollout', default=False):
+            # simulator and rollouts in a separate process
+            async_runner = AsyncRunner(
+                runner_cfg=cfg.task.env_runner,
+                policy_cfg=cfg.policy,
+                output_dir=self.output_dir,
+                device=cfg.training.device)
+        elif is_main_process:
+            env_runner = hydra.utils.instantiate(
+                cfg.task.env_runner,
+                output_dir=self.output_dir)
+            assert isinstance(env_runner, BaseLowdimRunner)
 
         # configure logging
+        logging_cfg = OmegaConf.to_container(cfg.logging)
+        if not is_main_process:
+            logging_cfg['mode'] = 'disabled'
         wandb_run = wandb.init(
             dir=str(self.output_dir),
             config=OmegaConf.to_container(cfg, resolve=True),
-            **cfg.logging
+            **logging_cfg
         )
         wandb.config.update(
             {
                 "output_dir": self.output_dir,
             }
         )
+        if async_runner is not None:
+            # background rollouts are plotted at the step of their snapshot
+            wandb_run.define_metric('rollout/global_step')
+            wandb_run.define_metric('rollout/*', step_metric='rollout/global_step')
 
         # configure checkpoint
         topk_manager = TopKCheckpointManager(
             save_dir=os.path.join(self.output_dir, 'checkpoints'),
+            delete_fn=self.remove_checkpoint,
             **cfg.checkpoint.topk
         )
 
         # device transfer
         device = torch.device(cfg.training.device)
+        if distributed and (device.type == 'cuda'):
+            device = torch.device('cuda', local_rank)
+            torch.cuda.set_device(device)
         self.model.to(device)
         if self.ema_model is not None:
             self.ema_model.to(device)
         optimizer_to(self.optimizer, device)
 
+        # mixed precision, normalizer and loss stay in fp32
+        precision = OmegaConf.select(cfg, 'training.precision', default='fp32')
+        grad_scaler = create_grad_scaler(device, precision)
+
+        compute_loss = self.model.compute_loss
+        if distributed:
+            compute_loss = torch.nn.parallel.DistributedDataParallel(
+                PolicyLossModule(self.model),
+                device_ids=[device.index] if device.type == 'cuda' else None,
+                find_unused_parameters=OmegaConf.select(cfg,
+                    'training.find_unused_parameters', default=False))
+            # different diffusion noise on every rank
+            torch.manual_seed(cfg.training.seed + rank)
+
         # save batch for sampling
         train_sampling_batch = None
 
@@ -155,13 +217,26 @@ class TrainDiffusionUnetLowdimWorkspace(BaseWorkspace):
 
         # training loop
         log_path = os.path.join(self.output_dir, 'logs.json.txt')
-        with JsonLogger(log_path) as json_logger:
+        json_logger_context = contextlib.nullcontext()
+        if is_main_process:
+            json_logger_context = JsonLogger(log_path)
+
+        def log_rollout(rollout_log):
+            # json log keeps the step of the snapshot,
+            # wandb steps have to be increasing
+            wandb_run.log({f'rollout/{key}': value
+                for key, value in rollout_log.items()}, step=self.global_step)
+            json_logger.log(rollout_log)
+
+        with json_logger_context as json_logger:
             for local_epoch_idx in range(cfg.training.num_epochs):
+                set_dataloader_epoch(train_dataloader, self.epoch)
                 step_log = dict()
                 # ========= train for this epoch ==========
                 train_losses = list()
                 with tqdm.tqdm(train_dataloader, desc=f"Training epoch {self.epoch}", 
-                        leave=False, mininterval=cfg.training.tqdm_interval_sec) as tepoch:
+                        leave=False, mininterval=cfg.training.tqdm_interval_sec,
+                        disable=not is_main_process) as tepoch:
                     for batch_idx, batch in enumerate(tepoch):
                         # device transfer
                         batch = dict_apply(batch, lambda x: x.to(device, non_blocking=True))
@@ -170,18 +245,20 @@ class TrainDiffusionUnetLowdimWorkspace(BaseWorkspace):
                             train_sampling_batch = batch
 
                         # compute loss
-                        raw_loss = self.model.compute_loss(batch)
+                        with autocast(device, precision):
+                            raw_loss = compute_loss(batch)
                         loss = raw_loss / cfg.training.gradient_accumulate_every
-                        loss.backward()
+                        grad_scaler.scale(loss).backward()
 
                         # step optimizer
                         if self.global_step % cfg.training.gradient_accumulate_every == 0:
-                            self.optimizer.step()
+                            grad_scaler.step(self.optimizer)
+                            grad_scaler.update()
                             self.optimizer.zero_grad()
                             lr_scheduler.step()
                         
                         # update ema
-                        if cfg.training.use_ema:
+                        if ema is not None:
                             ema.step(self.model)
 
                         # logging
@@ -198,8 +275,9 @@ class TrainDiffusionUnetLowdimWorkspace(BaseWorkspace):
                         is_last_batch = (batch_idx == (len(train_dataloader)-1))
                         if not is_last_batch:
                             # log of last step is combined with validation and rollout
-                            wandb_run.log(step_log, step=self.global_step)
-                            json_logger.log(step_log)
+                            if is_main_process:
+                                wandb_run.log(step_log, step=self.global_step)
+                                json_logger.log(step_log)
                             self.global_step += 1
 
                         if (cfg.training.max_train_steps is not None) \
@@ -208,7 +286,7 @@ class TrainDiffusionUnetLowdimWorkspace(BaseWorkspace):
                 
                 # at the end of each epoch
                 # replace train_loss with epoch average
-                train_loss = np.mean(train_losses)
+                train_loss = all_reduce_mean(np.mean(train_losses), device)
                 step_log['train_loss'] = np.sqrt(train_loss)
 
                 # ========= eval for this epoch ==========
@@ -223,8 +301,13 @@ class TrainDiffusionUnetLowdimWorkspace(BaseWorkspace):
                 #     # log all
                 #     step_log.update(runner_log)
                 
+                # run rollout in the background
+                if (async_runner is not None) and (self.epoch % cfg.training.rollout_every) == 0:
+                    # evaluated on a snapshot of the weights while training continues
+                    async_runner.submit(policy, self.global_step, self.epoch)
+
                 # run diffusion sampling on a eval batch
-                if (self.epoch % cfg.training.rollout_every) == 0:
+                if (env_runner is not None) and (self.epoch % cfg.training.rollout_every) == 0:
                     with torch.no_grad():
                         # sample trajectory from training set, and evaluate difference
                         filename = env_runner.run(policy)
@@ -283,24 +366,32 @@ class TrainDiffusionUnetLowdimWorkspace(BaseWorkspace):
                     with torch.no_grad():
                         val_losses = list()
                         with tqdm.tqdm(val_dataloader, desc=f"Validation epoch {self.epoch}", 
-                                leave=False, mininterval=cfg.training.tqdm_interval_sec) as tepoch:
+                                leave=False, mininterval=cfg.training.tqdm_interval_sec,
+                                disable=not is_main_process) as tepoch:
                             for batch_idx, batch in enumerate(tepoch):
                                 batch = dict_apply(batch, lambda x: x.to(device, non_blocking=True))
-                                loss = self.model.compute_loss(batch)
+                                with autocast(device, precision):
+                                    loss = self.model.compute_loss(batch)
                                 val_losses.append(loss)
                                 if (cfg.training.max_val_steps is not None) \
                                     and batch_idx >= (cfg.training.max_val_steps-1):
                                     break
                         if len(val_losses) > 0:
                             val_loss = torch.mean(torch.tensor(val_losses)).item()
+                            # every rank has the same number of val batches
+                            val_loss = all_reduce_mean(val_loss, device)
                             # log epoch average validation loss
                             step_log['val_loss'] = np.sqrt(val_loss)
 
                 # run diffusion sampling on a training batch
-                if (self.epoch % cfg.training.sample_every) == 0:
+                if is_main_process and (self.epoch % cfg.training.sample_every) == 0:
                     with torch.no_grad():
                         # sample trajectory from training set, and evaluate difference
                         batch = train_sampling_batch
+                        if 'nobs' in batch:
+                            # pre-normalized dataset
+                            batch = policy.normalizer.unnormalize({
+                                'obs': batch['nobs'], 'action': batch['naction']})
                         obs_dict = {'obs': batch['obs']}
                         gt_action = batch['action']
                         
@@ -324,7 +415,7 @@ class TrainDiffusionUnetLowdimWorkspace(BaseWorkspace):
                         del mse
                 
                 # checkpoint
-                if (self.epoch % cfg.training.checkpoint_every) == 0:
+                if is_main_process and (self.epoch % cfg.training.checkpoint_every) == 0:
                     # checkpointing
                     if cfg.checkpoint.save_last_ckpt:
                         self.save_checkpoint()
@@ -350,13 +441,27 @@ class TrainDiffusionUnetLowdimWorkspace(BaseWorkspace):
                 # ========= eval end for this epoch ==========
                 policy.train()
 
+                # finished background rollouts
+                if async_runner is not None:
+                    for rollout_log in async_runner.poll():
+                        log_rollout(rollout_log)
+
                 # end of epoch
                 # log of last step is combined with validation and rollout
-                wandb_run.log(step_log, step=self.global_step)
-                json_logger.log(step_log)
+                if is_main_process:
+                    wandb_run.log(step_log, step=self.global_step)
+                    json_logger.log(step_log)
                 self.global_step += 1
                 self.epoch += 1
 
+            if async_runner is not None:
+                for rollout_log in async_runner.close():
+                    log_rollout(rollout_log)
+
+        # checkpoints are written in the background
+        self.wait_for_checkpoints()
+        cleanup_distributed()
+
 @hydra.main(
     version_base=None,
     config_path=str(pathlib.Path(__file__).parent.parent.joinpath("config")), 
@@ -1,4 +1,4 @@
-from typing import Dict, Tuple
+from typing import Dict, Tuple, Optional
 
 import numpy as np
 import torch
@@ -10,6 +10,8 @@ from diffusers.schedulers.scheduling_ddpm import DDPMScheduler
 from diffusion_policy.model.common.normalizer import LinearNormalizer
 from diffusion_policy.policy.base_policy import BaseLowdimPolicy
 from diffusion_policy.model.diffusion.mask_generator import LowdimMaskGenerator
+from diffusion_policy.model.diffusion.inference_scheduler import (
+    create_inference_scheduler, get_ddpm_step_coefficients, ddpm_step)
 class DiffusionTransformerLowdimPolicy(BaseLowdimPolicy):
     def __init__(self, 
             model,
@@ -23,6 +25,7 @@ class DiffusionTransformerLowdimPolicy(BaseLowdimPolicy):
             num_inference_steps=None,
             obs_as_cond=False,
             pred_action_steps_only=False,
+            sampler='ddpm',
             # parameters passed to step
             **kwargs):
         super().__init__()
@@ -51,16 +54,60 @@ class DiffusionTransformerLowdimPolicy(BaseLowdimPolicy):
         if num_inference_steps is None:
             num_inference_steps = noise_scheduler.config.num_train_timesteps
         self.num_inference_steps = num_inference_steps
+        self.set_sampler(sampler)
+
+    def set_sampler(self, sampler: str='ddpm', num_inference_steps: Optional[int]=None):
+        """
+        Switch the inference sampler, all reuse the trained model.
+        sampler: ddpm, ddim or dpmsolver++
+        num_inference_steps: network evaluations per sample, default unchanged
+        """
+        self.sampler = sampler
+        self.inference_scheduler = create_inference_scheduler(
+            self.noise_scheduler, sampler)
+        if num_inference_steps is not None:
+            self.num_inference_steps = num_inference_steps
+        self._ddpm_schedule = None
+
+    def _get_sampling_schedule(self, device):
+        """
+        Timesteps of the inference scheduler and, for DDPM, the closed
+        form step coefficients on device, cached per step count.
+        Other samplers are stepped with scheduler.step, which may keep
+        state per sample, so they are reset every call.
+        return: timesteps, (N,5) coefficients or None
+        """
+        scheduler = self.inference_scheduler
+        key = (self.num_inference_steps, device)
+        if (self._ddpm_schedule is not None) and (self._ddpm_schedule[0] == key):
+            return self._ddpm_schedule[1:]
+
+        # set step values
+        scheduler.set_timesteps(self.num_inference_steps)
+        coefficients = None
+        if isinstance(scheduler, DDPMScheduler):
+            coefficients = get_ddpm_step_coefficients(scheduler)
+        if coefficients is None:
+            return scheduler.timesteps, None
+        self._ddpm_schedule = (key, scheduler.timesteps.clone(), coefficients.to(device))
+        return self._ddpm_schedule[1:]
     
     # ========= inference  ============
     def conditional_sample(self, 
             condition_data, condition_mask,
             cond=None, generator=None,
+            init_trajectory=None, init_step=0, init_mask=None,
             # keyword arguments to scheduler.step
             **kwargs
             ):
+        """
+        init_trajectory: warm start, clean trajectory re-noised to
+            inference step init_step, the steps before it are skipped
+        init_mask: (B,) rows of init_trajectory to use, all steps are
+            run if any row starts from pure noise
+        """
         model = self.model
-        scheduler = self.noise_scheduler
+        scheduler = self.inference_scheduler
 
         trajectory = torch.randn(
             size=condition_data.shape, 
@@ -68,10 +115,38 @@ class DiffusionTransformerLowdimPolicy(BaseLowdimPolicy):
             device=condition_data.device,
             generator=generator)
     
-        # set step values
-        scheduler.set_timesteps(self.num_inference_steps)
+        timesteps, step_coefficients = self._get_sampling_schedule(trajectory.device)
+        clip_sample_range = None
+        if (step_coefficients is not None) and scheduler.config.clip_sample:
+            clip_sample_range = scheduler.config.clip_sample_range
+
+        # observation token embeddings are the same every step
+        model_kwargs = dict()
+        if (cond is not None) and hasattr(model, 'embed_obs'):
+            model_kwargs['obs_emb'] = model.embed_obs(cond)
+
+        first_step = 0
+        if init_trajectory is not None:
+            assert 0 <= init_step < len(timesteps)
+            first_step = init_step
+            if (init_mask is not None) and (not init_mask.all()):
+                first_step = 0
+
+        for i in range(first_step, len(timesteps)):
+            t = timesteps[i]
+            if (init_trajectory is not None) and (i == init_step):
+                # x_t of the warm start at this step's noise level
+                noise = torch.randn(
+                    size=init_trajectory.shape,
+                    dtype=init_trajectory.dtype,
+                    device=init_trajectory.device,
+                    generator=generator)
+                init = self.noise_scheduler.add_noise(init_trajectory, noise, t)
+                if init_mask is None:
+                    trajectory = init
+                else:
+                    trajectory = torch.where(init_mask[:,None,None], init, trajectory)
 
-        for t in scheduler.timesteps:
             # 1. apply conditioning
             trajectory[condition_mask] = condition_data[condition_mask]
 
@@ -87,15 +162,27 @@ class DiffusionTransformerLowdimPolicy(BaseLowdimPolicy):
                 model_output = model.forward(trajectory_np, t_np, cond_np)
                 model_output = torch.from_numpy(model_output)
             else:
-                model_output = model.forward(trajectory, t_reshaped, cond)
+                model_output = model.forward(trajectory, t_reshaped, cond, **model_kwargs)
 
 
             # 3. compute previous image: x_t -> x_t-1
-            trajectory = scheduler.step(
-                model_output, t, trajectory, 
-                generator=generator,
-                **kwargs
-                ).prev_sample
+            if step_coefficients is None:
+                trajectory = scheduler.step(
+                    model_output, t, trajectory, 
+                    generator=generator,
+                    **kwargs
+                    ).prev_sample
+            else:
+                # DDPMScheduler.step in closed form, noise except at t = 0
+                noise = None
+                if t > 0:
+                    noise = torch.randn(
+                        size=model_output.shape,
+                        dtype=model_output.dtype,
+                        device=model_output.device,
+                        generator=generator)
+                trajectory = ddpm_step(trajectory, model_output,
+                    step_coefficients[i], noise, clip_sample_range)
         
         # finally make sure conditioning is enforced
         trajectory[condition_mask] = condition_data[condition_mask]        
@@ -103,9 +190,18 @@ class DiffusionTransformerLowdimPolicy(BaseLowdimPolicy):
         return trajectory
 
 
-    def predict_action(self, obs_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+    def predict_action(self, obs_dict: Dict[str, torch.Tensor],
+            warm_start: Optional[torch.Tensor]=None,
+            warm_start_step: Optional[int]=None,
+            warm_start_mask: Optional[torch.Tensor]=None) -> Dict[str, torch.Tensor]:
         """
         obs_dict: must include "obs" key
+        warm_start: action_pred of the previous call, advanced to this
+            call's observations with shift_action_pred. Sampling starts
+            from it re-noised to inference step warm_start_step instead
+            of from pure noise, skipping the steps before.
+        warm_start_step: default num_inference_steps // 2
+        warm_start_mask: (B,) rows to warm start, e.g. False after a reset
         result: must include "action" key
         """
 
@@ -141,11 +237,21 @@ class DiffusionTransformerLowdimPolicy(BaseLowdimPolicy):
             cond_data[:,:To,Da:] = nobs[:,:To]
             cond_mask[:,:To,Da:] = True
 
+        init_trajectory = None
+        if warm_start is not None:
+            init_trajectory = torch.zeros_like(cond_data)
+            init_trajectory[...,:Da] = self.normalizer['action'].normalize(warm_start)
+            if warm_start_step is None:
+                warm_start_step = self.num_inference_steps // 2
+
         # run sampling
         nsample = self.conditional_sample(
             cond_data, 
             cond_mask,
             cond=cond,
+            init_trajectory=init_trajectory,
+            init_step=warm_start_step,
+            init_mask=warm_start_mask,
             **self.kwargs)
         
         # unnormalize prediction
@@ -172,6 +278,18 @@ class DiffusionTransformerLowdimPolicy(BaseLowdimPolicy):
             result['obs_pred'] = obs_pred
         return result
 
+    @staticmethod
+    def shift_action_pred(action_pred: torch.Tensor, n_steps: int) -> torch.Tensor:
+        """
+        Plan of a previous call advanced by n_steps executed actions,
+        the last action repeated to fill the horizon.
+        """
+        n_steps = min(n_steps, action_pred.shape[1] - 1)
+        if n_steps <= 0:
+            return action_pred
+        return torch.cat([action_pred[:,n_steps:],
+            action_pred[:,-1:].expand(-1, n_steps, -1)], dim=1)
+
     # ========= training  ============
     def set_normalizer(self, normalizer: LinearNormalizer):
         self.normalizer.load_state_dict(normalizer.state_dict())
@@ -202,6 +320,9 @@ class DiffusionTransformerLowdimPolicy(BaseLowdimPolicy):
                 end = start + self.n_action_steps
                 trajectory = action[:,start:end]
         else:
+            # inpainting needs obs over the whole horizon,
+            # not only the n_obs_steps window of the dataset
+            assert obs.shape[1] == action.shape[1]
             trajectory = torch.cat([action, obs], dim=-1)
         
         # generate impainting mask
@@ -0,0 +1,86 @@
+"""
+Usage:
+python benchmark_distillation.py -t data/outputs/train_0/checkpoints/latest.ckpt -s data/outputs/distill_0/checkpoints/student_1_steps.ckpt
+python benchmark_distillation.py -t teacher.ckpt -s student_2_steps.ckpt,student_1_steps.ckpt --zarr_path recorded_data_5_skills_large.zarr
+
+Compares distilled students with their teacher on the same observations:
+network calls per predict_action, batch 1 latency, the action error to
+the recorded actions and to the teacher's actions, next to the teacher
+sampled with DDIM at the students' step counts without distillation.
+The teacher row compares two of its samples with different noise, the
+floor any student is compared against.
+"""
+
+import pathlib
+import click
+import numpy as np
+import torch
+
+from diffusion_policy.common.checkpoint_util import load_policy
+from diffusion_policy.common.policy_benchmark import compare_policies, format_comparison
+from diffusion_policy.common.replay_buffer import ReplayBuffer
+
+
+def load_windows(zarr_path, n_samples, horizon, n_obs_steps, obs_dim, seed=0):
+    """
+    Random horizon windows of recorded states and actions, within episodes.
+    return: obs (N,To,Do), action (N,T,Da)
+    """
+    replay_buffer = ReplayBuffer.copy_from_path(zarr_path, keys=['state', 'action'])
+    state = replay_buffer['state'][:]
+    action = replay_buffer['action'][:]
+    episode_ends = replay_buffer.episode_ends[:]
+    episode_starts = np.concatenate([[0], episode_ends[:-1]])
+    starts = np.concatenate([np.arange(start, end - horizon + 1)
+        for start, end in zip(episode_starts, episode_ends)])
+    rng = np.random.default_rng(seed=seed)
+    starts = rng.choice(starts, size=n_samples, replace=len(starts) < n_samples)
+    obs = np.stack([state[i:i + n_obs_steps, :obs_dim] for i in starts])
+    action = np.stack([action[i:i + horizon] for i in starts])
+    return torch.from_numpy(obs.astype(np.float32)), torch.from_numpy(action.astype(np.float32))
+
+
+@click.command()
+@click.option('-t', '--teacher', required=True, help='teacher checkpoint')
+@click.option('-s', '--students', required=True, help='comma separated student checkpoints')
+@click.option('-d', '--device', default='cuda:0')
+@click.option('--zarr_path', default=None, help='recorded observations and actions, default: random obs')
+@click.option('--n_samples', default=1000, type=int)
+@click.option('--n_latency', default=200, type=int, help='batch 1 calls timed per policy')
+@click.option('--seed', default=0, type=int)
+def main(teacher, students, device, zarr_path, n_samples, n_latency, seed):
+    device = torch.device(device)
+    teacher_path = teacher
+    teacher = load_policy(teacher_path, device=device)
+
+    action = None
+    if zarr_path is None:
+        torch.manual_seed(seed)
+        obs = torch.randn(n_samples, teacher.n_obs_steps, teacher.obs_dim)
+    else:
+        obs, action = load_windows(zarr_path, n_samples,
+            horizon=teacher.horizon, n_obs_steps=teacher.n_obs_steps,
+            obs_dim=teacher.obs_dim, seed=seed)
+
+    policies = {f"teacher_{teacher.sampler}_{teacher.num_inference_steps}": teacher}
+    student_steps = set()
+    for path in students.split(','):
+        student = load_policy(path, device=device)
+        name = f"student_{student.num_inference_steps}"
+        if name in policies:
+            name += f"_{pathlib.Path(path).stem}"
+        policies[name] = student
+        student_steps.add(student.num_inference_steps)
+    for num_inference_steps in sorted(student_steps):
+        policies[f"teacher_ddim_{num_inference_steps}"] = load_policy(
+            teacher_path, device=device,
+            sampler='ddim', num_inference_steps=num_inference_steps)
+
+    report = compare_policies(policies, obs, action, n_latency=n_latency, seed=seed)
+    source = 'random obs' if zarr_path is None else zarr_path
+    print(f"{len(obs)} samples of {source}, batch 1 latency on {device}")
+    print(format_comparison(report))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Usage:
+python benchmark_inference.py -c data/outputs/train_0/checkpoints/latest.ckpt
+python benchmark_inference.py -c data/outputs/train_0/checkpoints/latest.ckpt -d cuda:0 --batch_size 4 --num_threads 1
+
+Control loop latency of policy.predict_action against an InferenceSession
+with preallocated buffers, on the same observations and random state.
+Reports p50, p99 and max latency per call and checks the actions match.
+"""
+
+import time
+import click
+import numpy as np
+import torch
+
+from diffusion_policy.common.checkpoint_util import load_policy
+from diffusion_policy.common.inference_session import InferenceSession
+
+
+def measure(predict_action, obs, n_warmup, seed, device):
+    """
+    return: last result, latencies in seconds
+    """
+    latencies = list()
+    for i in range(n_warmup + obs.shape[0]):
+        obs_dict = {'obs': obs[i % obs.shape[0]]}
+        torch.manual_seed(seed + i)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start_time = time.perf_counter()
+        result = predict_action(obs_dict)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        if i >= n_warmup:
+            latencies.append(time.perf_counter() - start_time)
+    return result, np.array(latencies)
+
+
+@click.command()
+@click.option('-c', '--checkpoint', required=True)
+@click.option('-d', '--device', default='cpu')
+@click.option('--batch_size', default=1, type=int)
+@click.option('--sampler', default=None, help='default: as trained')
+@click.option('--num_inference_steps', default=None, type=int)
+@click.option('--num_threads', default=None, type=int, help='torch CPU threads')
+@click.option('--n_calls', default=500, type=int)
+@click.option('--n_warmup', default=20, type=int)
+@click.option('--seed', default=0, type=int)
+def main(checkpoint, device, batch_size, sampler, num_inference_steps,
+        num_threads, n_calls, n_warmup, seed):
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    device = torch.device(device)
+    policy = load_policy(checkpoint, device=device,
+        sampler=sampler, num_inference_steps=num_inference_steps)
+    session = InferenceSession(policy, batch_size=batch_size)
+
+    torch.manual_seed(seed)
+    obs = torch.randn(n_calls, batch_size, policy.n_obs_steps, policy.obs_dim,
+        device=device)
+
+    def predict_action(obs_dict):
+        with torch.no_grad():
+            return policy.predict_action(obs_dict)
+
+    results = dict()
+    for name, fn in [('policy', predict_action), ('session', session.predict_action)]:
+        result, latencies = measure(fn, obs, n_warmup=n_warmup, seed=seed, device=device)
+        results[name] = (result['action_pred'].clone(), latencies)
+
+    print(f"{policy.sampler} {policy.num_inference_steps} steps, batch {batch_size}, "
+        f"{n_calls} calls, {device}, {torch.get_num_threads()} threads")
+    print(f"{'':>8} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} {'std ms':>8}")
+    for name, (_, latencies) in results.items():
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1e3
+        print(f"{name:>8} {p50:>8.3f} {p99:>8.3f} {latencies.max() * 1e3:>8.3f} "
+            f"{latencies.std() * 1e3:>8.3f}")
+    max_diff = (results['policy'][0] - results['session'][0]).abs().max().item()
+    print(f"max action difference {max_diff:.3g}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Usage:
+python benchmark_precision.py -c ../diffusion_policy/config_files/cyber_diffusion_policy_n=8.yaml
+python benchmark_precision.py -c ../diffusion_policy/config_files/cyber_diffusion_policy_n=8.yaml --precisions fp32,bf16 --n_steps 2000
+
+Trains the configured policy once per training.precision, from the same
+initialization, on the same batches and diffusion noise of a small
+synthetic dataset. Reports the smoothed loss curves relative to fp32,
+training throughput and peak memory.
+"""
+
+import copy
+import time
+import click
+import hydra
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+from diffusion_policy.common.pytorch_util import autocast, create_grad_scaler
+from diffusion_policy.model.common.normalizer import LinearNormalizer
+
+
+def make_synthetic_data(n_samples, horizon, obs_dim, action_dim, seed=0):
+    """
+    Smooth random observations, actions a fixed nonlinear function of them.
+    """
+    rng = np.random.default_rng(seed=seed)
+    t = np.arange(horizon)[None, :, None]
+    freq = rng.uniform(0.05, 0.5, size=(n_samples, 1, obs_dim))
+    phase = rng.uniform(0, 2 * np.pi, size=(n_samples, 1, obs_dim))
+    obs = np.sin(freq * t + phase) + 0.05 * rng.standard_normal((n_samples, horizon, obs_dim))
+    weight = rng.standard_normal((obs_dim, action_dim)) / np.sqrt(obs_dim)
+    action = np.tanh(obs @ weight)
+    return {
+        'obs': torch.from_numpy(obs.astype(np.float32)),
+        'action': torch.from_numpy(action.astype(np.float32))
+    }
+
+
+def train(policy, data, precision, device, n_steps, batch_size, optimizer_cfg, seed):
+    policy.to(device)
+    optimizer = policy.get_optimizer(**optimizer_cfg)
+    grad_scaler = create_grad_scaler(device, precision)
+    data = {key: value.to(device) for key, value in data.items()}
+    n_samples = data['obs'].shape[0]
+
+    # same batches and diffusion noise for every precision
+    rng = np.random.default_rng(seed=seed)
+    torch.manual_seed(seed)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+    losses = list()
+    n_warmup = min(10, n_steps // 2)
+    start_time = None
+    for step in range(n_steps):
+        if step == n_warmup:
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            start_time = time.perf_counter()
+        idxs = torch.from_numpy(rng.integers(0, n_samples, size=batch_size)).to(device)
+        batch = {key: value[idxs] for key, value in data.items()}
+        with autocast(device, precision):
+            loss = policy.compute_loss(batch)
+        grad_scaler.scale(loss).backward()
+        grad_scaler.step(optimizer)
+        grad_scaler.update()
+        optimizer.zero_grad(set_to_none=True)
+        losses.append(loss.detach())
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    duration = time.perf_counter() - start_time
+
+    peak_mem = None
+    if device.type == 'cuda':
+        peak_mem = torch.cuda.max_memory_allocated(device)
+    return {
+        'losses': torch.stack(losses).float().cpu().numpy(),
+        'steps_per_sec': (n_steps - n_warmup) / duration,
+        'peak_mem_mb': None if peak_mem is None else peak_mem / 1e6
+    }
+
+
+def smooth(x, window):
+    window = min(window, len(x))
+    return np.convolve(x, np.ones(window) / window, mode='valid')
+
+
+@click.command()
+@click.option('-c', '--config', required=True, help='training config yaml')
+@click.option('--precisions', default='fp32,bf16,fp16')
+@click.option('-d', '--device', default='cuda:0')
+@click.option('--n_steps', default=1000, type=int)
+@click.option('--batch_size', default=None, type=int, help='default: dataloader.batch_size')
+@click.option('--n_samples', default=20000, type=int, help='synthetic dataset size')
+@click.option('--smooth_window', default=50, type=int)
+@click.option('--tolerance', default=0.05, type=float, help='max relative gap of smoothed loss to fp32')
+@click.option('--seed', default=0, type=int)
+def main(config, precisions, device, n_steps, batch_size, n_samples,
+        smooth_window, tolerance, seed):
+    cfg = OmegaConf.load(config)
+    precisions = precisions.split(',')
+    device = torch.device(device)
+    if batch_size is None:
+        batch_size = cfg.dataloader.batch_size
+
+    data = make_synthetic_data(n_samples,
+        horizon=cfg.horizon,
+        obs_dim=cfg.obs_dim,
+        action_dim=cfg.action_dim,
+        seed=seed)
+    normalizer = LinearNormalizer()
+    normalizer.fit(data, last_n_dims=1, mode='limits')
+
+    torch.manual_seed(seed)
+    init_policy = hydra.utils.instantiate(cfg.policy)
+    init_policy.set_normalizer(normalizer)
+
+    results = dict()
+    for precision in precisions:
+        policy = copy.deepcopy(init_policy)
+        results[precision] = train(policy, data,
+            precision=precision,
+            device=device,
+            n_steps=n_steps,
+            batch_size=batch_size,
+            optimizer_cfg=cfg.optimizer,
+            seed=seed)
+        del policy
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    reference = smooth(results[precisions[0]]['losses'], smooth_window)
+    print(f"Relative to {precisions[0]}, {n_steps} steps, batch {batch_size}, {device}")
+    print(f"{'precision':>9} {'final loss':>11} {'max gap':>8} {'steps/s':>9} {'speedup':>8} {'peak MB':>9}")
+    passed = True
+    for precision in precisions:
+        result = results[precision]
+        curve = smooth(result['losses'], smooth_window)
+        max_gap = np.max(np.abs(curve - reference) / np.abs(reference))
+        passed = passed and (max_gap <= tolerance)
+        speedup = result['steps_per_sec'] / results[precisions[0]]['steps_per_sec']
+        peak_mem = 'n/a' if result['peak_mem_mb'] is None else f"{result['peak_mem_mb']:.1f}"
+        print(f"{precision:>9} {curve[-1]:>11.5f} {max_gap:>8.2%} "
+            f"{result['steps_per_sec']:>9.2f} {speedup:>7.2f}x {peak_mem:>9}")
+    print('parity ' + ('passed' if passed else 'FAILED') + f" (tolerance {tolerance:.0%})")
+
+
+if __name__ == '__main__':
+    main()
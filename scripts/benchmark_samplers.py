@@ -0,0 +1,118 @@
+"""
+Usage:
+python benchmark_samplers.py -c data/outputs/train_0/checkpoints/latest.ckpt
+python benchmark_samplers.py -c data/outputs/train_0/checkpoints/latest.ckpt --zarr_path recorded_data_5_skills_large.zarr --steps 1,2,3,4,5
+
+Samples the same observations with the same initial noise using the
+trained 10 step DDPM chain as reference and the few-step DDIM and
+DPM-Solver++ samplers. Reports batch 1 latency and the action error
+relative to the reference, next to the error between two DDPM samples
+with different noise as the floor any sampler is compared against.
+"""
+
+import time
+import click
+import numpy as np
+import torch
+
+from diffusion_policy.common.checkpoint_util import load_policy_artifact, policy_from_artifact
+from diffusion_policy.common.replay_buffer import ReplayBuffer
+
+
+def load_obs_windows(zarr_path, n_samples, n_obs_steps, obs_dim, seed=0):
+    """
+    Random n_obs_steps windows of recorded states, within episodes.
+    """
+    replay_buffer = ReplayBuffer.copy_from_path(zarr_path, keys=['state'])
+    state = replay_buffer['state'][:]
+    episode_ends = replay_buffer.episode_ends[:]
+    episode_starts = np.concatenate([[0], episode_ends[:-1]])
+    starts = np.concatenate([np.arange(start, end - n_obs_steps + 1)
+        for start, end in zip(episode_starts, episode_ends)])
+    rng = np.random.default_rng(seed=seed)
+    starts = rng.choice(starts, size=n_samples, replace=len(starts) < n_samples)
+    obs = np.stack([state[i:i + n_obs_steps, :obs_dim] for i in starts])
+    return torch.from_numpy(obs.astype(np.float32))
+
+
+def sample_actions(policy, obs, seed):
+    """
+    Action predictions one observation at a time, the noise of sample i
+    drawn from seed + i for every sampler.
+    return: actions (N, T, Da), latencies in seconds (N,)
+    """
+    device = policy.device
+    actions = list()
+    latencies = list()
+    for i in range(obs.shape[0]):
+        obs_dict = {'obs': obs[i:i + 1].to(device)}
+        torch.manual_seed(seed + i)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start_time = time.perf_counter()
+        with torch.no_grad():
+            result = policy.predict_action(obs_dict)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        latencies.append(time.perf_counter() - start_time)
+        actions.append(result['action_pred'].cpu())
+    return torch.cat(actions), np.array(latencies)
+
+
+def rmse(x, y):
+    return torch.sqrt(torch.mean(torch.square(x - y))).item()
+
+
+@click.command()
+@click.option('-c', '--checkpoint', required=True)
+@click.option('-d', '--device', default='cuda:0')
+@click.option('--samplers', default='ddim,dpmsolver++')
+@click.option('--steps', default='1,2,3,4', help='inference steps for the few-step samplers')
+@click.option('--reference_steps', default=10, type=int, help='DDPM reference steps')
+@click.option('--zarr_path', default=None, help='recorded observations, default: random')
+@click.option('--n_samples', default=200, type=int)
+@click.option('--n_warmup', default=10, type=int)
+@click.option('--seed', default=0, type=int)
+def main(checkpoint, device, samplers, steps, reference_steps, zarr_path,
+        n_samples, n_warmup, seed):
+    device = torch.device(device)
+    artifact = load_policy_artifact(checkpoint, map_location=device)
+    policy = policy_from_artifact(artifact, device=device)
+    n_obs_steps = policy.n_obs_steps
+    obs_dim = policy.obs_dim
+
+    if zarr_path is None:
+        torch.manual_seed(seed)
+        obs = torch.randn(n_samples, n_obs_steps, obs_dim)
+    else:
+        obs = load_obs_windows(zarr_path, n_samples,
+            n_obs_steps=n_obs_steps, obs_dim=obs_dim, seed=seed)
+
+    def run(sampler, num_inference_steps, seed):
+        policy.set_sampler(sampler, num_inference_steps=num_inference_steps)
+        sample_actions(policy, obs[:n_warmup], seed=seed)
+        return sample_actions(policy, obs, seed=seed)
+
+    reference, reference_latency = run('ddpm', reference_steps, seed)
+    # same sampler, independent noise
+    floor, _ = run('ddpm', reference_steps, seed + n_samples)
+
+    rows = [('ddpm', reference_steps, reference_latency, 0.0),
+        ('ddpm/noise', reference_steps, reference_latency, rmse(floor, reference))]
+    for sampler in samplers.split(','):
+        for num_inference_steps in [int(x) for x in steps.split(',')]:
+            actions, latency = run(sampler, num_inference_steps, seed)
+            rows.append((sampler, num_inference_steps, latency, rmse(actions, reference)))
+
+    source = 'random obs' if zarr_path is None else zarr_path
+    print(f"Relative to ddpm {reference_steps} steps, {n_samples} samples of {source}, batch 1, {device}")
+    print(f"{'sampler':>12} {'steps':>5} {'p50 ms':>8} {'p99 ms':>8} {'speedup':>8} {'action rmse':>12}")
+    reference_p50 = np.percentile(reference_latency, 50)
+    for sampler, num_inference_steps, latency, error in rows:
+        p50, p99 = np.percentile(latency, [50, 99])
+        print(f"{sampler:>12} {num_inference_steps:>5} {p50 * 1e3:>8.2f} {p99 * 1e3:>8.2f} "
+            f"{reference_p50 / p50:>7.2f}x {error:>12.5f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Usage:
+python benchmark_server.py -c data/outputs/train_0/checkpoints/latest.ckpt
+python benchmark_server.py -c data/outputs/train_0/checkpoints/latest.ckpt -d cuda:0 --n_clients 1,4,16,64
+
+Runs an InferenceServer on the policy and 1..N client processes, each
+requesting actions for one robot in a closed loop. Reports throughput,
+the batch sizes formed and the round trip latency seen by the clients.
+"""
+
+import os
+import time
+import tempfile
+import threading
+import click
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from diffusion_policy.common.checkpoint_util import load_policy
+from diffusion_policy.common.inference_server import InferenceServer, InferenceClient
+
+
+def run_client(address, n_requests, obs_shape, seed, start_event, result_queue):
+    client = InferenceClient(address)
+    rng = np.random.default_rng(seed=seed)
+    obs = rng.standard_normal((n_requests,) + obs_shape).astype(np.float32)
+    start_event.wait()
+    latencies = list()
+    for i in range(n_requests):
+        client.predict_action({'obs': obs[i:i+1]})
+        latencies.append(client.last_latency['round_trip_ms'])
+    client.close()
+    result_queue.put(latencies)
+
+
+@click.command()
+@click.option('-c', '--checkpoint', required=True)
+@click.option('-d', '--device', default='cuda:0')
+@click.option('--n_clients', default='1,2,4,8')
+@click.option('--n_requests', default=200, type=int, help='per client')
+@click.option('--max_batch_size', default=64, type=int)
+@click.option('--max_wait_ms', default=2.0, type=float)
+def main(checkpoint, device, n_clients, n_requests, max_batch_size, max_wait_ms):
+    policy = load_policy(checkpoint, device=torch.device(device))
+    obs_shape = (policy.n_obs_steps, policy.obs_dim)
+    ctx = mp.get_context('spawn')
+
+    print(f"{'clients':>7} {'req/s':>9} {'batch':>6} {'p50 ms':>8} {'p99 ms':>8} "
+        f"{'queue p50':>10} {'infer p50':>10}")
+    for n in [int(x) for x in n_clients.split(',')]:
+        address = os.path.join(tempfile.mkdtemp(), 'policy.sock')
+        server = InferenceServer(policy, address,
+            max_batch_size=max_batch_size,
+            max_wait_ms=max_wait_ms)
+        server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+        server_thread.start()
+
+        start_event = ctx.Event()
+        result_queue = ctx.Queue()
+        processes = [ctx.Process(target=run_client,
+            args=(address, n_requests, obs_shape, i, start_event, result_queue))
+            for i in range(n)]
+        for process in processes:
+            process.start()
+        # clients connected and ready
+        time.sleep(2.0)
+        start_time = time.perf_counter()
+        start_event.set()
+        latencies = np.concatenate([result_queue.get() for _ in processes])
+        duration = time.perf_counter() - start_time
+        for process in processes:
+            process.join()
+
+        stats = server.get_stats()
+        server.close()
+        server_thread.join()
+        p50, p99 = np.percentile(latencies, [50, 99])
+        print(f"{n:>7} {len(latencies) / duration:>9.1f} {stats['batch_size_mean']:>6.1f} "
+            f"{p50:>8.2f} {p99:>8.2f} {stats['queue_ms_p50']:>10.2f} {stats['inference_ms_p50']:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Usage:
+python benchmark_warm_start.py -c data/outputs/train_0/checkpoints/latest.ckpt --task cyber2_walk
+python benchmark_warm_start.py -c data/outputs/train_0/checkpoints/latest.ckpt --task cyber2_walk --warm_start_steps none,3,5,7,9
+
+Closed loop evaluation of warm started denoising: each prediction starts
+from the previous plan shifted by the executed actions and re-noised to
+inference step k, running num_inference_steps - k steps instead of all.
+For each k, runs every env until its first episode ends and reports
+survival, heading tracking error (_reward_evaluate_metrics) and the
+predict_action latency against sampling from pure noise.
+"""
+
+import sys
+# use line-buffering for both stdout and stderr
+sys.stdout = open(sys.stdout.fileno(), mode="w", buffering=1)
+sys.stderr = open(sys.stderr.fileno(), mode="w", buffering=1)
+
+try:
+    from isaacgym.torch_utils import *
+except:
+    print("Isaac Gym Not Installed")
+
+import json
+import pathlib
+import click
+import hydra
+import torch
+from omegaconf import OmegaConf
+
+from diffusion_policy.common.checkpoint_util import load_policy_artifact, policy_from_artifact
+
+
+@click.command()
+@click.option("-c", "--checkpoint", required=True)
+@click.option("-d", "--device", default="cuda:0")
+@click.option("--task", default="cyber2_walk")
+@click.option("--output_dir", default="./output")
+@click.option("--warm_start_steps", default="none,3,5,7", help="inference step to warm start at, none: from noise")
+@click.option("--sampler", default=None, help="default: as trained")
+@click.option("--num_inference_steps", default=None, type=int)
+def main(checkpoint, device, task, output_dir, warm_start_steps, sampler, num_inference_steps):
+    pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+    artifact = load_policy_artifact(checkpoint, map_location=device)
+    runner_cfg = OmegaConf.create(artifact["env_runner_cfg"])
+    runner_cfg["device"] = device
+    runner_cfg["_target_"] = "diffusion_policy.env_runner.cyber_runner.LeggedRunner"
+
+    device = torch.device(device)
+    policy = policy_from_artifact(artifact, device=device,
+        sampler=sampler, num_inference_steps=num_inference_steps)
+
+    # one simulator for all settings
+    env_runner = hydra.utils.instantiate(
+        runner_cfg,
+        output_dir=output_dir,
+        task=task,
+        evaluate=True)
+
+    results = dict()
+    for k in warm_start_steps.split(","):
+        k = None if k == "none" else int(k)
+        env_runner.warm_start_step = k
+        torch.manual_seed(0)
+        results[k] = env_runner.run(policy, online=True)
+        print(json.dumps({"warm_start_step": k, **results[k]}))
+
+    n_steps = policy.num_inference_steps
+    reference = results.get(None, next(iter(results.values())))
+    print(f"{policy.sampler} {n_steps} steps, {task}")
+    print(f"{'start k':>7} {'steps':>5} {'p50 ms':>8} {'p99 ms':>8} {'saved':>7} "
+        f"{'survival':>9} {'ep length':>10} {'tracking':>9}")
+    for k, result in results.items():
+        saved = 1 - result["predict_ms_p50"] / reference["predict_ms_p50"]
+        tracking = result.get("tracking_error", float("nan"))
+        print(f"{'none' if k is None else k:>7} {n_steps - (k or 0):>5} "
+            f"{result['predict_ms_p50']:>8.2f} {result['predict_ms_p99']:>8.2f} {saved:>7.1%} "
+            f"{result['survival_rate']:>9.1%} {result['mean_episode_length']:>10.1f} {tracking:>9.4f}")
+
+
+if __name__ == "__main__":
+    main()
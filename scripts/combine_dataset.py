@@ -1,36 +1,27 @@
-import zarr
-import time
-import numpy as np
-
-skill_filenames = ['recorded_data_bounce_12-15-35.zarr', 'recorded_data_cyber2_stand_dance_aug_23-39-56.zarr', 'recorded_data_hop_12-18-21.zarr']
-zroot = zarr.open_group("recorded_data_{}_{}.zarr".format('combined', time.strftime("%H-%M-%S", time.localtime())), "w")
-
-zroot.create_group("data")
-zdata = zroot["data"]
+"""
+Usage:
+python combine_dataset.py recorded_data_bounce_12-15-35.zarr recorded_data_cyber2_stand_dance_aug_23-39-56.zarr recorded_data_hop_12-18-21.zarr
+python combine_dataset.py -o recorded_data_3_skills.zarr --tag_skills recorded_data_*.zarr
+"""
 
-zroot.create_group("meta")
-zmeta = zroot["meta"]
-
-zmeta.create_group("episode_ends")
-
-zdata.create_group("action")
-zdata.create_group("state")
+import time
+import click
 
-action = np.zeros((0,12))
-state = np.zeros((0,45))
-episode_ends = np.zeros((0,))
+from diffusion_policy.common.replay_buffer import ReplayBuffer
 
 
-episode_end = 0
-for skill in skill_filenames: 
-    print("Processing {}".format(skill))
-    zfile = zarr.open(skill, "r")
-    action = np.concatenate([action, zfile["data"]["action"]])
-    state = np.concatenate([state, zfile["data"]["state"]])
-    episode_ends = np.concatenate([episode_ends, np.array(zfile["meta"]["episode_ends"]) + episode_end])
-    episode_end = episode_end + zfile["meta"]["episode_ends"][-1]
+@click.command()
+@click.argument('skill_filenames', nargs=-1, required=True)
+@click.option('-o', '--output', default=None)
+@click.option('--tag_skills', is_flag=True, default=False, help='store per-episode skill index in meta/skill_ids')
+def main(skill_filenames, output, tag_skills):
+    if output is None:
+        output = "recorded_data_{}_{}.zarr".format('combined', time.strftime("%H-%M-%S", time.localtime()))
+    replay_buffer = ReplayBuffer.merge(list(skill_filenames), output,
+        skill_ids=True if tag_skills else None)
+    print(replay_buffer)
+    print(replay_buffer.root.tree())
 
 
-zdata["action"] = action
-zdata["state"] = state
-zmeta["episode_ends"] = episode_ends
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 """
 Usage:
 python eval.py --checkpoint data/image/pusht/diffusion_policy_cnn/train_0/checkpoints/latest.ckpt -o data/pusht_eval_output
+python eval.py --checkpoint data/image/pusht/diffusion_policy_cnn/train_0/checkpoints/latest.ckpt --sampler dpmsolver++ --num_inference_steps 3
 """
 
 import sys
@@ -18,12 +19,10 @@ import pathlib
 import click
 import hydra
 import torch
-import dill
-import wandb
 import json
 from omegaconf import OmegaConf
 
-from diffusion_policy.workspace.base_workspace import BaseWorkspace
+from diffusion_policy.common.checkpoint_util import load_policy_artifact, policy_from_artifact
 
 @click.command()
 @click.option("-c", "--checkpoint", required=True)
@@ -33,38 +32,27 @@ from diffusion_policy.workspace.base_workspace import BaseWorkspace
 @click.option("--headless", default=False)
 @click.option("--online", default=True)
 @click.option("--generate_data", default=False)
-def main(checkpoint, device, task, output_dir, online, generate_data, **kwargs):
+@click.option("--sampler", default=None, help="ddpm, ddim or dpmsolver++, default: as trained")
+@click.option("--num_inference_steps", default=None, type=int)
+def main(checkpoint, device, task, output_dir, online, generate_data,
+        sampler, num_inference_steps, **kwargs):
     pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
     
-    # load checkpoint
-    payload = torch.load(open(checkpoint, "rb"), pickle_module=dill)
-    cfg = payload["cfg"]
+    # load policy weights and configs only, no optimizer or workspace
+    artifact = load_policy_artifact(checkpoint, map_location=device)
+    runner_cfg = OmegaConf.create(artifact["env_runner_cfg"])
 
-
-    OmegaConf.set_struct(cfg, False)
-
-    cfg.task.env_runner["device"] = device
-    cfg["task"]["env_runner"]["_target_"] = "diffusion_policy.env_runner.cyber_runner.LeggedRunner"
-    print("Using {0} number of observation steps.".format(cfg["task"]["env_runner"]["n_obs_steps"]))
-    
-    cls = hydra.utils.get_class(cfg._target_)
-    print(f"Loading workspace {cls.__name__}")
-    workspace = cls(cfg, output_dir=output_dir)
-    workspace: BaseWorkspace
-    workspace.load_payload(payload, exclude_keys=None, include_keys=None)
-    
-    # get policy from workspace
-    policy = workspace.model
-    if cfg.training.use_ema:
-        policy = workspace.ema_model
+    runner_cfg["device"] = device
+    runner_cfg["_target_"] = "diffusion_policy.env_runner.cyber_runner.LeggedRunner"
+    print("Using {0} number of observation steps.".format(runner_cfg["n_obs_steps"]))
     
     device = torch.device(device)
-    policy.to(device)
-    policy.eval()
+    policy = policy_from_artifact(artifact, device=device,
+        sampler=sampler, num_inference_steps=num_inference_steps)
     
     # run eval
     env_runner = hydra.utils.instantiate(
-        cfg.task.env_runner,
+        runner_cfg,
         output_dir=output_dir,
         task=task)
     env_runner.run(policy, online=online, generate_data=generate_data)
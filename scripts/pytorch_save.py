@@ -15,11 +15,9 @@ import click
 import hydra
 import torch
 import torch.onnx
-import dill
-from omegaconf import OmegaConf
 # import onnxruntime
 
-from diffusion_policy.workspace.base_workspace import BaseWorkspace
+from diffusion_policy.common.checkpoint_util import load_policy_artifact, policy_from_artifact
 
 @click.command()
 @click.option('-c', '--checkpoint', required=True)
@@ -28,29 +26,13 @@ from diffusion_policy.workspace.base_workspace import BaseWorkspace
 def main(checkpoint, output_dir, device):
 
     
-    # load checkpoint
-    payload = torch.load(open(checkpoint, 'rb'), pickle_module=dill)
-    cfg = payload['cfg']
+    # load policy weights and configs only, no optimizer or workspace
+    artifact = load_policy_artifact(checkpoint, map_location=device)
+    policy_cfg = artifact['policy_cfg']
     action_steps = 4            # Maybe you need to change this accordingly
-    cfg['task']['env_runner']['_target_'] = 'diffusion_policy.env_runner.isaac_runner.IsaacHumanoidRunner'
-    cfg['n_action_steps'] = action_steps
-    cfg['task']['env_runner']['n_action_steps'] = action_steps
-    cfg['policy']['n_action_steps'] = action_steps
-    OmegaConf.set_struct(cfg, False)
+    policy_cfg['n_action_steps'] = action_steps
 
-
-
-    cfg.task.env_runner['device'] = device
-    
-    cls = hydra.utils.get_class(cfg._target_)
-    workspace = cls(cfg)
-    workspace: BaseWorkspace
-    workspace.load_payload(payload, exclude_keys=None, include_keys=None)
-    
-    # get policy from workspace
-    policy = workspace.model
-    if cfg.training.use_ema:
-        policy = workspace.ema_model
+    policy = policy_from_artifact(artifact, device=device)
     model = policy.model
 
     model = model.eval()
@@ -63,11 +45,11 @@ def main(checkpoint, output_dir, device):
 
     torch.save(model, "./go1_ckpts/go1_unet.pt")
 
-    config_dict = {'horizon': cfg['policy']['horizon'], 
-                   'n_obs_steps': cfg['policy']['n_obs_steps'],
-                   'num_inference_steps': cfg['policy']['num_inference_steps'],
+    config_dict = {'horizon': policy_cfg['horizon'], 
+                   'n_obs_steps': policy_cfg['n_obs_steps'],
+                   'num_inference_steps': policy_cfg['num_inference_steps'],
                    }
-    normalizer_ckpt = {k: v for k, v in payload['state_dicts']['model'].items() if "normalizer" in k}
+    normalizer_ckpt = {k: v for k, v in artifact['state_dict'].items() if "normalizer" in k}
     torch.save((config_dict, normalizer_ckpt), "./go1_ckpts/go1_unet_config_dict.pt")
 
     # onnx_file = "./go1_ckpts/model.onnx"
@@ -0,0 +1,46 @@
+"""
+Usage:
+python serve_policy.py -c data/outputs/train_0/checkpoints/latest.ckpt --address /tmp/diffusion_policy.sock
+python serve_policy.py -c data/outputs/train_0/checkpoints/latest.ckpt -d cuda:0 --max_batch_size 64 --max_wait_ms 1
+
+Serves predict_action of a trained policy to several clients on a Unix
+domain socket, batching concurrent requests. Clients connect with
+diffusion_policy.common.inference_server.InferenceClient, a drop-in for
+policy.predict_action.
+"""
+
+import json
+import click
+import torch
+
+from diffusion_policy.common.checkpoint_util import load_policy
+from diffusion_policy.common.inference_server import InferenceServer
+
+
+@click.command()
+@click.option('-c', '--checkpoint', required=True)
+@click.option('-d', '--device', default='cuda:0')
+@click.option('-a', '--address', default='/tmp/diffusion_policy.sock', help='Unix domain socket path')
+@click.option('--max_batch_size', default=32, type=int)
+@click.option('--max_wait_ms', default=2.0, type=float)
+@click.option('--sampler', default=None, help='default: as trained')
+@click.option('--num_inference_steps', default=None, type=int)
+def main(checkpoint, device, address, max_batch_size, max_wait_ms,
+        sampler, num_inference_steps):
+    policy = load_policy(checkpoint, device=torch.device(device),
+        sampler=sampler, num_inference_steps=num_inference_steps)
+    server = InferenceServer(policy, address,
+        max_batch_size=max_batch_size,
+        max_wait_ms=max_wait_ms)
+    print(f"Serving {checkpoint} on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        print(json.dumps(server.get_stats(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
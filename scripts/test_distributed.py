@@ -0,0 +1,119 @@
+"""
+Usage:
+torchrun --nproc_per_node=2 scripts/test_distributed.py
+torchrun --nproc_per_node=2 scripts/test_distributed.py --config diffusion_policy/config_files/cyber_diffusion_policy_n=8.yaml --steps 5
+
+Smoke test of distributed data parallel training on CPU with the gloo
+backend: init_distributed, create_dataloader(distributed=True) and a few
+DistributedDataParallel steps of the configured policy on random data.
+Checks that the ranks' shards cover the dataset with the same number of
+batches each and that the parameters are identical on all ranks after
+training. Exits with an error otherwise.
+"""
+
+import sys
+# use line-buffering for both stdout and stderr
+sys.stdout = open(sys.stdout.fileno(), mode="w", buffering=1)
+sys.stderr = open(sys.stderr.fileno(), mode="w", buffering=1)
+
+import click
+import hydra
+import torch
+import torch.distributed as dist
+from omegaconf import OmegaConf
+
+from diffusion_policy.common.distributed_util import (
+    init_distributed, cleanup_distributed, PolicyLossModule)
+from diffusion_policy.dataset.base_dataset import create_dataloader, set_dataloader_epoch
+from diffusion_policy.model.common.normalizer import LinearNormalizer
+
+OmegaConf.register_new_resolver("eval", eval, replace=True)
+
+
+class RandomLowdimDataset(torch.utils.data.Dataset):
+    """
+    Fixed random obs and action windows, the same on every rank.
+    """
+    def __init__(self, n_samples, horizon, obs_dim, action_dim, seed=0):
+        generator = torch.Generator().manual_seed(seed)
+        self.obs = torch.randn(n_samples, horizon, obs_dim, generator=generator)
+        self.action = torch.randn(n_samples, horizon, action_dim, generator=generator)
+
+    def get_normalizer(self):
+        normalizer = LinearNormalizer()
+        normalizer.fit(data={'obs': self.obs, 'action': self.action},
+            last_n_dims=1, mode='limits')
+        return normalizer
+
+    def __len__(self):
+        return len(self.obs)
+
+    def __getitem__(self, idx):
+        return {'obs': self.obs[idx], 'action': self.action[idx]}
+
+
+@click.command()
+@click.option("--config", default="diffusion_policy/config_files/cyber_diffusion_policy_n=8.yaml")
+@click.option("--n_samples", default=256, type=int)
+@click.option("--batch_size", default=16, type=int)
+@click.option("--steps", default=3, type=int, help="training steps per rank")
+def main(config, n_samples, batch_size, steps):
+    rank, world_size, _ = init_distributed('gloo')
+    assert world_size > 1, "launch with torchrun --nproc_per_node=2"
+    cfg = OmegaConf.load(config)
+
+    # same initial weights on every rank, DDP also broadcasts them from rank 0
+    torch.manual_seed(cfg.training.seed)
+    policy = hydra.utils.instantiate(cfg.policy)
+    dataset = RandomLowdimDataset(n_samples,
+        horizon=cfg.horizon, obs_dim=cfg.obs_dim, action_dim=cfg.action_dim)
+    policy.set_normalizer(dataset.get_normalizer())
+
+    dataloader = create_dataloader(dataset, batch_size=batch_size,
+        shuffle=True, distributed=True)
+    set_dataloader_epoch(dataloader, 0)
+
+    # every index on some rank, the same number of batches on each
+    indices = torch.tensor(list(dataloader.sampler))
+    all_indices = [torch.zeros_like(indices) for _ in range(world_size)]
+    dist.all_gather(all_indices, indices)
+    assert len(set(torch.cat(all_indices).tolist())) == len(dataset), \
+        "shards don't cover the dataset"
+    n_batches = torch.tensor(len(dataloader))
+    all_n_batches = [torch.zeros_like(n_batches) for _ in range(world_size)]
+    dist.all_gather(all_n_batches, n_batches)
+    assert len(set(x.item() for x in all_n_batches)) == 1, \
+        f"different number of batches per rank: {all_n_batches}"
+
+    # different diffusion noise on every rank
+    torch.manual_seed(cfg.training.seed + rank)
+    loss_module = torch.nn.parallel.DistributedDataParallel(PolicyLossModule(policy))
+    optimizer = torch.optim.AdamW(policy.parameters(), lr=1e-3)
+    losses = list()
+    for batch_idx, batch in enumerate(dataloader):
+        if batch_idx >= steps:
+            break
+        loss = loss_module(batch)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        losses.append(loss.item())
+
+    # parameters of rank 0 on every rank
+    params = torch.cat([p.detach().flatten() for p in policy.parameters()])
+    rank0_params = params.clone()
+    dist.broadcast(rank0_params, src=0)
+    max_diff = torch.max(torch.abs(params - rank0_params))
+    dist.all_reduce(max_diff, op=dist.ReduceOp.MAX)
+
+    if rank == 0:
+        print(f"{world_size} ranks, {len(dataloader)} batches per rank, "
+            f"losses {[round(x, 4) for x in losses]}")
+        print(f"max parameter difference between ranks: {max_diff.item()}")
+    cleanup_distributed()
+    if max_diff.item() != 0:
+        raise RuntimeError("parameters diverged between ranks")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Usage:
+python tune_dataset_chunks.py -i recorded_data_5_skills_large.zarr
+python tune_dataset_chunks.py -i recorded_data_5_skills_large.zarr -o recorded_data_tuned.zarr --objective load
+
+Benchmarks chunk length x codec combinations on a prefix of the dataset,
+using the SequenceSampler window access pattern of training, and rewrites
+the dataset with the best one (in place unless -o is given).
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import click
+import zarr
+import numcodecs
+import numpy as np
+
+from diffusion_policy.common.replay_buffer import ReplayBuffer, load_array_parallel
+from diffusion_policy.common.sampler import SequenceSampler
+
+
+def parse_codec(name):
+    """
+    none, lz4 (ReplayBuffer 'default'), zstd<level> (bitshuffle, like 'disk')
+    """
+    if name == 'none':
+        return None
+    elif name == 'lz4':
+        return ReplayBuffer.resolve_compressor('default')
+    elif name.startswith('zstd'):
+        level = int(name[len('zstd'):] or 5)
+        return numcodecs.Blosc('zstd', clevel=level,
+            shuffle=numcodecs.Blosc.BITSHUFFLE)
+    raise ValueError(f"Unsupported codec {name}")
+
+
+def get_dir_size(path):
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.path.getsize(os.path.join(dirpath, filename))
+    return size
+
+
+def load_prefix(zarr_path, keys, max_steps):
+    """
+    Whole episodes from the start of the dataset, up to max_steps.
+    """
+    group = zarr.open(os.path.expanduser(zarr_path), 'r')
+    episode_ends = group['meta']['episode_ends'][:]
+    n_episodes = max(1, np.searchsorted(episode_ends, max_steps, side='right'))
+    episode_ends = episode_ends[:n_episodes]
+    data = dict()
+    for key in keys:
+        data[key] = group['data'][key][:episode_ends[-1]]
+    return ReplayBuffer(root={
+        'meta': {'episode_ends': episode_ends},
+        'data': data
+    })
+
+
+def benchmark(replay_buffer, path, chunk_length, compressor,
+        horizon, pad_before, pad_after, n_windows, num_threads, seed=0):
+    chunks = dict()
+    compressors = dict()
+    for key, value in replay_buffer.items():
+        chunks[key] = (min(chunk_length, value.shape[0]),) + value.shape[1:]
+        compressors[key] = compressor
+    replay_buffer.save_to_path(path, chunks=chunks, compressors=compressors)
+    disk_bytes = get_dir_size(path)
+
+    # full load, what CyberDogDataset does at startup
+    group = zarr.open(path, 'r')
+    nbytes = 0
+    start_time = time.perf_counter()
+    for key in replay_buffer.keys():
+        nbytes += load_array_parallel(group['data'][key],
+            num_threads=num_threads, desc=key).nbytes
+    load_sec = time.perf_counter() - start_time
+
+    # random windows straight from disk, as SequenceSampler reads them
+    sampler = SequenceSampler(
+        replay_buffer=ReplayBuffer.create_from_path(path, mode='r'),
+        sequence_length=horizon,
+        pad_before=pad_before,
+        pad_after=pad_after)
+    rng = np.random.default_rng(seed=seed)
+    latencies = list()
+    for idx in rng.integers(0, len(sampler), size=n_windows):
+        start_time = time.perf_counter()
+        sampler.sample_sequence(idx)
+        latencies.append(time.perf_counter() - start_time)
+    latencies = np.array(latencies) * 1000
+
+    return {
+        'load_mb_per_sec': nbytes / 1e6 / load_sec,
+        'window_ms_p50': np.percentile(latencies, 50),
+        'window_ms_p99': np.percentile(latencies, 99),
+        'disk_mb': disk_bytes / 1e6
+    }
+
+
+def rewrite_zarr(src_path, dst_path, chunk_length, compressor):
+    src_root = zarr.open(os.path.expanduser(src_path), 'r')
+    dst_root = zarr.open(os.path.expanduser(dst_path), 'w')
+    zarr.copy_store(source=src_root.store, dest=dst_root.store,
+        source_path='/meta', dest_path='/meta')
+    data_group = dst_root.create_group('data')
+    for key, value in src_root['data'].items():
+        # zarr.copy streams chunk by chunk
+        zarr.copy(source=value, dest=data_group, name=key,
+            chunks=(min(chunk_length, value.shape[0]),) + value.shape[1:],
+            compressor=compressor)
+
+
+@click.command()
+@click.option('-i', '--input', 'input_path', required=True)
+@click.option('-o', '--output', 'output_path', default=None, help='default: rewrite input in place')
+@click.option('--keys', default='state,action')
+@click.option('--chunk_lengths', default='1024,4096,16384,65536')
+@click.option('--codecs', default='lz4,zstd1,zstd3,zstd5,none')
+@click.option('--horizon', default=16, type=int)
+@click.option('--pad_before', default=1, type=int)
+@click.option('--pad_after', default=7, type=int)
+@click.option('--max_steps', default=1000000, type=int, help='benchmark on this many steps')
+@click.option('--n_windows', default=2000, type=int)
+@click.option('--num_threads', default=1, type=int)
+@click.option('--objective', default='window', type=click.Choice(['window', 'load', 'size']))
+@click.option('--dry_run', is_flag=True, default=False)
+def main(input_path, output_path, keys, chunk_lengths, codecs,
+        horizon, pad_before, pad_after, max_steps, n_windows, num_threads,
+        objective, dry_run):
+    keys = keys.split(',')
+    chunk_lengths = [int(x) for x in chunk_lengths.split(',')]
+    codecs = codecs.split(',')
+
+    replay_buffer = load_prefix(input_path, keys=keys, max_steps=max_steps)
+    print(f"Benchmarking on {replay_buffer.n_episodes} episodes, {replay_buffer.n_steps} steps")
+
+    results = list()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for chunk_length in chunk_lengths:
+            for codec in codecs:
+                path = os.path.join(tmp_dir, f'{chunk_length}_{codec}.zarr')
+                result = benchmark(replay_buffer, path,
+                    chunk_length=chunk_length,
+                    compressor=parse_codec(codec),
+                    horizon=horizon,
+                    pad_before=pad_before,
+                    pad_after=pad_after,
+                    n_windows=n_windows,
+                    num_threads=num_threads)
+                shutil.rmtree(path)
+                result.update(chunk_length=chunk_length, codec=codec)
+                results.append(result)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if objective == 'window':
+        best = min(results, key=lambda x: x['window_ms_p50'])
+    elif objective == 'load':
+        best = max(results, key=lambda x: x['load_mb_per_sec'])
+    else:
+        best = min(results, key=lambda x: x['disk_mb'])
+
+    print(f"{'chunk':>8} {'codec':>6} {'load MB/s':>10} {'win p50 ms':>11} {'win p99 ms':>11} {'disk MB':>9}")
+    for result in results:
+        marker = ' *' if result is best else ''
+        print(f"{result['chunk_length']:>8} {result['codec']:>6} "
+            f"{result['load_mb_per_sec']:>10.1f} {result['window_ms_p50']:>11.3f} "
+            f"{result['window_ms_p99']:>11.3f} {result['disk_mb']:>9.1f}{marker}")
+
+    if dry_run:
+        return
+
+    compressor = parse_codec(best['codec'])
+    if output_path is not None:
+        rewrite_zarr(input_path, output_path, best['chunk_length'], compressor)
+        print(f"Wrote {output_path}")
+    else:
+        src_path = os.path.expanduser(input_path).rstrip('/')
+        tmp_path = src_path + '.tuning'
+        backup_path = src_path + '.backup'
+        rewrite_zarr(src_path, tmp_path, best['chunk_length'], compressor)
+        os.rename(src_path, backup_path)
+        os.rename(tmp_path, src_path)
+        shutil.rmtree(backup_path)
+        print(f"Rewrote {src_path}")
+    print(f"chunk_length={best['chunk_length']} codec={best['codec']}")
+
+
+if __name__ == '__main__':
+    main()